@@ -0,0 +1,85 @@
+"""Benchmark: recall@1 and QPS of the NumPy IVF engine against exact search.
+
+Galleries are synthetic clustered 512-d embeddings (identities with several
+noisy samples each), queries are fresh noisy samples of registered
+identities. Runs on CPU; a 10M gallery needs ~40 GB of RAM (exact matrix
+plus the per-list copies of the IVF index).
+
+    python -m bench.ann_recall --sizes 10000,100000,1000000 --queries 1000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from gallery import EMBEDDING_DIM, SNAPSHOT_CHUNK, GalleryIndex, IVFIndex, ivf_params
+
+SAMPLES_PER_IDENTITY = 4
+NOISE = 0.6
+
+
+def synthetic_gallery(size, dim, rng):
+    """(identity centers, embeddings) with SAMPLES_PER_IDENTITY rows per center"""
+    centers = rng.standard_normal(
+        (max(1, size // SAMPLES_PER_IDENTITY), dim), dtype=np.float32
+    )
+    embeddings = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, SNAPSHOT_CHUNK):
+        stop = min(size, start + SNAPSHOT_CHUNK)
+        noise = rng.standard_normal((stop - start, dim), dtype=np.float32)
+        embeddings[start:stop] = (
+            centers[np.arange(start, stop) % len(centers)] + NOISE * noise
+        )
+    return centers, embeddings
+
+
+def measure(index, queries, batch_size):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(queries), batch_size):
+        results.extend(index.search_batch(queries[i : i + batch_size], k=1))
+    elapsed = time.perf_counter() - start
+    return [matches[0][1] for matches in results], len(queries) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--nprobe", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'size':>10} {'lists':>6} {'probes':>6} {'build s':>8} "
+        f"{'exact qps':>10} {'ivf qps':>10} {'recall@1':>9}"
+    )
+    for size in map(int, args.sizes.split(",")):
+        centers, embeddings = synthetic_gallery(size, EMBEDDING_DIM, rng)
+        ids = np.arange(size)
+        names = ids.astype(str)
+        queries = centers[rng.integers(0, len(centers), args.queries)]
+        queries = queries + NOISE * rng.standard_normal(queries.shape, np.float32)
+
+        exact = GalleryIndex()
+        exact.load_arrays(ids, names, embeddings)
+        start = time.perf_counter()
+        ivf = IVFIndex(nprobe=args.nprobe)
+        ivf.load_arrays(ids, names, embeddings)
+        build = time.perf_counter() - start
+        del embeddings
+
+        expected, exact_qps = measure(exact, queries, args.batch_size)
+        actual, ivf_qps = measure(ivf, queries, args.batch_size)
+        recall = np.mean([a == e for a, e in zip(actual, expected)])
+        lists, probes = ivf_params(size)
+        print(
+            f"{size:>10} {lists:>6} {args.nprobe or probes:>6} {build:>8.1f} "
+            f"{exact_qps:>10.0f} {ivf_qps:>10.0f} {recall:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Benchmark: per-box cv2 label rendering against the cached label sprites.
+
+Frames are 1080p with `--faces` boxes each; boxes follow drifting tracks
+whose labels are drawn from a pool of `--names` identities with their match
+distance, plus "Not recognized", as annotate_frame produces them. Labels
+change every `--refresh` frames: TRACK_REFRESH_FRAMES when the tracker
+reuses matches, 1 when every frame is matched again and the distances
+change. Some tracks sit on the frame edges so clipped labels are covered.
+Every sprite-annotated frame is compared with putText drawing the same
+label parts ("max diff" should be 0). Where OpenCV anti-aliases text
+(OpenCV 5) utils.LABEL_SPRITES is off and both columns time putText.
+
+    python -m bench.annotation --faces 1,4,16 --frames 300 --refresh 1
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from inference import TRACK_REFRESH_FRAMES
+from utils import LABEL_SPRITES, draw_detections, label_parts, label_sprite
+
+WIDTH, HEIGHT = 1920, 1080
+# Border around the reference canvas, larger than any label overhang
+EDGE_PAD = 64
+
+
+def legacy_draw(image, bboxes, labels):
+    """The draw_bbox/label_on_box path before sprites: rasterizes every
+    label of every box"""
+    for bbox, label in zip(bboxes, labels):
+        x_min, y_min, x_max, y_max = (int(v) for v in bbox)
+        cv2.rectangle(image, (x_min, y_min), (x_max, y_max), (0, 0, 255), 2)
+        current_y = y_min - 10
+        (text_width, text_height), _ = cv2.getTextSize(
+            label, cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2
+        )
+        cv2.rectangle(
+            image,
+            (x_min, current_y - text_height),
+            (x_min + text_width, current_y),
+            (255, 255, 255),
+            cv2.FILLED,
+        )
+        cv2.putText(
+            image,
+            label,
+            (x_min, current_y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.75,
+            (0, 0, 255),
+            2,
+        )
+
+
+def parts_draw(image, bboxes, labels):
+    """legacy_draw with every label_parts part put side by side, as the
+    sprites lay them out"""
+    for bbox, label in zip(bboxes, labels):
+        x_min, y_min, x_max, y_max = (int(v) for v in bbox)
+        cv2.rectangle(image, (x_min, y_min), (x_max, y_max), (0, 0, 255), 2)
+        current_y = y_min - 10
+        (_, text_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2)
+        for part in label_parts(label):
+            (text_width, _), _ = cv2.getTextSize(
+                part, cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2
+            )
+            cv2.rectangle(
+                image,
+                (x_min, current_y - text_height),
+                (x_min + text_width, current_y),
+                (255, 255, 255),
+                cv2.FILLED,
+            )
+            cv2.putText(
+                image,
+                part,
+                (x_min, current_y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.75,
+                (0, 0, 255),
+                2,
+            )
+            x_min += text_width
+
+
+def reference_draw(image, bboxes, labels):
+    """parts_draw on a canvas padded by EDGE_PAD, cropped back: labels
+    clipped by the frame edges as if drawn whole (OpenCV's own clipping
+    can shift the edge row of a clipped glyph by a pixel)"""
+    if not LABEL_SPRITES:
+        legacy_draw(image, bboxes, labels)
+        return
+    canvas = cv2.copyMakeBorder(image, *(EDGE_PAD,) * 4, cv2.BORDER_CONSTANT)
+    shifted = [[v + EDGE_PAD for v in bbox] for bbox in bboxes]
+    parts_draw(canvas, shifted, labels)
+    image[:] = canvas[EDGE_PAD:-EDGE_PAD, EDGE_PAD:-EDGE_PAD]
+
+
+def synthetic_frames(count, faces, names, refresh, rng):
+    """(bboxes, labels) per frame of `faces` drifting tracks; a track's
+    label changes when it is re-matched, every `refresh` frames, and every
+    fourth track hugs a frame edge"""
+    size = rng.integers(40, 200, faces)
+    x = rng.integers(-60, WIDTH - 20, faces)
+    y = rng.integers(-20, HEIGHT - 20, faces)
+    x[::4] = rng.choice([-30, WIDTH - 40], len(x[::4]))
+    y[::4] = rng.choice([2, HEIGHT - 30], len(y[::4]))
+    frames = []
+    for frame_num in range(count):
+        if frame_num % refresh == 0:
+            labels = [
+                (
+                    f"person-{rng.integers(names)} ({rng.uniform(0.1, 0.7):.2f})"
+                    if rng.random() < 0.7
+                    else "Not recognized"
+                )
+                for _ in range(faces)
+            ]
+        x = x + rng.integers(-2, 3, faces)
+        y = y + rng.integers(-2, 3, faces)
+        bboxes = np.stack([x, y, x + size, y + size], axis=1).tolist()
+        frames.append((bboxes, labels))
+    return frames
+
+
+def measure(draw, background, frames):
+    """Microseconds per frame of `draw`"""
+    elapsed = 0.0
+    for bboxes, labels in frames:
+        image = background.copy()
+        start = time.perf_counter()
+        draw(image, bboxes, labels)
+        elapsed += time.perf_counter() - start
+    return elapsed / len(frames) * 1e6
+
+
+def max_diff(background, frames):
+    """Largest pixel difference between draw_detections and reference_draw"""
+    diff = 0
+    for bboxes, labels in frames:
+        actual, expected = background.copy(), background.copy()
+        draw_detections(actual, bboxes, labels)
+        reference_draw(expected, bboxes, labels)
+        diff = max(diff, int(np.abs(actual.astype(np.int16) - expected).max()))
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--faces", default="1,4,16")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--names", type=int, default=20)
+    parser.add_argument("--refresh", type=int, default=TRACK_REFRESH_FRAMES)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    print(
+        f"{'faces':>6} {'legacy us':>10} {'sprite us':>10} {'speedup':>8} "
+        f"{'hit rate':>9} {'max diff':>9}"
+    )
+    for faces in map(int, args.faces.split(",")):
+        frames = synthetic_frames(args.frames, faces, args.names, args.refresh, rng)
+        label_sprite.cache_clear()
+        legacy = measure(legacy_draw, background, frames)
+        sprite = measure(draw_detections, background, frames)
+        info = label_sprite.cache_info()
+        lookups = info.hits + info.misses
+        hit_rate = f"{info.hits / lookups:.3f}" if lookups else "-"
+        print(
+            f"{faces:>6} {legacy:>10.1f} {sprite:>10.1f} {legacy / sprite:>8.2f} "
+            f"{hit_rate:>9} {max_diff(background, frames):>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
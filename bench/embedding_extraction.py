@@ -0,0 +1,69 @@
+"""Microbenchmark: per-element embedding extraction vs. a single ctypes view.
+
+Runs without a GPU: the NvDsInferLayerInfo output buffer is replaced by a
+synthetic ctypes float array and `pyds.get_detections` by an equivalent
+per-element Python-to-C read.
+
+    python -m bench.embedding_extraction --iterations 20000
+"""
+
+import argparse
+import ctypes
+import time
+
+import numpy as np
+
+from utils import embedding_from_buffer
+
+try:
+    from sklearn.preprocessing import normalize
+except ImportError:
+    normalize = None
+
+
+def get_detections(buffer, index):
+    # Same shape of call as pyds.get_detections(layer.buffer, i)
+    return buffer[index]
+
+
+def legacy_extract(buffer, size):
+    emb = np.array([get_detections(buffer, i) for i in range(size)])
+    if normalize is not None:
+        return normalize(emb.reshape(1, -1)).flatten()
+    return emb / np.linalg.norm(emb)
+
+
+def vectorized_extract(buffer, size):
+    return embedding_from_buffer(ctypes.addressof(buffer), size)
+
+
+def measure(func, buffer, size, iterations):
+    func(buffer, size)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(buffer, size)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    values = np.random.default_rng(0).normal(size=args.size).astype(np.float32)
+    buffer = (ctypes.c_float * args.size)(*values)
+
+    expected = legacy_extract(buffer, args.size)
+    actual = vectorized_extract(buffer, args.size)
+    assert np.allclose(expected, actual, atol=1e-6), "extraction results differ"
+
+    legacy = measure(legacy_extract, buffer, args.size, args.iterations)
+    vectorized = measure(vectorized_extract, buffer, args.size, args.iterations)
+    print(f"legacy     : {legacy * 1e6:9.2f} us/face")
+    print(f"vectorized : {vectorized * 1e6:9.2f} us/face")
+    print(f"speedup    : {legacy / vectorized:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""CPU stand-ins for the DeepStream pipeline and the `faces` table.
+
+`install()` registers FakeInference as the inference backend before `main`
+is imported, so the real FastAPI app, search layer, match cache and
+tracker run unchanged on top of synthetic detections.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from prometheus_client import Histogram
+
+import inference
+from bench.ann_recall import synthetic_gallery
+from gallery import EMBEDDING_DIM, GalleryIndex, l2_normalize
+from inference import (
+    IMAGE_BATCH_SIZE,
+    IMAGE_BATCH_WINDOW_MS,
+    ImageBatchScheduler,
+    InferenceBackend,
+    StreamOutputs,
+    face_search,
+    frame_records,
+    image_postprocessor,
+    match_batch_faces,
+    video_postprocessor,
+)
+from match_cache import MatchCache
+from metrics import LATENCY_BUCKETS
+
+# Per-dimension noise of a known face (cosine distance ~0.1, within THRESHOLD)
+KNOWN_FACE_NOISE = 0.02
+
+BENCH_STAGE_SECONDS = Histogram(
+    "bench_stage_seconds",
+    "Stages of the fake pipeline that stand in for GPU work",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class FakeSession:
+    """Async session stand-in that records inserted rows in `table`"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def begin(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement, params=None):
+        self.table.extend(params or [])
+
+
+class FakeInference(InferenceBackend):
+    """Inference backend without models.
+
+    Images are decoded with OpenCV (standing in for nvv4l2decoder) and
+    batched by the real ImageBatchScheduler; the detector and recognizer
+    are replaced by a sleep of `inference_ms` per batch and
+    `faces_per_frame` synthetic embeddings per frame. Matching, records
+    and metrics go through the real image_postprocessor and
+    PGVectorFaceSearch.
+    """
+
+    def __init__(self, tracker=None):
+        super().__init__(tracker)
+        self.workload = _workload
+        self.image_scheduler = None
+        self.image_post = None
+
+    def start_image_pipeline(
+        self,
+        batch_size=IMAGE_BATCH_SIZE,
+        batch_window_ms=IMAGE_BATCH_WINDOW_MS,
+        warmup=True,
+    ):
+        if self.image_scheduler is not None:
+            return
+        self.image_post = image_postprocessor(self.image_requests)
+        self.image_scheduler = ImageBatchScheduler(
+            lambda batch: self.workload.executor.submit(self._infer_batch, batch),
+            batch_size=batch_size,
+            window_ms=batch_window_ms,
+        )
+
+    def stop_image_pipeline(self):
+        if self.image_scheduler is None:
+            return
+        self.image_scheduler.close()
+        self.image_post.close()
+        self.image_requests.fail_all(RuntimeError("Image pipeline stopped"))
+        self.image_scheduler = None
+        self.image_post = None
+
+    def _detect(self, width, height):
+        """(bbox, embedding, object_id) of faces_per_frame synthetic faces"""
+        faces = []
+        for i in range(self.workload.faces_per_frame):
+            size = max(16, min(width, height) // 8)
+            x = (i * size * 2) % max(1, width - size)
+            bbox = [x, size, x + size, 2 * size]
+            faces.append((bbox, self.workload.embedding(), i))
+        return faces
+
+    def _infer_batch(self, batch):
+        """One engine call for a batch of (image, pts)"""
+        try:
+            with BENCH_STAGE_SECONDS.labels("inference").time():
+                time.sleep(self.workload.inference_ms / 1000.0)
+                frames = [
+                    (pts, image, self._detect(image.shape[1], image.shape[0]))
+                    for image, pts in batch
+                ]
+            self.image_post.submit(frames, len(frames))
+        except Exception as e:
+            for _, pts in batch:
+                self.image_requests.fail(pts, e)
+
+    def submit_image(self, image_bytes):
+        with BENCH_STAGE_SECONDS.labels("decode").time():
+            image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Unsupported or corrupt image")
+        if self.image_scheduler is None:
+            raise RuntimeError("Image pipeline is not running")
+        pts, future = self.image_requests.register()
+        self.image_scheduler.submit(image, pts)
+        return pts, future
+
+    def run_image(self, image_path):
+        """One image through the fake detector and the real matching"""
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        faces = [self._detect(image.shape[1], image.shape[0])]
+        records = frame_records(image, faces[0], match_batch_faces(faces))
+        return image, records[1:]
+
+    def run_video(self, uri, output_path=None, on_result=None, **options):
+        """Emit `video_frames` frames of tracked synthetic faces through the
+        real video post-processing stage (no frames are drawn)"""
+        outputs = StreamOutputs(
+            None,
+            lambda source_id: 30,
+            (1920, 1080),
+            on_result=on_result,
+            recognizer=self._make_recognizer(),
+        )
+        post = video_postprocessor(outputs)
+        faces = self._detect(1920, 1080)
+        try:
+            for frame_num in range(self.workload.video_frames):
+                with BENCH_STAGE_SECONDS.labels("inference").time():
+                    time.sleep(self.workload.inference_ms / 1000.0)
+                post.submit([(0, frame_num, frame_num / 30.0, None, faces)])
+        finally:
+            post.close()
+        if output_path:
+            open(output_path, "wb").close()
+
+
+class Workload:
+    """Synthetic gallery and detections shared by the fakes"""
+
+    def __init__(
+        self,
+        gallery_size,
+        faces_per_frame,
+        known_ratio,
+        inference_ms,
+        video_frames,
+        workers,
+        seed=0,
+    ):
+        self.faces_per_frame = faces_per_frame
+        self.known_ratio = known_ratio
+        self.inference_ms = inference_ms
+        self.video_frames = video_frames
+        self.rng = np.random.default_rng(seed)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        _, self.gallery = synthetic_gallery(gallery_size, EMBEDDING_DIM, self.rng)
+        self._lock = threading.Lock()
+
+    def embedding(self):
+        with self._lock:
+            if len(self.gallery) and self.rng.random() < self.known_ratio:
+                base = l2_normalize(self.gallery[self.rng.integers(len(self.gallery))])
+                noise = self.rng.standard_normal(EMBEDDING_DIM, np.float32)
+                return l2_normalize(base + KNOWN_FACE_NOISE * noise)
+            return l2_normalize(self.rng.standard_normal(EMBEDDING_DIM, np.float32))
+
+    def index(self):
+        index = GalleryIndex()
+        index.load_arrays(
+            [uuid.UUID(int=i) for i in range(len(self.gallery))],
+            [f"person-{i}" for i in range(len(self.gallery))],
+            self.gallery,
+        )
+        return index
+
+
+_workload = None
+
+
+def install(workload, cache=True):
+    """Select FakeInference as the backend and load the synthetic gallery
+    into the shared matcher; returns the faces table"""
+    global _workload
+    _workload = workload
+    face_search.index = workload.index()
+    face_search.cache = MatchCache() if cache else None
+    inference.BACKENDS["bench"] = "bench.fakes:FakeInference"
+    inference.INFERENCE_BACKEND = "bench"
+    return []  # rows inserted through FakeSession
@@ -0,0 +1,203 @@
+"""Benchmark: the FastAPI endpoints on CPU stand-ins for DeepStream and Postgres.
+
+Drives the real `main.app` in process (no server, no GPU, no database)
+with the fakes of bench/fakes.py, and prints one JSON document with
+requests/s, latency percentiles, status codes and the per-stage time
+breakdown taken from the service's Prometheus histograms, so runs can be
+diffed against a baseline.
+
+    python -m bench.service --requests 500 --concurrency 16 --faces-per-frame 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+
+import cv2
+import numpy as np
+
+from bench import fakes
+
+SCENARIOS = ("search", "search_topk", "register", "register_bulk", "video_detections")
+
+
+def histogram_totals(registry):
+    """{(metric, labels): (sum, count)} of every histogram in the registry"""
+    totals = {}
+    for metric in registry.collect():
+        if metric.type != "histogram":
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith(("_sum", "_count")):
+                labels = tuple(sorted(sample.labels.items()))
+                key = (metric.name, labels)
+                total = totals.setdefault(key, [0.0, 0.0])
+                total[0 if sample.name.endswith("_sum") else 1] = sample.value
+    return totals
+
+
+def stage_breakdown(before, after):
+    """Mean seconds and count per histogram series observed during a run"""
+    stages = {}
+    for (name, labels), (total, count) in after.items():
+        prev_total, prev_count = before.get((name, labels), (0.0, 0.0))
+        count -= prev_count
+        if count <= 0:
+            continue
+        label = ",".join(f"{k}={v}" for k, v in labels)
+        key = f"{name}{{{label}}}" if label else name
+        stages[key] = {
+            "count": int(count),
+            "mean_ms": 1000.0 * (total - prev_total) / count,
+        }
+    return stages
+
+
+def percentiles(latencies):
+    values = np.array(latencies) * 1000.0
+    summary = {f"p{p}_ms": float(np.percentile(values, p)) for p in (50, 90, 95, 99)}
+    summary["max_ms"] = float(values.max())
+    summary["mean_ms"] = float(values.mean())
+    return summary
+
+
+def make_request(scenario, image, bulk_size):
+    """(method, url, request kwargs) of one request of a scenario"""
+    upload = ("face.jpg", image, "image/jpeg")
+    if scenario == "search":
+        return "/search", {"files": {"file": upload}}
+    if scenario == "search_topk":
+        return "/search/topk?k=5", {"files": {"file": upload}}
+    if scenario == "register":
+        return "/register", {"files": {"file": upload}, "data": {"name": "bench"}}
+    if scenario == "register_bulk":
+        files = [
+            ("files", (f"bench-{i}.jpg", image, "image/jpeg")) for i in range(bulk_size)
+        ]
+        return "/register/bulk", {"files": files}
+    return "/infer-video/detections", {
+        "files": {"file": ("clip.mp4", b"\0", "video/mp4")}
+    }
+
+
+async def run_scenario(client, registry, scenario, image, args):
+    url, kwargs = make_request(scenario, image, args.bulk_size)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, statuses = [], {}
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(url, **kwargs)
+            await response.aread()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    for _ in range(min(args.warmup, args.requests)):
+        await one()
+    latencies.clear()
+    statuses.clear()
+
+    before = histogram_totals(registry)
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": args.requests,
+        "seconds": elapsed,
+        "requests_per_second": args.requests / elapsed,
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+        "latency": percentiles(latencies),
+        "stages": stage_breakdown(before, histogram_totals(registry)),
+    }
+
+
+async def run(args):
+    import httpx
+    from prometheus_client import REGISTRY
+
+    workload = fakes.Workload(
+        gallery_size=args.gallery_size,
+        faces_per_frame=args.faces_per_frame,
+        known_ratio=args.known_ratio,
+        inference_ms=args.inference_ms,
+        video_frames=args.video_frames,
+        workers=args.workers,
+        seed=args.seed,
+    )
+    table = fakes.install(workload, cache=not args.no_cache)
+
+    import main
+    from search import get_session
+
+    async def fake_session():
+        yield fakes.FakeSession(table)
+
+    main.app.dependency_overrides[get_session] = fake_session
+    # The startup hook also needs the database: only its pipeline is started
+    main.face_ds.start_image_pipeline()
+    image = cv2.imencode(
+        ".jpg",
+        np.random.default_rng(args.seed).integers(0, 255, (720, 1280, 3), np.uint8),
+    )[1].tobytes()
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=60
+    ) as client:
+        for scenario in args.scenarios.split(","):
+            results[scenario] = await run_scenario(
+                client, REGISTRY, scenario, image, args
+            )
+    main.face_ds.stop_image_pipeline()
+    main.video_jobs.shutdown()
+    workload.executor.shutdown()
+    return {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+        },
+        "gallery_faces": len(fakes.face_search.index),
+        "rows_inserted": len(table),
+        "match_cache": (
+            fakes.face_search.cache.stats() if fakes.face_search.cache else None
+        ),
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--gallery-size", type=int, default=10000)
+    parser.add_argument("--faces-per-frame", type=int, default=2)
+    parser.add_argument("--known-ratio", type=float, default=0.5)
+    parser.add_argument("--inference-ms", type=float, default=5.0)
+    parser.add_argument("--video-frames", type=int, default=300)
+    parser.add_argument("--bulk-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
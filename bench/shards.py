@@ -0,0 +1,79 @@
+"""Benchmark: QPS of the sharded gallery against single-process exact search.
+
+Uses the synthetic gallery of bench.ann_recall. For every shard count the
+top-k ids are compared with GalleryIndex ("match" should be 1.000, both
+are exact), then one shard is added and the fraction of rows it took over
+is reported ("moved", ideally 1 / (shards + 1)) with the results checked
+again. Throughput only grows with shards up to the number of cores.
+
+    python -m bench.shards --size 1000000 --shards 1,2,4,8 --queries 2000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from bench.ann_recall import NOISE, synthetic_gallery
+from gallery import EMBEDDING_DIM, GalleryIndex
+from shards import ShardedIndex
+
+
+def measure(index, queries, batch_size, k):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(queries), batch_size):
+        results.extend(index.search_batch(queries[i : i + batch_size], k=k))
+    elapsed = time.perf_counter() - start
+    return [[face_id for _, face_id, _ in matches] for matches in results], len(
+        queries
+    ) / elapsed
+
+
+def agreement(actual, expected):
+    return np.mean([a == e for a, e in zip(actual, expected)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers, embeddings = synthetic_gallery(args.size, EMBEDDING_DIM, rng)
+    ids = np.arange(args.size)
+    names = ids.astype(str)
+    queries = centers[rng.integers(0, len(centers), args.queries)]
+    queries = queries + NOISE * rng.standard_normal(queries.shape, np.float32)
+
+    exact = GalleryIndex()
+    exact.load_arrays(ids, names, embeddings)
+    expected, exact_qps = measure(exact, queries, args.batch_size, args.k)
+    del exact
+    print(f"exact: {exact_qps:.0f} qps over {args.size} faces")
+    print(
+        f"{'shards':>6} {'load s':>7} {'qps':>8} {'speedup':>8} {'match':>6} "
+        f"{'moved':>6} {'match':>6}"
+    )
+    for shards in map(int, args.shards.split(",")):
+        start = time.perf_counter()
+        index = ShardedIndex(shards)
+        index.load_arrays(ids, names, embeddings)
+        load = time.perf_counter() - start
+        actual, qps = measure(index, queries, args.batch_size, args.k)
+        moved = index.add_shard() / args.size
+        rebalanced, _ = measure(index, queries, args.batch_size, args.k)
+        index.close()
+        print(
+            f"{shards:>6} {load:>7.1f} {qps:>8.0f} {qps / exact_qps:>8.2f} "
+            f"{agreement(actual, expected):>6.3f} {moved:>6.3f} "
+            f"{agreement(rebalanced, expected):>6.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
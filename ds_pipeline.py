@@ -8,25 +8,79 @@ import sys
 import time
 import argparse
 import platform
+import threading
 from ctypes import *
 
-from utils import is_aarch64, get_bbox, draw_bbox
-from search import Base, Face, PGVectorFaceSearch
+from utils import is_aarch64, get_bbox, embedding_from_buffer
+from gallery import EMBEDDING_DIM
+from inference import (
+    ENGINE_MAX_BATCH_SIZE,
+    IMAGE_BATCH_SIZE,
+    IMAGE_BATCH_WINDOW_MS,
+    IMAGE_FRAME_DURATION,
+    KEYFRAME_OUTPUT_FPS,
+    VIDEO_DEFAULT_FPS,
+    AdaptiveInterval,
+    FrameSampler,
+    ImageBatchScheduler,
+    InferenceBackend,
+    StreamOutputs,
+    frame_records,
+    image_postprocessor,
+    match_batch_faces,
+    observe_frames,
+    observe_probe,
+    to_bgr,
+    video_postprocessor,
+)
+from metrics import (
+    EMBEDDING_EXTRACTION_SECONDS,
+    FIRST_BUFFER_SECONDS,
+    FRAMES_DROPPED,
+    PIPELINE_BUILD_SECONDS,
+)
 
 sys.path.append("/opt/nvidia/deepstream/deepstream/lib")
 import pyds
 import numpy as np
 import cv2
-from sklearn.preprocessing import normalize
 
 CONFIG_PGIE_INFER = "engine/primary/retinaface.txt"
 CONFIG_SGIE_INFER = "engine/secondary/webface.txt"
+TRACKER_LL_LIB = "/opt/nvidia/deepstream/deepstream/lib/libnvds_nvmultiobjecttracker.so"
+TRACKER_LL_CONFIG = (
+    "/opt/nvidia/deepstream/deepstream/samples/configs/deepstream-app/"
+    "config_tracker_IOU.yml"
+)
 STREAMMUX_BATCH_SIZE = 1
 STREAMMUX_WIDTH = 1920
 STREAMMUX_HEIGHT = 1080
 GPU_ID = 0
-THRESHOLD = 0.7
-face_search = PGVectorFaceSearch(threshold=THRESHOLD)
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+class VideoSource(FrameSampler):
+    """Streammux link of one uridecodebin, the frame rate reported by its
+    decoder and the sampling applied before streammux"""
+
+    def __init__(self, sinkpad, target_fps=None, keyframes_only=False):
+        super().__init__(target_fps, second=Gst.SECOND)
+        self.sinkpad = sinkpad
+        self.keyframes_only = keyframes_only
+        self.fps = None
+
+    def keep(self, pts):
+        """Whether the buffer at `pts` is due for the target frame rate"""
+        if pts == Gst.CLOCK_TIME_NONE:
+            return True
+        return super().keep(pts)
+
+
+def sample_probe(pad, info, source):
+    if source.keep(info.get_buffer().pts):
+        return Gst.PadProbeReturn.OK
+    FRAMES_DROPPED.labels("sampling").inc()
+    return Gst.PadProbeReturn.DROP
 
 
 def decodebin_child_added(child_proxy, Object, name, user_data):
@@ -35,6 +89,9 @@ def decodebin_child_added(child_proxy, Object, name, user_data):
     if name.find("nvv4l2decoder") != -1:
         Object.set_property("drop-frame-interval", 0)
         Object.set_property("num-extra-surfaces", 1)
+        if user_data is not None and user_data.keyframes_only:
+            # Only I-frames are decoded; the others never leave the decoder
+            Object.set_property("skip-frames", 2)
         if is_aarch64():
             Object.set_property("enable-max-performance", 1)
         else:
@@ -43,7 +100,7 @@ def decodebin_child_added(child_proxy, Object, name, user_data):
 
 
 def cb_newpad(decodebin, pad, user_data):
-    streammux_sink_pad = user_data
+    source = user_data
     caps = pad.get_current_caps()
     if not caps:
         caps = pad.query_caps()
@@ -52,13 +109,22 @@ def cb_newpad(decodebin, pad, user_data):
     features = caps.get_features(0)
     if name.find("video") != -1:
         if features.contains("memory:NVMM"):
-            if pad.link(streammux_sink_pad) != Gst.PadLinkReturn.OK:
+            parsed, num, den = structure.get_fraction("framerate")
+            if parsed and num > 0 and den > 0:
+                source.fps = num / den
+            if source.target_fps:
+                pad.add_probe(Gst.PadProbeType.BUFFER, sample_probe, source)
+            if pad.link(source.sinkpad) != Gst.PadLinkReturn.OK:
                 sys.stderr.write("ERROR: Failed to link source to streammux sink pad\n")
         else:
             sys.stderr.write("ERROR: decodebin did not pick NVIDIA decoder plugin")
 
 
-def create_uridecode_bin(stream_id, uri, streammux):
+def create_uridecode_bin(
+    stream_id, uri, streammux, target_fps=None, keyframes_only=False
+):
+    """uridecodebin feeding streammux sink_<stream_id>; returns the bin and
+    its VideoSource"""
     bin_name = "source-bin-%04d" % stream_id
     bin = Gst.ElementFactory.make("uridecodebin", bin_name)
     if "rtsp://" in uri:
@@ -66,160 +132,136 @@ def create_uridecode_bin(stream_id, uri, streammux):
     bin.set_property("uri", uri)
     pad_name = "sink_%u" % stream_id
     streammux_sink_pad = streammux.get_request_pad(pad_name)
-    bin.connect("pad-added", cb_newpad, streammux_sink_pad)
-    bin.connect("child-added", decodebin_child_added, 0)
-    return bin
+    source = VideoSource(streammux_sink_pad, target_fps, keyframes_only)
+    bin.connect("pad-added", cb_newpad, source)
+    bin.connect("child-added", decodebin_child_added, source)
+    return bin, source
 
 
-def img_probe(pad, info, user_data):
-    buf = info.get_buffer()
-    batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
-    # print('let go ')
-    l_frame = batch_meta.frame_meta_list
-    while l_frame:
+def collect_frame_faces(frame_meta):
+    """(bbox, normalized embedding, object_id) of every face in a frame"""
+    faces = []
+    l_obj = frame_meta.obj_meta_list
+    while l_obj:
         try:
-            frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
+            obj_meta = pyds.NvDsObjectMeta.cast(l_obj.data)
         except StopIteration:
             break
-        frame_index = frame_meta.batch_id
-
-        n_frame = pyds.get_nvds_buf_surface(hash(buf), frame_index)
-        frame_copy = np.array(n_frame, copy=True, dtype=np.uint8)
-        frame_bgr = cv2.cvtColor(frame_copy, cv2.COLOR_RGBA2BGR)
-        user_data.append({"image": frame_bgr})
-        current_index = frame_meta.source_id
-        l_obj = frame_meta.obj_meta_list
-        while l_obj:
-            try:
-                obj_meta = pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            unique_component_id = obj_meta.unique_component_id
-            user_meta = obj_meta.obj_user_meta_list
-
-            user_meta = obj_meta.obj_user_meta_list
-            landmarks_list = []
-            x1, y1, x2, y2 = get_bbox(obj_meta.rect_params)
-            user_data.append({})
-            user_data[-1]["bbox"] = [x1, y1, x2, y2]
-            user_data[-1]["img"] = frame_bgr
-            while user_meta:
-                user_meta_data = pyds.NvDsUserMeta.cast(user_meta.data)
-                if (
-                    user_meta_data.base_meta.meta_type
-                    == pyds.NVDSINFER_TENSOR_OUTPUT_META
-                ):
-                    tensor_meta = pyds.NvDsInferTensorMeta.cast(
-                        user_meta_data.user_meta_data
-                    )
-                    layer = pyds.get_nvds_LayerInfo(tensor_meta, 0)
-                    layer_name = layer.layerName
-                    dims = layer.dims
-                    shape = [dims.d[i] for i in range(dims.numDims)]
-                    emb = np.array(
-                        [pyds.get_detections(layer.buffer, i) for i in range(512)]
-                    )
-                    emb = normalize(emb.reshape(1, -1)).flatten()
-                    user_data[-1]["embedding"] = emb
-                    match_distance, UserId, UserName = face_search.compare_face(emb)
-                    if match_distance is not None and match_distance <= THRESHOLD:
-                        label = f"{UserName} ({match_distance:.2f})"
-                        user_data[-1]["existed"] = True
-                        user_data[-1]["UserName"] = UserName
-                        user_data[-1]["match_distance"] = match_distance
-                    else:
-                        label = "Not recognized"
-                        user_data[-1]["existed"] = False
-                    user_data[-1]["label"] = label
-                    # draw_bbox(frame_bgr,[x1, y1, x2, y2], label = label)
-
-                try:
-                    user_meta = user_meta.next
-                except StopIteration:
-                    break
+        bbox = get_bbox(obj_meta.rect_params)
+        user_meta = obj_meta.obj_user_meta_list
+        while user_meta:
+            user_meta_data = pyds.NvDsUserMeta.cast(user_meta.data)
+            if user_meta_data.base_meta.meta_type == pyds.NVDSINFER_TENSOR_OUTPUT_META:
+                tensor_meta = pyds.NvDsInferTensorMeta.cast(
+                    user_meta_data.user_meta_data
+                )
+                layer = pyds.get_nvds_LayerInfo(tensor_meta, 0)
+                emb = embedding_from_buffer(pyds.get_ptr(layer.buffer), EMBEDDING_DIM)
+                faces.append((bbox, emb, obj_meta.object_id))
             try:
-                l_obj = l_obj.next
+                user_meta = user_meta.next
             except StopIteration:
                 break
         try:
-            l_frame = l_frame.next
+            l_obj = l_obj.next
         except StopIteration:
             break
-    return Gst.PadProbeReturn.OK
+    return faces
 
 
-def video_probe(pad, info, video_writer):
-    buf = info.get_buffer()
+def collect_batch_frames(buf, copy_frames=True):
+    """Host RGBA copy (None unless `copy_frames`) and detected faces for
+    every frame of a batched buffer; the colour conversion is left to the
+    post-processing workers"""
     batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
-    # print('let go ')
+    frames = []
     l_frame = batch_meta.frame_meta_list
     while l_frame:
         try:
             frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
         except StopIteration:
             break
-        frame_index = frame_meta.batch_id
-        n_frame = pyds.get_nvds_buf_surface(hash(buf), frame_index)
-        frame_copy = np.array(n_frame, copy=True, dtype=np.uint8)
-        frame_bgr = cv2.cvtColor(frame_copy, cv2.COLOR_RGBA2BGR)
-
-        current_index = frame_meta.source_id
-        l_obj = frame_meta.obj_meta_list
-        while l_obj:
-            try:
-                obj_meta = pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            unique_component_id = obj_meta.unique_component_id
-            user_meta = obj_meta.obj_user_meta_list
-
-            user_meta = obj_meta.obj_user_meta_list
-            landmarks_list = []
-            x1, y1, x2, y2 = get_bbox(obj_meta.rect_params)
-            while user_meta:
-                user_meta_data = pyds.NvDsUserMeta.cast(user_meta.data)
-                if (
-                    user_meta_data.base_meta.meta_type
-                    == pyds.NVDSINFER_TENSOR_OUTPUT_META
-                ):
-                    tensor_meta = pyds.NvDsInferTensorMeta.cast(
-                        user_meta_data.user_meta_data
-                    )
-                    layer = pyds.get_nvds_LayerInfo(tensor_meta, 0)
-                    layer_name = layer.layerName
-                    dims = layer.dims
-                    shape = [dims.d[i] for i in range(dims.numDims)]
-                    emb = np.array(
-                        [pyds.get_detections(layer.buffer, i) for i in range(512)]
-                    )
-                    emb = normalize(emb.reshape(1, -1)).flatten()
-                    match_distance, UserId, UserName = face_search.compare_face(emb)
-                    if match_distance is not None and match_distance <= THRESHOLD:
-                        label = f"{UserName} ({match_distance:.2f})"
-                    else:
-                        label = "Not recognized"
-                    draw_bbox(frame_bgr, [x1, y1, x2, y2], label=label)
-                try:
-                    user_meta = user_meta.next
-                except StopIteration:
-                    break
-            try:
-                l_obj = l_obj.next
-            except StopIteration:
-                break
-
-        video_writer.write(frame_bgr)
+        frame = None
+        if copy_frames:
+            # The surface is reused once the probe returns: copy it now
+            n_frame = pyds.get_nvds_buf_surface(hash(buf), frame_meta.batch_id)
+            frame = np.array(n_frame, copy=True, dtype=np.uint8)
+        start = time.perf_counter()
+        faces = collect_frame_faces(frame_meta)
+        EMBEDDING_EXTRACTION_SECONDS.observe(time.perf_counter() - start)
+        frames.append((frame_meta, frame, faces))
         try:
             l_frame = l_frame.next
         except StopIteration:
             break
+    return frames
+
+
+def img_probe(pad, info, user_data):
+    started = time.perf_counter()
+    frames = collect_batch_frames(info.get_buffer())
+    faces = [frame_faces for _, _, frame_faces in frames]
+    matches = match_batch_faces(faces)
+    recognized = 0
+    for frame_meta, frame, frame_faces in frames:
+        records = frame_records(to_bgr(frame), frame_faces, matches)
+        recognized += sum(record["existed"] for record in records[1:])
+        user_data.extend(records)
+    observe_probe("image", frames, started)
+    observe_frames("image", faces, recognized, started)
+    return Gst.PadProbeReturn.OK
+
+
+def image_request_probe(pad, info, user_data):
+    """Capture the frames of a batch and hand them to the image
+    post-processor, which matches and resolves them"""
+    requests, post = user_data
+    started = time.perf_counter()
+    if requests.started_at is not None:
+        FIRST_BUFFER_SECONDS.labels("image").observe(started - requests.started_at)
+        requests.started_at = None
+    frames = collect_batch_frames(info.get_buffer())
+    post.submit(
+        [(meta.buf_pts, frame, faces) for meta, frame, faces in frames],
+        frames=len(frames),
+    )
+    observe_probe("image", frames, started)
+    return Gst.PadProbeReturn.OK
+
+
+def video_probe(pad, info, user_data):
+    """Capture the frames of a batch and hand them to the video
+    post-processor; frame_meta is only valid inside the probe, so plain
+    values are passed on"""
+    outputs, post = user_data
+    started = time.perf_counter()
+    if outputs.started_at is not None:
+        FIRST_BUFFER_SECONDS.labels("video").observe(started - outputs.started_at)
+        outputs.started_at = None
+    frames = collect_batch_frames(info.get_buffer(), copy_frames=outputs.writes_video)
+    if outputs.interval is not None:
+        outputs.interval.update(len(frames), any(faces for _, _, faces in frames))
+    post.submit(
+        [
+            (
+                meta.source_id,
+                meta.frame_num,
+                meta.buf_pts / Gst.SECOND,
+                frame,
+                faces,
+            )
+            for meta, frame, faces in frames
+        ],
+        frames=len(frames),
+    )
+    observe_probe("video", frames, started)
     return Gst.PadProbeReturn.OK
 
 
 Gst.init(None)
 
 
-class DeepStreamInference:
+class DeepStreamInference(InferenceBackend):
     def __init__(
         self,
         config_pgie=CONFIG_PGIE_INFER,
@@ -227,7 +269,11 @@ class DeepStreamInference:
         gpu_id=GPU_ID,
         streammux_width=STREAMMUX_WIDTH,
         streammux_height=STREAMMUX_HEIGHT,
+        tracker=None,
     ):
+        """`tracker` is None (match every face), "nvtracker" (track in the
+        pipeline) or "iou" (track in Python from the probe)"""
+        super().__init__(tracker)
         self.config_pgie = config_pgie
         self.config_sgie = config_sgie
         self.gpu_id = gpu_id
@@ -236,11 +282,31 @@ class DeepStreamInference:
 
         self.pipeline = None
         self.loop = None
-        self.video_writer = None
-        self.video_fps = 30
+        self.bus_error = None
+        self.pgie = None
+        self.video_outputs = None
+        self.video_post = None
+        self.video_fps = VIDEO_DEFAULT_FPS
         self.video_size = (self.streammux_width, self.streammux_height)
         self.embedding_holder = []
 
+        self.streammux = None
+        self.max_sources = 1
+        self.source_bins = {}
+        self.video_sources = {}
+        self.source_lock = threading.Lock()
+        self.remove_finished_sources = False
+        self.target_fps = None
+        self.keyframes_only = False
+
+        self.image_pipeline = None
+        self.image_sources = []
+        self.raw_image_sources = []
+        self.image_scheduler = None
+        self.image_post = None
+        self.image_loop = None
+        self.image_thread = None
+
     def _make_element(self, factory, name):
         elem = Gst.ElementFactory.make(factory, name)
         if not elem:
@@ -260,7 +326,15 @@ class DeepStreamInference:
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             sys.stderr.write(f"Error: {err}, Debug: {debug}\n")
+            # Raised by _run_video_pipeline once the pipeline is torn down
+            self.bus_error = f"{message.src.get_name()}: {err.message}"
             loop.quit()
+        elif t == Gst.MessageType.ELEMENT:
+            struct = message.get_structure()
+            if struct is not None and struct.has_name("stream-eos"):
+                parsed, stream_id = struct.get_uint("stream-id")
+                if parsed and self.remove_finished_sources:
+                    self.remove_source(stream_id)
         return True
 
     def _add_probe(self, elem, probe_func, infer_type):
@@ -274,47 +348,45 @@ class DeepStreamInference:
                 Gst.PadProbeType.BUFFER, probe_func, self.embedding_holder
             )
         elif infer_type == "video":
-            if self.video_writer is None:
-                # fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-                fourcc = cv2.VideoWriter_fourcc(*"avc1")
-                self.video_writer = cv2.VideoWriter(
-                    self.output_path, fourcc, self.video_fps, self.video_size
-                )
-            src_pad.add_probe(Gst.PadProbeType.BUFFER, probe_func, self.video_writer)
+            src_pad.add_probe(
+                Gst.PadProbeType.BUFFER,
+                probe_func,
+                (self.video_outputs, self.video_post),
+            )
 
-    def _create_streammux(self, batch_size=1, live_source=0):
+    def _create_streammux(self, batch_size=1, live_source=0, push_timeout=25000):
         streammux = self._make_element("nvstreammux", "stream-muxer")
         streammux.set_property("batch-size", batch_size)
         streammux.set_property("gpu_id", self.gpu_id)
         streammux.set_property("width", self.streammux_width)
         streammux.set_property("height", self.streammux_height)
-        streammux.set_property("batched-push-timeout", 25000)
+        streammux.set_property("batched-push-timeout", push_timeout)
         streammux.set_property("live-source", live_source)
         streammux.set_property("enable-padding", 1)
         streammux.set_property("attach-sys-ts", 1)
         return streammux
 
-    def run_video(self, uri, output_path):
-        self.output_path = output_path
-        """Run inference on video / RTSP stream"""
+    def _build_video_pipeline(self, batch_size=1, live_source=0):
+        """streammux -> pgie -> sgie -> RGBA conversion -> fakesink; sources
+        are linked to the returned streammux by the caller"""
         self.pipeline = Gst.Pipeline()
 
         streammux = self._create_streammux(
-            batch_size=1, live_source=0 if "file://" in uri else 1
+            batch_size=batch_size, live_source=live_source
         )
-        source_bin = create_uridecode_bin(0, uri, streammux)
 
         pgie = self._make_element("nvinfer", "pgie")
         sgie = self._make_element("nvinfer", "sgie")
         converter = self._make_element("nvvideoconvert", "nvvideoconvert")
         capsfilter = Gst.ElementFactory.make("capsfilter", "capsfilter")
-        caps = Gst.Caps.from_string(f"video/x-raw(memory:NVMM), format=RGBA")
+        caps = Gst.Caps.from_string("video/x-raw(memory:NVMM), format=RGBA")
         capsfilter.set_property("caps", caps)
 
         # osd = self._make_element("nvdsosd", "nvdsosd")
         sink = self._make_element("fakesink", "fakesink")
 
         pgie.set_property("config-file-path", self.config_pgie)
+        pgie.set_property("batch-size", min(batch_size, ENGINE_MAX_BATCH_SIZE))
         pgie.set_property("qos", 0)
         sgie.set_property("config-file-path", self.config_sgie)
         sgie.set_property("qos", 0)
@@ -327,51 +399,214 @@ class DeepStreamInference:
         sink.set_property("async", 0)
         sink.set_property("sync", 0)
         sink.set_property("qos", 0)
-        self.pipeline.add(
-            source_bin, streammux, pgie, sgie, converter, capsfilter, sink
-        )
+        self.pipeline.add(streammux, pgie, sgie, converter, capsfilter, sink)
         streammux.link(pgie)
-        pgie.link(sgie)
+        if self.tracker == "nvtracker":
+            tracker = self._make_element("nvtracker", "tracker")
+            tracker.set_property("ll-lib-file", TRACKER_LL_LIB)
+            tracker.set_property("ll-config-file", TRACKER_LL_CONFIG)
+            tracker.set_property("tracker-width", 640)
+            tracker.set_property("tracker-height", 384)
+            tracker.set_property("gpu_id", self.gpu_id)
+            self.pipeline.add(tracker)
+            pgie.link(tracker)
+            tracker.link(sgie)
+        else:
+            pgie.link(sgie)
         sgie.link(converter)
         # converter.link(osd)
         converter.link(capsfilter)
         capsfilter.link(sink)
         # osd.link(sink)
-
-        self._add_probe(capsfilter, video_probe, "video")
-
-        self.loop = GLib.MainLoop()
+        self.streammux = streammux
+        self.pgie = pgie
+        return capsfilter
+
+    def _output_fps(self, source_id):
+        """Frame rate of the annotated video of a source: the sampled rate
+        when sampling, else the rate reported by its decoder"""
+        source = self.video_sources.get(source_id)
+        if source is None:
+            return self.video_fps
+        if source.keyframes_only:
+            return source.target_fps or KEYFRAME_OUTPUT_FPS
+        if source.target_fps and source.fps:
+            return min(source.target_fps, source.fps)
+        return source.target_fps or source.fps or self.video_fps
+
+    def _run_video_pipeline(self):
+        # A private main context per run lets several DeepStreamInference
+        # instances run videos concurrently from worker threads.
+        context = GLib.MainContext.new()
+        context.push_thread_default()
+        self.loop = GLib.MainLoop.new(context, False)
         bus = self.pipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message", self._bus_call, self.loop)
+        self.bus_error = None
 
+        if self.video_outputs is not None:
+            self.video_outputs.started_at = time.perf_counter()
         self.pipeline.set_state(Gst.State.PLAYING)
         try:
             self.loop.run()
         except:
             pass
         self.pipeline.set_state(Gst.State.NULL)
-        if self.video_writer is not None:
-            self.video_writer.release()
-            self.video_writer = None
+        bus.remove_signal_watch()
+        context.pop_thread_default()
+        if self.video_post is not None:
+            # Frames still queued are written before the outputs close
+            self.video_post.close()
+            self.video_post = None
+        if self.video_outputs is not None:
+            self.video_outputs.release()
+            self.video_outputs = None
+        self.source_bins = {}
+        self.video_sources = {}
+        if self.bus_error is not None:
+            raise RuntimeError(f"Video pipeline failed: {self.bus_error}")
+
+    def run_video(
+        self,
+        uri,
+        output_path=None,
+        on_result=None,
+        target_fps=None,
+        keyframes_only=False,
+        adaptive_interval=False,
+        output_format="mp4",
+    ):
+        """Run inference on video / RTSP stream.
+
+        Writes the annotated video to `output_path` and/or passes per-frame
+        detection records to `on_result`; with no `output_path` the frame
+        copy, drawing and encoding are skipped entirely.
+
+        `target_fps` drops decoded frames before streammux down to that rate,
+        `keyframes_only` makes the decoder skip everything but I-frames, and
+        `adaptive_interval` raises the detector interval on footage without
+        faces. Record timestamps are the source PTS in every mode.
+        `output_format` picks the writer: "mp4", or "fmp4" / "hls" to make
+        the output playable while it is being written (see video_output).
+        """
+        self.output_path = output_path
+        live_source = 0 if "file://" in uri else 1
+        start = time.perf_counter()
+        capsfilter = self._build_video_pipeline(batch_size=1, live_source=live_source)
+        self.max_sources = 1
+        self.remove_finished_sources = False
+        self.target_fps = target_fps
+        self.keyframes_only = keyframes_only
+        self.add_source(uri)
+        PIPELINE_BUILD_SECONDS.labels("video").observe(time.perf_counter() - start)
+
+        self.video_outputs = StreamOutputs(
+            (lambda source_id: output_path) if output_path else None,
+            self._output_fps,
+            self.video_size,
+            on_result=on_result,
+            recognizer=self._make_recognizer(),
+            interval=AdaptiveInterval(self.pgie) if adaptive_interval else None,
+            output_format=output_format,
+        )
+        self.video_post = video_postprocessor(self.video_outputs, live=live_source)
+        self._add_probe(capsfilter, video_probe, "video")
+        self._run_video_pipeline()
         return
 
-    def run_image(self, image_path):
-        """Run inference on single image"""
-        if not os.path.isfile(image_path):
-            sys.stderr.write(f"ERROR: Image file not found: {image_path}\n")
-            return []
+    def run_streams(self, uris, output_dir=None, max_sources=None, on_result=None):
+        """Run inference on several videos / RTSP streams in one batch.
+
+        Every source gets its own streammux pad; frames are routed by
+        frame_meta.source_id to `output_dir/stream_<source_id>.mp4` (unless
+        `output_dir` is None) and to `on_result(record)`. Up to `max_sources`
+        (default: len(uris)) sources can be attached, so capacity can be
+        reserved for add_source/remove_source calls while running.
+        """
+        batch_size = max_sources or len(uris)
+        live_source = int(any(not uri.startswith("file://") for uri in uris))
+        start = time.perf_counter()
+        capsfilter = self._build_video_pipeline(batch_size, live_source)
+        self.max_sources = batch_size
+        self.remove_finished_sources = True
+        self.target_fps = None
+        self.keyframes_only = False
+        for uri in uris:
+            self.add_source(uri)
+        PIPELINE_BUILD_SECONDS.labels("video").observe(time.perf_counter() - start)
+
+        path_for_source = None
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            path_for_source = lambda source_id: os.path.join(
+                output_dir, f"stream_{source_id}.mp4"
+            )
+        self.video_outputs = StreamOutputs(
+            path_for_source,
+            self._output_fps,
+            self.video_size,
+            on_result=on_result,
+            recognizer=self._make_recognizer(),
+        )
+        self.video_post = video_postprocessor(self.video_outputs, live=live_source)
+        self._add_probe(capsfilter, video_probe, "video")
+        self._run_video_pipeline()
+
+    def add_source(self, uri):
+        """Attach a source to the running video pipeline; returns its id"""
+        with self.source_lock:
+            free = [i for i in range(self.max_sources) if i not in self.source_bins]
+            if not free:
+                raise RuntimeError(f"All {self.max_sources} stream slots are in use")
+            source_id = free[0]
+            source_bin, source = create_uridecode_bin(
+                source_id, uri, self.streammux, self.target_fps, self.keyframes_only
+            )
+            self.source_bins[source_id] = source_bin
+            self.video_sources[source_id] = source
+            self.pipeline.add(source_bin)
+            source_bin.sync_state_with_parent()
+        return source_id
+
+    def remove_source(self, source_id):
+        """Detach a source and close its output; returns False if unknown"""
+        with self.source_lock:
+            source_bin = self.source_bins.pop(source_id, None)
+            if source_bin is None:
+                return False
+            source_bin.set_state(Gst.State.NULL)
+            sinkpad = self.streammux.get_static_pad(f"sink_{source_id}")
+            if sinkpad is not None:
+                sinkpad.send_event(Gst.Event.new_flush_stop(False))
+                self.streammux.release_request_pad(sinkpad)
+            self.pipeline.remove(source_bin)
+        if self.video_post is not None:
+            # Let its queued frames reach the writer before closing it
+            self.video_post.flush()
+        if self.video_outputs is not None:
+            self.video_outputs.close(source_id)
+        return True
 
-        self.pipeline = Gst.Pipeline()
+    def stop_streams(self):
+        """Finish a run_streams call, flushing every open output"""
+        if self.pipeline is not None:
+            self.pipeline.send_event(Gst.Event.new_eos())
 
-        filesrc = self._make_element("filesrc", "file-source")
-        jpegparser = self._make_element("jpegparse", "jpeg-parser")
-        decoder = self._make_element("nvv4l2decoder", "nvv4l2-decoder")
-        nvvideoconvert_1 = self._make_element("nvvideoconvert", "convertor_1")
-        capsfilter_1 = self._make_element("capsfilter", "capsfilter_1")
+    def _build_image_pipeline(self, sources, raw_sources=(), push_timeout=25000):
+        """Decode JPEG buffers from each source into one streammux batch and
+        run both nvinfer stages on it; source i feeds streammux sink_i.
 
-        streammux = self._create_streammux(batch_size=1, live_source=1)
+        `raw_sources` push already-decoded RGBA frames and feed the pads
+        after the JPEG ones, sharing the same batch.
+        """
+        pipeline = Gst.Pipeline()
+        batch_size = len(sources)
+        caps = Gst.Caps.from_string("video/x-raw(memory:NVMM), format=RGBA")
 
+        streammux = self._create_streammux(
+            batch_size=batch_size, live_source=1, push_timeout=push_timeout
+        )
         pgie = self._make_element("nvinfer", "pgie")
         nvvideoconvert_2 = self._make_element("nvvideoconvert", "convertor_2")
         capsfilter_2 = self._make_element("capsfilter", "capsfilter_2")
@@ -379,43 +614,77 @@ class DeepStreamInference:
         sink = self._make_element("fakesink", "fakesink")
 
         # Set props
-        filesrc.set_property("location", image_path)
         pgie.set_property("config-file-path", self.config_pgie)
+        pgie.set_property("batch-size", batch_size)
         sgie.set_property("config-file-path", self.config_sgie)
-
-        caps = Gst.Caps.from_string("video/x-raw(memory:NVMM), format=RGBA")
-        capsfilter_1.set_property("caps", caps)
+        sink.set_property("sync", 0)
         capsfilter_2.set_property("caps", caps)
-
-        self._set_gpu_mem(nvvideoconvert_1)
         self._set_gpu_mem(nvvideoconvert_2)
 
         # Add and link
-        for elem in [
-            filesrc,
-            jpegparser,
-            decoder,
-            nvvideoconvert_1,
-            capsfilter_1,
-            streammux,
-            pgie,
-            nvvideoconvert_2,
-            capsfilter_2,
-            sgie,
-            sink,
-        ]:
-            self.pipeline.add(elem)
-
-        filesrc.link(jpegparser)
-        jpegparser.link(decoder)
-        decoder.link(nvvideoconvert_1)
-        nvvideoconvert_1.link(capsfilter_1)
-        capsfilter_1.get_static_pad("src").link(streammux.get_request_pad("sink_0"))
+        for elem in [streammux, pgie, nvvideoconvert_2, capsfilter_2, sgie, sink]:
+            pipeline.add(elem)
+
+        for slot, source in enumerate(sources):
+            jpegparser = self._make_element("jpegparse", f"jpeg-parser-{slot}")
+            decoder = self._make_element("nvv4l2decoder", f"nvv4l2-decoder-{slot}")
+            nvvideoconvert_1 = self._make_element(
+                "nvvideoconvert", f"convertor_1-{slot}"
+            )
+            capsfilter_1 = self._make_element("capsfilter", f"capsfilter_1-{slot}")
+            capsfilter_1.set_property("caps", caps)
+            self._set_gpu_mem(nvvideoconvert_1)
+
+            for elem in [source, jpegparser, decoder, nvvideoconvert_1, capsfilter_1]:
+                pipeline.add(elem)
+            source.link(jpegparser)
+            jpegparser.link(decoder)
+            decoder.link(nvvideoconvert_1)
+            nvvideoconvert_1.link(capsfilter_1)
+            capsfilter_1.get_static_pad("src").link(
+                streammux.get_request_pad(f"sink_{slot}")
+            )
+
+        for slot, source in enumerate(raw_sources):
+            nvvideoconvert_1 = self._make_element(
+                "nvvideoconvert", f"raw-convertor-{slot}"
+            )
+            capsfilter_1 = self._make_element("capsfilter", f"raw-capsfilter-{slot}")
+            capsfilter_1.set_property("caps", caps)
+            self._set_gpu_mem(nvvideoconvert_1)
+
+            for elem in [source, nvvideoconvert_1, capsfilter_1]:
+                pipeline.add(elem)
+            source.link(nvvideoconvert_1)
+            nvvideoconvert_1.link(capsfilter_1)
+            capsfilter_1.get_static_pad("src").link(
+                streammux.get_request_pad(f"sink_{len(sources) + slot}")
+            )
+
         streammux.link(pgie)
         pgie.link(nvvideoconvert_2)
         nvvideoconvert_2.link(capsfilter_2)
         capsfilter_2.link(sgie)
         sgie.link(sink)
+        return pipeline, sgie
+
+    def run_image(self, image_path):
+        """Run inference on single image"""
+        if not os.path.isfile(image_path):
+            sys.stderr.write(f"ERROR: Image file not found: {image_path}\n")
+            return []
+
+        if self.image_pipeline is not None:
+            with open(image_path, "rb") as f:
+                return self.infer_image(f.read())
+
+        start = time.perf_counter()
+        filesrc = self._make_element("filesrc", "file-source")
+        filesrc.set_property("location", image_path)
+        self.pipeline, sgie = self._build_image_pipeline([filesrc])
+        PIPELINE_BUILD_SECONDS.labels("image_oneshot").observe(
+            time.perf_counter() - start
+        )
 
         self._add_probe(sgie, img_probe, "image")
 
@@ -432,3 +701,153 @@ class DeepStreamInference:
         self.pipeline.set_state(Gst.State.NULL)
         image_cv = self.embedding_holder.pop(0)["image"]
         return image_cv, self.embedding_holder
+
+    def start_image_pipeline(
+        self,
+        batch_size=IMAGE_BATCH_SIZE,
+        batch_window_ms=IMAGE_BATCH_WINDOW_MS,
+        warmup=True,
+    ):
+        """Keep an image pipeline PLAYING so engines load once per process.
+
+        Concurrent requests are grouped by an ImageBatchScheduler and pushed
+        through `batch_size` appsrc slots so they share one streammux batch.
+        Every slot has a JPEG appsrc (decoded on the GPU) and a raw RGBA
+        appsrc for images that had to be decoded on the host.
+        """
+        if self.image_pipeline is not None:
+            return
+        start = time.perf_counter()
+        self.image_sources = []
+        self.raw_image_sources = []
+        for slot in range(batch_size):
+            appsrc = self._make_element("appsrc", f"image-source-{slot}")
+            appsrc.set_property("caps", Gst.Caps.from_string("image/jpeg"))
+            appsrc.set_property("format", Gst.Format.TIME)
+            appsrc.set_property("is-live", True)
+            self.image_sources.append(appsrc)
+
+            appsrc = self._make_element("appsrc", f"raw-image-source-{slot}")
+            appsrc.set_property("format", Gst.Format.TIME)
+            appsrc.set_property("is-live", True)
+            self.raw_image_sources.append(appsrc)
+        self.image_pipeline, sgie = self._build_image_pipeline(
+            self.image_sources,
+            self.raw_image_sources,
+            push_timeout=int(batch_window_ms * 1000),
+        )
+        self.image_post = image_postprocessor(self.image_requests)
+        sgie.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER,
+            image_request_probe,
+            (self.image_requests, self.image_post),
+        )
+        PIPELINE_BUILD_SECONDS.labels("image").observe(time.perf_counter() - start)
+
+        # The bus is watched from a dedicated context so this pipeline never
+        # competes with run_video's loop on the default main context.
+        self.image_loop = GLib.MainLoop.new(GLib.MainContext.new(), False)
+        ready = threading.Event()
+        self.image_thread = threading.Thread(
+            target=self._run_image_loop, args=(ready,), daemon=True
+        )
+        self.image_thread.start()
+        ready.wait()
+
+        self.image_requests.started_at = time.perf_counter()
+        self.image_pipeline.set_state(Gst.State.PLAYING)
+        self.image_scheduler = ImageBatchScheduler(
+            self._push_batch, batch_size=batch_size, window_ms=batch_window_ms
+        )
+        if warmup:
+            blank = np.zeros((self.streammux_height, self.streammux_width, 3), np.uint8)
+            _, jpeg = cv2.imencode(".jpg", blank)
+            self.infer_image(jpeg.tobytes())
+
+    def stop_image_pipeline(self):
+        if self.image_pipeline is None:
+            return
+        self.image_scheduler.close()
+        self.image_pipeline.set_state(Gst.State.NULL)
+        self.image_loop.quit()
+        self.image_thread.join()
+        self.image_post.close()
+        self.image_requests.fail_all(RuntimeError("Image pipeline stopped"))
+        self.image_pipeline = None
+        self.image_sources = []
+        self.raw_image_sources = []
+        self.image_scheduler = None
+        self.image_post = None
+        self.image_loop = None
+        self.image_thread = None
+
+    def _run_image_loop(self, ready):
+        context = self.image_loop.get_context()
+        context.push_thread_default()
+        bus = self.image_pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._image_bus_call)
+        ready.set()
+        self.image_loop.run()
+        bus.remove_signal_watch()
+        context.pop_thread_default()
+
+    def _image_bus_call(self, bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            sys.stderr.write(f"Error: {err}, Debug: {debug}\n")
+            # A failed buffer leaves the pipeline in an error state: fail the
+            # waiting requests and restart so later requests can proceed.
+            self.image_requests.fail_all(RuntimeError(str(err)))
+            self.image_pipeline.set_state(Gst.State.NULL)
+            self.image_pipeline.set_state(Gst.State.PLAYING)
+        return True
+
+    def _push_batch(self, batch):
+        """Request i of a batch goes to appsrc slot i"""
+        for slot, (image, pts) in enumerate(batch):
+            self._push_image(slot, image, pts)
+
+    def _push_image(self, slot, image, pts):
+        raw = isinstance(image, np.ndarray)
+        buffer = Gst.Buffer.new_wrapped(image.tobytes() if raw else image)
+        buffer.pts = pts
+        buffer.dts = pts
+        buffer.duration = IMAGE_FRAME_DURATION
+        if raw:
+            # Every raw image carries its own caps as its size varies
+            height, width = image.shape[:2]
+            caps = Gst.Caps.from_string(
+                f"video/x-raw, format=RGBA, width={width}, height={height}, "
+                "framerate=0/1"
+            )
+            sample = Gst.Sample.new(buffer, caps, None, None)
+            ret = self.raw_image_sources[slot].emit("push-sample", sample)
+        else:
+            ret = self.image_sources[slot].emit("push-buffer", buffer)
+        if ret != Gst.FlowReturn.OK:
+            FRAMES_DROPPED.labels("image_rejected").inc()
+            self.image_requests.fail(
+                pts, RuntimeError("Image pipeline refused the buffer")
+            )
+
+    def submit_image(self, image_bytes):
+        """Queue one encoded image for the next batch; resolves to
+        (image_cv, results).
+
+        JPEG bytes are pushed untouched and decoded by nvv4l2decoder; any
+        other format OpenCV can read is decoded once on the host and pushed
+        as raw RGBA. Raises ValueError for undecodable data.
+        """
+        if image_bytes[:3] == JPEG_MAGIC:
+            image = image_bytes
+        else:
+            decoded = cv2.imdecode(
+                np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR
+            )
+            if decoded is None:
+                raise ValueError("Unsupported or corrupt image")
+            image = cv2.cvtColor(decoded, cv2.COLOR_BGR2RGBA)
+        pts, future = self.image_requests.register()
+        self.image_scheduler.submit(image, pts)
+        return pts, future
@@ -0,0 +1,562 @@
+import json
+import os
+import threading
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+INITIAL_CAPACITY = 1024
+SNAPSHOT_CHUNK = 65536
+# Candidates per requested match re-scored against the exact vectors
+SNAPSHOT_RERANK_FACTOR = 8
+# IVF: exact search below this size, retrain once the gallery doubles.
+# Batched queries probe most lists of a small gallery, so below ~100k rows
+# IVF reads about as much memory as exact search and only loses recall.
+IVF_MIN_SIZE = 100000
+IVF_RETRAIN_GROWTH = 2
+IVF_TRAIN_ITERATIONS = 10
+IVF_TRAIN_SAMPLES_PER_LIST = 256
+
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    """L2-normalize a vector or the rows of a matrix as float32"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def top_k_rows(distances: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k smallest distances of every row, sorted"""
+    k = min(k, distances.shape[1])
+    if k < distances.shape[1]:
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(distances.shape[1]), (len(distances), 1))
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def ivf_params(count: int) -> Tuple[int, int]:
+    """(lists, probes) for an IVF index over `count` vectors, following the
+    pgvector guidance: rows / 1000 lists up to 1M rows, sqrt(rows) above,
+    and sqrt(lists) probes"""
+    lists = max(1, count // 1000 if count <= 1_000_000 else int(np.sqrt(count)))
+    return lists, max(1, int(np.sqrt(lists)))
+
+
+def kmeans(embeddings: np.ndarray, k: int, iterations: int, seed: int = 0):
+    """Spherical k-means over L2-normalized rows; returns (k, dim) centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_lists(embeddings, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, embeddings)
+        empty = np.bincount(assignment, minlength=k) == 0
+        # Re-seed empty lists with random rows instead of dropping them
+        sums[empty] = embeddings[rng.choice(len(embeddings), empty.sum())]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+def assign_lists(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the closest centroid for every row, computed in chunks"""
+    return np.concatenate(
+        [
+            np.argmax(embeddings[start : start + SNAPSHOT_CHUNK] @ centroids.T, axis=1)
+            for start in range(0, len(embeddings), SNAPSHOT_CHUNK)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+class RowLookup:
+    """Face id -> row map over an id array that is only appended to, built
+    on first use and extended as rows are published. A new array (reload,
+    growth) starts a new map."""
+
+    def __init__(self):
+        self._state = (None, 0, {})
+
+    def row(self, ids, size: int, face_id) -> int:
+        """Row of `face_id` among the first `size` ids; KeyError if absent"""
+        known, count, rows = self._state
+        if known is not ids:
+            count, rows = 0, {}
+        if count < size:
+            rows.update((str(ids[row]), row) for row in range(count, size))
+            self._state = (ids, size, rows)
+        face_id = str(face_id)
+        row = rows.get(face_id)
+        if row is None or row >= size or str(ids[row]) != face_id:
+            raise KeyError(face_id)
+        return row
+
+
+class GalleryIndex:
+    """In-process copy of the `faces` table for exact cosine search.
+
+    Embeddings are kept L2-normalized in one contiguous float32 matrix, so the
+    cosine distance to every registered face is a single matrix product and
+    matches `embedding <=> query` in pgvector.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self._lock = threading.Lock()
+        # (embeddings, ids, names, size) swapped as one tuple so readers
+        # always see a consistent view without taking the lock.
+        self._state = (
+            np.zeros((INITIAL_CAPACITY, dim), dtype=np.float32),
+            np.empty(INITIAL_CAPACITY, dtype=object),
+            np.empty(INITIAL_CAPACITY, dtype=object),
+            0,
+        )
+        self._rows = RowLookup()
+
+    def __len__(self):
+        return self._state[3]
+
+    def load(self, rows) -> int:
+        """Replace the index content with (id, name, embedding) rows"""
+        rows = list(rows)
+        return self.load_arrays(
+            [face_id for face_id, _, _ in rows],
+            [name for _, name, _ in rows],
+            np.array([embedding for _, _, embedding in rows], dtype=np.float32),
+        )
+
+    def load_arrays(self, ids, names, embeddings: np.ndarray) -> int:
+        """Replace the index content with parallel id/name/embedding arrays"""
+        count = len(ids)
+        capacity = max(count, INITIAL_CAPACITY)
+        gallery = np.zeros((capacity, self.dim), np.float32)
+        for start in range(0, count, SNAPSHOT_CHUNK):
+            stop = min(start + SNAPSHOT_CHUNK, count)
+            gallery[start:stop] = l2_normalize(embeddings[start:stop])
+        id_array = np.empty(capacity, dtype=object)
+        id_array[:count] = [str(face_id) for face_id in ids]
+        name_array = np.empty(capacity, dtype=object)
+        name_array[:count] = list(names)
+
+        with self._lock:
+            self._state = (gallery, id_array, name_array, count)
+        return count
+
+    def add(self, face_id, name: str, embedding: np.ndarray) -> None:
+        """Append one registered face, growing the storage geometrically"""
+        with self._lock:
+            self._append(face_id, name, embedding)
+
+    def _append(self, face_id, name: str, embedding: np.ndarray) -> int:
+        embeddings, ids, names, size = self._state
+        if size == len(embeddings):
+            capacity = 2 * len(embeddings)
+            embeddings = np.concatenate(
+                [embeddings, np.zeros((capacity - size, self.dim), np.float32)]
+            )
+            ids = np.concatenate([ids, np.empty(capacity - size, dtype=object)])
+            names = np.concatenate([names, np.empty(capacity - size, dtype=object)])
+        # Rows at or above `size` are invisible to readers until the new
+        # state tuple is published.
+        embeddings[size] = l2_normalize(embedding)
+        ids[size] = str(face_id)
+        names[size] = name
+        self._state = (embeddings, ids, names, size + 1)
+        return size
+
+    def vector(self, face_id) -> np.ndarray:
+        """Normalized embedding of a registered face; KeyError if unknown"""
+        embeddings, ids, _, size = self._state
+        return embeddings[self._rows.row(ids, size, face_id)].copy()
+
+    def search(self, embedding: np.ndarray, k: int = 1) -> List[Tuple[float, str, str]]:
+        """Return up to k (distance, id, name) tuples sorted by cosine distance"""
+        embeddings, ids, names, size = self._state
+        if size == 0:
+            return []
+        distances = 1.0 - embeddings[:size] @ l2_normalize(embedding)
+        k = min(k, size)
+        if k < size:
+            top = np.argpartition(distances, k - 1)[:k]
+            top = top[np.argsort(distances[top])]
+        else:
+            top = np.argsort(distances)
+        return [(float(distances[i]), ids[i], names[i]) for i in top]
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int = 1
+    ) -> List[List[Tuple[float, str, str]]]:
+        """Top-k matches for each row of an (N, dim) query matrix"""
+        gallery, ids, names, size = self._state
+        queries = l2_normalize(np.atleast_2d(embeddings))
+        if size == 0:
+            return [[] for _ in range(len(queries))]
+        distances = 1.0 - queries @ gallery[:size].T
+        top = top_k_rows(distances, k)
+        return [
+            [(float(distances[q, i]), ids[i], names[i]) for i in row]
+            for q, row in enumerate(top)
+        ]
+
+
+class IVFIndex(GalleryIndex):
+    """GalleryIndex with an inverted file on top for large galleries.
+
+    Rows are bucketed by their nearest k-means centroid and a query only
+    scores the `nprobe` closest buckets, trading a little recall for a scan
+    of roughly nprobe / nlist of the gallery. Every bucket keeps its own
+    contiguous copy of its vectors, so each one is scored with a single
+    matrix product for all the queries probing it. Below IVF_MIN_SIZE rows
+    the exact search of GalleryIndex is used.
+    """
+
+    def __init__(
+        self,
+        dim: int = EMBEDDING_DIM,
+        nlist: Optional[int] = None,
+        nprobe: Optional[int] = None,
+    ):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        # (centroids, lists, nprobe, trained_size); lists[i] is a
+        # (rows, vectors) tuple replaced as a whole on every add.
+        self._ivf = None
+        self._training = False
+
+    def load_arrays(self, ids, names, embeddings: np.ndarray) -> int:
+        with self._lock:
+            self._ivf = None
+        count = super().load_arrays(ids, names, embeddings)
+        self.train()
+        return count
+
+    def add(self, face_id, name: str, embedding: np.ndarray) -> None:
+        with self._lock:
+            row = self._append(face_id, name, embedding)
+            if self._ivf is not None:
+                self._assign(self._ivf, row, row + 1)
+            trained_size = self._ivf[3] if self._ivf is not None else 0
+            retrain = not self._training and (
+                row + 1 >= max(IVF_MIN_SIZE, IVF_RETRAIN_GROWTH * trained_size)
+            )
+            self._training = self._training or retrain
+        if retrain:
+            self.train()
+
+    def train(self) -> None:
+        """(Re)build centroids and lists from the current rows"""
+        embeddings, _, _, size = self._state
+        try:
+            if size < IVF_MIN_SIZE:
+                return
+            nlist, nprobe = ivf_params(size)
+            nlist = min(self.nlist or nlist, size)
+            samples = embeddings[:size]
+            if size > nlist * IVF_TRAIN_SAMPLES_PER_LIST:
+                rng = np.random.default_rng(0)
+                samples = samples[
+                    np.sort(rng.choice(size, nlist * IVF_TRAIN_SAMPLES_PER_LIST, False))
+                ]
+            centroids = kmeans(samples, nlist, IVF_TRAIN_ITERATIONS)
+            assignment = assign_lists(embeddings[:size], centroids)
+            order = np.argsort(assignment, kind="stable")
+            bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+            lists = []
+            for i in range(nlist):
+                rows = order[bounds[i] : bounds[i + 1]]
+                lists.append((rows, embeddings[rows]))
+            ivf = (centroids, lists, min(self.nprobe or nprobe, nlist), size)
+            with self._lock:
+                # Rows added while training was running
+                self._assign(ivf, size, self._state[3])
+                self._ivf = ivf
+        finally:
+            self._training = False
+
+    def _assign(self, ivf, start: int, stop: int) -> None:
+        if start >= stop:
+            return
+        centroids, lists = ivf[0], ivf[1]
+        embeddings = self._state[0][start:stop]
+        assignment = assign_lists(embeddings, centroids)
+        for offset, list_id in enumerate(assignment):
+            rows, vectors = lists[list_id]
+            lists[list_id] = (
+                np.append(rows, start + offset),
+                np.concatenate([vectors, embeddings[offset : offset + 1]]),
+            )
+
+    def search(self, embedding: np.ndarray, k: int = 1) -> List[Tuple[float, str, str]]:
+        return self.search_batch(embedding, k)[0]
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int = 1
+    ) -> List[List[Tuple[float, str, str]]]:
+        ivf = self._ivf
+        if ivf is None:
+            return super().search_batch(embeddings, k)
+        _, ids, names, size = self._state
+        centroids, lists, nprobe, _ = ivf
+        queries = l2_normalize(np.atleast_2d(embeddings))
+        probes = top_k_rows(-(queries @ centroids.T), nprobe)
+
+        # Queries grouped by probed list with one sort instead of a scan
+        # of `probes` per list
+        flat = probes.ravel()
+        order = np.argsort(flat, kind="stable")
+        probed, starts = np.unique(flat[order], return_index=True)
+        groups = np.split(order // probes.shape[1], starts[1:])
+
+        query_ids, found, found_rows = [], [], []
+        for list_id, probing in zip(probed, groups):
+            rows, vectors = lists[list_id]
+            # Lists may reference rows published after `size` was read
+            visible = rows < size
+            if not visible.all():
+                rows, vectors = rows[visible], vectors[visible]
+            if len(rows) == 0:
+                continue
+            distances = 1.0 - queries[probing] @ vectors.T
+            top = top_k_rows(distances, k)
+            query_ids.append(np.repeat(probing, top.shape[1]))
+            found.append(np.take_along_axis(distances, top, axis=1).ravel())
+            found_rows.append(rows[top].ravel())
+        if not found:
+            return [[] for _ in range(len(queries))]
+
+        # Merge the per-list top-k of every query with one sort
+        query_ids = np.concatenate(query_ids)
+        found = np.concatenate(found)
+        found_rows = np.concatenate(found_rows)
+        order = np.lexsort((found, query_ids))
+        query_ids, found, found_rows = query_ids[order], found[order], found_rows[order]
+        bounds = np.searchsorted(query_ids, np.arange(len(queries) + 1))
+        return [
+            [
+                (float(found[j]), ids[found_rows[j]], names[found_rows[j]])
+                for j in range(start, min(start + k, stop))
+            ]
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+
+def quantize(embeddings: np.ndarray, dtype: str):
+    """L2-normalize and quantize rows to float16, or to int8 with one
+    float32 scale per vector; returns (vectors, scales or None)"""
+    normalized = l2_normalize(np.atleast_2d(embeddings))
+    if dtype == "float16":
+        return normalized.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(normalized).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        vectors = np.round(normalized / scales[:, None]).astype(np.int8)
+        return vectors, scales.astype(np.float32)
+    raise ValueError(f"Unsupported snapshot dtype '{dtype}'")
+
+
+def write_snapshot(
+    path: str,
+    rows,
+    count: int,
+    dtype: str = "int8",
+    watermark: Optional[datetime] = None,
+    keep_exact: bool = True,
+    dim: int = EMBEDDING_DIM,
+) -> int:
+    """Write `count` (id, name, embedding) rows as a snapshot directory.
+
+    Vectors are streamed into .npy files that GallerySnapshot memory-maps;
+    with `keep_exact` a float32 copy is kept on disk for re-ranking.
+    `watermark` is the created_at of the newest row in the snapshot.
+    """
+    os.makedirs(path, exist_ok=True)
+    vectors = np.lib.format.open_memmap(
+        os.path.join(path, "vectors.npy"),
+        mode="w+",
+        dtype=np.float16 if dtype == "float16" else np.int8,
+        shape=(count, dim),
+    )
+    scales = np.ones(count, dtype=np.float32)
+    exact = None
+    if keep_exact:
+        exact = np.lib.format.open_memmap(
+            os.path.join(path, "exact.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(count, dim),
+        )
+    ids, names = [], []
+    batch = []
+
+    def flush(start):
+        embeddings = np.stack(batch)
+        quantized, batch_scales = quantize(embeddings, dtype)
+        vectors[start : start + len(batch)] = quantized
+        if batch_scales is not None:
+            scales[start : start + len(batch)] = batch_scales
+        if exact is not None:
+            exact[start : start + len(batch)] = l2_normalize(embeddings)
+        batch.clear()
+
+    written = 0
+    for face_id, name, embedding in rows:
+        if written + len(batch) == count:
+            break
+        ids.append(str(face_id))
+        names.append(name or "")
+        batch.append(np.asarray(embedding, dtype=np.float32))
+        if len(batch) == SNAPSHOT_CHUNK:
+            written += len(batch)
+            flush(written - len(batch))
+    if batch:
+        written += len(batch)
+        flush(written - len(batch))
+
+    vectors.flush()
+    if exact is not None:
+        exact.flush()
+    if dtype == "int8":
+        np.save(os.path.join(path, "scales.npy"), scales[:written])
+    np.save(os.path.join(path, "ids.npy"), np.array(ids, dtype=str))
+    np.save(os.path.join(path, "names.npy"), np.array(names, dtype=str))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "dtype": dtype,
+                "dim": dim,
+                "count": written,
+                "watermark": watermark.isoformat() if watermark else None,
+            },
+            f,
+        )
+    return written
+
+
+class GallerySnapshot:
+    """Read-only, memory-mapped snapshot written by write_snapshot.
+
+    Opening one only maps the files, so it takes milliseconds whatever the
+    gallery size, and worker processes share the pages through the page
+    cache. Scores are computed chunk by chunk on the quantized vectors and
+    the best candidates re-ranked against the exact vectors when present.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.path = path
+        self.dtype = meta["dtype"]
+        self.count = meta["count"]
+        self.watermark = (
+            datetime.fromisoformat(meta["watermark"]) if meta["watermark"] else None
+        )
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.scales = None
+        if self.dtype == "int8":
+            self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        self.exact = None
+        if os.path.exists(os.path.join(path, "exact.npy")):
+            self.exact = np.load(os.path.join(path, "exact.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.names = np.load(os.path.join(path, "names.npy"), mmap_mode="r")
+        self._rows = RowLookup()
+
+    def __len__(self):
+        return self.count
+
+    def vector(self, face_id) -> np.ndarray:
+        """Embedding of a face in the snapshot (exact when stored, otherwise
+        dequantized); KeyError if unknown"""
+        row = self._rows.row(self.ids, self.count, face_id)
+        if self.exact is not None:
+            return np.array(self.exact[row], np.float32)
+        vector = np.array(self.vectors[row], np.float32)
+        if self.scales is not None:
+            vector *= self.scales[row]
+        return vector
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int = 1, rerank: bool = True
+    ) -> List[List[Tuple[float, str, str]]]:
+        queries = l2_normalize(np.atleast_2d(embeddings))
+        if self.count == 0:
+            return [[] for _ in range(len(queries))]
+        rerank = rerank and self.exact is not None
+        candidates = k * SNAPSHOT_RERANK_FACTOR if rerank else k
+
+        best_idx = np.empty((len(queries), 0), dtype=np.int64)
+        best_dist = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, self.count, SNAPSHOT_CHUNK):
+            block = np.asarray(self.vectors[start : start + SNAPSHOT_CHUNK], np.float32)
+            scores = queries @ block.T
+            if self.scales is not None:
+                scores *= self.scales[start : start + len(block)]
+            idx = np.concatenate(
+                [
+                    best_idx,
+                    np.arange(start, start + len(block))[None].repeat(len(queries), 0),
+                ],
+                axis=1,
+            )
+            dist = np.concatenate([best_dist, 1.0 - scores], axis=1)
+            top = top_k_rows(dist, candidates)
+            best_idx = np.take_along_axis(idx, top, axis=1)
+            best_dist = np.take_along_axis(dist, top, axis=1)
+
+        if rerank:
+            for q in range(len(queries)):
+                # Sorted indices keep the memmap reads sequential
+                rows = np.sort(best_idx[q])
+                best_idx[q, : len(rows)] = rows
+                best_dist[q, : len(rows)] = 1.0 - self.exact[rows] @ queries[q]
+            top = top_k_rows(best_dist, k)
+            best_idx = np.take_along_axis(best_idx, top, axis=1)
+            best_dist = np.take_along_axis(best_dist, top, axis=1)
+
+        return [
+            [
+                (float(d), str(self.ids[i]), str(self.names[i]))
+                for d, i in zip(dists[:k], rows[:k])
+            ]
+            for dists, rows in zip(best_dist, best_idx)
+        ]
+
+
+class SnapshotIndex:
+    """GalleryIndex-compatible view of a snapshot plus the faces added
+    since it was written, which live in an in-memory GalleryIndex"""
+
+    def __init__(self, snapshot: GallerySnapshot, delta: Optional[GalleryIndex] = None):
+        self.snapshot = snapshot
+        self.delta = delta or GalleryIndex(snapshot.vectors.shape[1])
+
+    def __len__(self):
+        return len(self.snapshot) + len(self.delta)
+
+    def add(self, face_id, name: str, embedding: np.ndarray) -> None:
+        self.delta.add(face_id, name, embedding)
+
+    def vector(self, face_id) -> np.ndarray:
+        try:
+            return self.delta.vector(face_id)
+        except KeyError:
+            return self.snapshot.vector(face_id)
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int = 1
+    ) -> List[List[Tuple[float, str, str]]]:
+        merged = []
+        for old, new in zip(
+            self.snapshot.search_batch(embeddings, k),
+            self.delta.search_batch(embeddings, k),
+        ):
+            merged.append(sorted(old + new, key=lambda match: match[0])[:k])
+        return merged
+
+    def search(self, embedding: np.ndarray, k: int = 1) -> List[Tuple[float, str, str]]:
+        return self.search_batch(embedding, k)[0]
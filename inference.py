@@ -0,0 +1,541 @@
+"""Backend-independent half of the inference service.
+
+Everything here is free of GStreamer/pyds so it can be shared by the
+DeepStream backend (ds_pipeline.py) and the ONNX Runtime CPU backend
+(onnx_pipeline.py): the gallery matcher, result records, request
+bookkeeping, batching, post-processing stages, video outputs and the
+InferenceBackend contract. `create_backend()` imports the configured
+backend lazily, so machines without DeepStream never import it.
+"""
+
+import abc
+import importlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+
+from match_cache import MatchCache
+from metrics import (
+    FACES_DETECTED,
+    FACES_RECOGNIZED,
+    FRAMES_PROCESSED,
+    IMAGE_REQUEST_SECONDS,
+    POSTPROCESS_FRAME_SECONDS,
+    PROBE_FRAME_SECONDS,
+)
+from postprocess import PostProcessor
+from search import PGVectorFaceSearch
+from tracker import TrackedRecognizer
+from utils import draw_detections
+from video_output import open_video_writer
+
+# "deepstream" (GPU, nvinfer) or "onnx" (CPU, ONNX Runtime)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "deepstream")
+BACKENDS = {
+    "deepstream": "ds_pipeline:DeepStreamInference",
+    "onnx": "onnx_pipeline:OnnxInference",
+}
+THRESHOLD = 0.7
+IMAGE_REQUEST_TIMEOUT = 10.0
+# Image requests are keyed by a nanosecond PTS, one 30 fps frame apart
+IMAGE_FRAME_DURATION = 1000000000 // 30
+# Optimal/max batch of the TensorRT engines built in startup.sh
+ENGINE_MAX_BATCH_SIZE = 4
+IMAGE_BATCH_SIZE = ENGINE_MAX_BATCH_SIZE
+IMAGE_BATCH_WINDOW_MS = 5
+# Frames a track keeps its identity before it is matched again
+TRACK_REFRESH_FRAMES = 30
+# Fallback when the decoder does not report a frame rate
+VIDEO_DEFAULT_FPS = 30
+# Nominal rate of the annotated video of a keyframe-only run
+KEYFRAME_OUTPUT_FPS = 1
+# Adaptive detector interval: doubled after this many frames without a
+# face, up to ADAPTIVE_MAX_INTERVAL skipped frames between detections
+ADAPTIVE_IDLE_FRAMES = 30
+ADAPTIVE_MAX_INTERVAL = 8
+face_search = PGVectorFaceSearch(threshold=THRESHOLD, cache=MatchCache())
+
+
+def match_batch_faces(faces):
+    """Resolve every face of a batch, given as one list of faces per
+    frame, with a single compare_faces call"""
+    embeddings = [emb for frame_faces in faces for _, emb, _ in frame_faces]
+    if not embeddings:
+        return iter([])
+    return iter(face_search.compare_faces(np.stack(embeddings)))
+
+
+def to_bgr(frame):
+    """BGR view of a host frame copied from an RGBA surface (or already BGR)"""
+    if frame is not None and frame.shape[2] == 4:
+        return cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
+    return frame
+
+
+def frame_records(frame_bgr, faces, matches):
+    """Result dicts of one frame: the image first, then one per face"""
+    records = [{"image": frame_bgr}]
+    for bbox, emb, _ in faces:
+        match_distance, UserId, UserName = next(matches)
+        result = {"bbox": bbox, "img": frame_bgr, "embedding": emb}
+        if face_search.is_match(match_distance):
+            result["label"] = f"{UserName} ({match_distance:.2f})"
+            result["existed"] = True
+            result["UserName"] = UserName
+            result["match_distance"] = match_distance
+        else:
+            result["label"] = "Not recognized"
+            result["existed"] = False
+        records.append(result)
+    return records
+
+
+def annotate_frame(frame_bgr, faces, matches):
+    """Draw the matches of a video frame (unless `frame_bgr` is None);
+    returns its detection dicts and the number of recognized faces"""
+    recognized = 0
+    detections = []
+    labels = []
+    for bbox, emb, _ in faces:
+        match_distance, UserId, UserName = next(matches)
+        if face_search.is_match(match_distance):
+            label = f"{UserName} ({match_distance:.2f})"
+            recognized += 1
+        else:
+            label = "Not recognized"
+            UserId, UserName = None, None
+        labels.append(label)
+        detections.append(
+            {
+                "bbox": bbox,
+                "id": UserId,
+                "name": UserName,
+                "distance": match_distance,
+            }
+        )
+    if frame_bgr is not None:
+        draw_detections(frame_bgr, [bbox for bbox, _, _ in faces], labels)
+    return detections, recognized
+
+
+def publish_frame(outputs, source_id, frame_num, timestamp, frame_bgr, detections):
+    """Write an annotated frame and pass its record to `outputs.on_result`"""
+    if frame_bgr is not None:
+        outputs.write(source_id, frame_bgr)
+    if outputs.on_result is not None:
+        outputs.on_result(
+            {
+                "source_id": source_id,
+                "frame_num": frame_num,
+                "timestamp": timestamp,
+                "detections": detections,
+            }
+        )
+
+
+def observe_probe(pipeline, frames, started):
+    """Per-frame probe time of one batch"""
+    if not frames:
+        return
+    per_frame = (time.perf_counter() - started) / len(frames)
+    histogram = PROBE_FRAME_SECONDS.labels(pipeline)
+    for _ in frames:
+        histogram.observe(per_frame)
+
+
+def observe_frames(pipeline, faces, recognized, started):
+    """Per-frame post-processing time and frame/face counters of one batch,
+    given as one list of faces per frame"""
+    if not faces:
+        return
+    per_frame = (time.perf_counter() - started) / len(faces)
+    histogram = POSTPROCESS_FRAME_SECONDS.labels(pipeline)
+    for _ in faces:
+        histogram.observe(per_frame)
+    FRAMES_PROCESSED.labels(pipeline).inc(len(faces))
+    FACES_DETECTED.labels(pipeline).inc(sum(len(f) for f in faces))
+    FACES_RECOGNIZED.labels(pipeline).inc(recognized)
+
+
+def video_postprocessor(outputs, live=False):
+    """PostProcessor of a video run.
+
+    Takes batches of (source_id, frame_num, timestamp, frame, faces), with
+    `frame` None when no video is written. Faces are matched in frame order
+    when `outputs.recognizer` tracks them, frames are converted and drawn
+    concurrently, then written and reported in frame order. Live sources
+    drop batches instead of stalling when the workers fall behind.
+    """
+
+    def match(frames):
+        started = time.perf_counter()
+        faces = [frame_faces for *_, frame_faces in frames]
+        if outputs.recognizer is not None:
+            matches = outputs.recognizer.match(
+                [(source_id, frame_num, f) for source_id, frame_num, *_, f in frames]
+            )
+        else:
+            matches = match_batch_faces(faces)
+        return started, frames, list(matches)
+
+    def annotate(matched):
+        started, frames, matches = matched
+        matches = iter(matches)
+        annotated = []
+        recognized = 0
+        for source_id, frame_num, timestamp, frame, faces in frames:
+            frame_bgr = to_bgr(frame)
+            detections, count = annotate_frame(frame_bgr, faces, matches)
+            recognized += count
+            annotated.append((source_id, frame_num, timestamp, frame_bgr, detections))
+        return started, frames, annotated, recognized
+
+    def publish(annotated_batch):
+        started, frames, annotated, recognized = annotated_batch
+        for source_id, frame_num, timestamp, frame_bgr, detections in annotated:
+            publish_frame(
+                outputs, source_id, frame_num, timestamp, frame_bgr, detections
+            )
+        observe_frames("video", [faces for *_, faces in frames], recognized, started)
+
+    return PostProcessor(
+        [
+            (match, outputs.recognizer is not None),
+            (annotate, False),
+            (publish, True),
+        ],
+        drop_when_full=live,
+        name="video",
+    )
+
+
+def image_postprocessor(requests):
+    """PostProcessor of the persistent image pipeline: batches of (pts,
+    frame, faces) are matched and resolved in any order"""
+
+    def resolve(batch):
+        started = time.perf_counter()
+        faces = [frame_faces for _, _, frame_faces in batch]
+        matches = match_batch_faces(faces)
+        recognized = 0
+        for pts, frame, frame_faces in batch:
+            image = to_bgr(frame)
+            records = frame_records(image, frame_faces, matches)
+            recognized += sum(record["existed"] for record in records[1:])
+            requests.resolve(pts, (image, records[1:]))
+        observe_frames("image", faces, recognized, started)
+
+    def fail(batch, exc):
+        for pts, _, _ in batch:
+            requests.fail(pts, exc)
+
+    return PostProcessor([(resolve, False)], on_error=fail, name="image")
+
+
+class FrameSampler:
+    """Keeps frames at `target_fps`, by presentation timestamp in units of
+    `second` per second"""
+
+    def __init__(self, target_fps=None, second=1.0):
+        self.target_fps = target_fps
+        self.second = second
+        self._next_pts = None
+
+    def keep(self, pts):
+        """Whether the frame at `pts` is due for the target frame rate"""
+        if not self.target_fps:
+            return True
+        step = self.second / self.target_fps
+        # Tolerate 1 ms of rounding in the source timestamps
+        if self._next_pts is not None and pts + self.second / 1000 < self._next_pts:
+            return False
+        if self._next_pts is None or pts - self._next_pts >= step:
+            self._next_pts = pts + step
+        else:
+            self._next_pts += step
+        return True
+
+
+class AdaptiveInterval:
+    """Raises the detector interval while no face is seen and drops it back
+    to the configured one as soon as a face is detected.
+
+    `detector` exposes nvinfer's "interval" property through
+    get_property/set_property.
+    """
+
+    def __init__(
+        self,
+        detector,
+        idle_frames=ADAPTIVE_IDLE_FRAMES,
+        max_interval=ADAPTIVE_MAX_INTERVAL,
+    ):
+        self.detector = detector
+        self.idle_frames = idle_frames
+        self.max_interval = max_interval
+        self.base = None
+        self.interval = None
+        self.idle = 0
+
+    def update(self, frames, faces_found):
+        if self.base is None:
+            # Read once the config file has been applied
+            self.base = self.interval = self.detector.get_property("interval")
+        interval = self.interval
+        if faces_found:
+            self.idle = 0
+            interval = self.base
+        else:
+            self.idle += frames
+            if self.idle >= self.idle_frames:
+                self.idle = 0
+                interval = min(self.max_interval, max(1, 2 * self.interval))
+        if interval != self.interval:
+            self.detector.set_property("interval", interval)
+            self.interval = interval
+
+
+class StreamOutputs:
+    """Annotated-video writers routed by source id.
+
+    A writer is opened on the first frame of a source, at
+    `fps_for_source(source_id)`, and closed when the source is removed.
+    Without `path_for_source` no video is written and frames are never
+    copied to host memory. `on_result(record)` receives a per-frame record
+    (source_id, frame_num, timestamp, detections) when given. With a
+    `recognizer`, faces are only matched when their track needs it; with an
+    AdaptiveInterval as `interval`, the detector interval follows the
+    presence of faces. `output_format` is one of VIDEO_OUTPUT_FORMATS.
+    """
+
+    def __init__(
+        self,
+        path_for_source,
+        fps_for_source,
+        size,
+        on_result=None,
+        recognizer=None,
+        interval=None,
+        output_format="mp4",
+    ):
+        self.path_for_source = path_for_source
+        self.fps_for_source = fps_for_source
+        self.size = size
+        self.output_format = output_format
+        self.on_result = on_result
+        self.recognizer = recognizer
+        self.interval = interval
+        # Set when the pipeline goes to PLAYING, cleared by the first buffer
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._writers = {}
+
+    @property
+    def writes_video(self):
+        return self.path_for_source is not None
+
+    def write(self, source_id, frame):
+        with self._lock:
+            writer = self._writers.get(source_id)
+            if writer is None:
+                writer = open_video_writer(
+                    self.path_for_source(source_id),
+                    self.fps_for_source(source_id),
+                    self.size,
+                    self.output_format,
+                )
+                self._writers[source_id] = writer
+            writer.write(frame)
+
+    def close(self, source_id):
+        with self._lock:
+            writer = self._writers.pop(source_id, None)
+        if writer is not None:
+            writer.release()
+
+    def release(self):
+        for source_id in list(self._writers):
+            self.close(source_id)
+
+
+class ImageRequests:
+    """Pending persistent-pipeline requests keyed by the PTS of their buffer.
+
+    PTS values are unique across all appsrc slots, so a frame coming out of a
+    batch is matched to its request whatever its batch_id/source_id.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # pts -> (future, submitted at)
+        self._next_id = 0
+        # Set when the pipeline goes to PLAYING, cleared by the first buffer
+        self.started_at = None
+
+    def register(self):
+        with self._lock:
+            self._next_id += 1
+            pts = self._next_id * IMAGE_FRAME_DURATION
+            future = Future()
+            self._pending[pts] = (future, time.perf_counter())
+        return pts, future
+
+    def resolve(self, pts, records):
+        with self._lock:
+            pending = self._pending.pop(pts, None)
+        if pending is not None and not pending[0].done():
+            IMAGE_REQUEST_SECONDS.observe(time.perf_counter() - pending[1])
+            pending[0].set_result(records)
+
+    def fail(self, pts, exc):
+        with self._lock:
+            pending = self._pending.pop(pts, None)
+        if pending is not None and not pending[0].done():
+            pending[0].set_exception(exc)
+
+    def discard(self, pts):
+        with self._lock:
+            self._pending.pop(pts, None)
+
+    def fail_all(self, exc):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+
+class ImageBatchScheduler:
+    """Groups concurrent image requests into engine-sized batches.
+
+    A batch is flushed when `batch_size` requests are waiting or `window_ms`
+    after its first request arrived; `push(batch)` receives the batch as a
+    list of (image, pts).
+    """
+
+    def __init__(
+        self, push, batch_size=IMAGE_BATCH_SIZE, window_ms=IMAGE_BATCH_WINDOW_MS
+    ):
+        self.push = push
+        self.batch_size = batch_size
+        self.window = window_ms / 1000.0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, pts):
+        self.queue.put((image, pts))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self.push(batch)
+
+
+class InferenceBackend(abc.ABC):
+    """Contract of an inference backend, as used by main.py and jobs.py.
+
+    Images go through a persistent batched pipeline (start_image_pipeline,
+    submit_image/infer_image, stop_image_pipeline) or a one-shot run_image;
+    videos through run_video. Image results are (image_bgr, records) with
+    one frame_records dict per face.
+    """
+
+    def __init__(self, tracker=None):
+        """`tracker` is None (match every face), "nvtracker" (track in the
+        pipeline, where the backend has one) or "iou" (track in Python)"""
+        self.tracker = tracker
+        self.image_requests = ImageRequests()
+
+    @abc.abstractmethod
+    def start_image_pipeline(
+        self,
+        batch_size=IMAGE_BATCH_SIZE,
+        batch_window_ms=IMAGE_BATCH_WINDOW_MS,
+        warmup=True,
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stop_image_pipeline(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def submit_image(self, image_bytes):
+        """Queue one encoded image; returns (pts, future) resolving to
+        (image_cv, results). Raises ValueError for undecodable data."""
+        raise NotImplementedError
+
+    def infer_image(self, image_bytes, timeout=IMAGE_REQUEST_TIMEOUT):
+        """Run one encoded image through the persistent image pipeline"""
+        pts, future = self.submit_image(image_bytes)
+        try:
+            return future.result(timeout=timeout)
+        finally:
+            self.image_requests.discard(pts)
+
+    @abc.abstractmethod
+    def run_image(self, image_path):
+        """Run inference on single image"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def run_video(
+        self,
+        uri,
+        output_path=None,
+        on_result=None,
+        target_fps=None,
+        keyframes_only=False,
+        adaptive_interval=False,
+        output_format="mp4",
+    ):
+        """Run inference on a video / stream; see DeepStreamInference"""
+        raise NotImplementedError
+
+    def _make_recognizer(self):
+        if self.tracker is None:
+            return None
+        return TrackedRecognizer(
+            face_search.compare_faces,
+            face_search.threshold,
+            refresh_frames=TRACK_REFRESH_FRAMES,
+        )
+
+
+def create_backend(tracker=None, backend=None):
+    """Instantiate the `backend` (default INFERENCE_BACKEND) named in
+    BACKENDS, importing its module on first use"""
+    name = backend or INFERENCE_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown inference backend '{name}', expected one of {sorted(BACKENDS)}"
+        )
+    module_name, class_name = BACKENDS[name].split(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(tracker=tracker)
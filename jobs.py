@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from video_output import output_path as video_output_path, remove_output
+
+VIDEO_JOB_WORKERS = 2
+VIDEO_JOB_RETENTION = 100
+
+
+class VideoJob:
+    def __init__(
+        self,
+        job_id: str,
+        input_path: str,
+        output_path: Optional[str],
+        on_detections: Optional[Callable] = None,
+        video_options: Optional[dict] = None,
+        output_format: str = "mp4",
+    ):
+        self.id = job_id
+        self.input_path = input_path
+        self.output_path = output_path
+        self.on_detections = on_detections
+        self.video_options = video_options or {}
+        self.output_format = output_format
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.cancelled = False
+        self.frames_processed = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future = None
+
+    @property
+    def fps(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.frames_processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def cancel(self, error: str):
+        """Fail the job whatever run_video returns, e.g. when its input was
+        cut short, and drop its output"""
+        self.error = error
+        self.cancelled = True
+
+    def on_result(self, record):
+        self.frames_processed += 1
+        # Nobody is listening for the records of a cancelled job
+        if self.on_detections is not None and not self.cancelled:
+            self.on_detections(record)
+
+
+class VideoJobManager:
+    """Runs video inference jobs on a worker pool, off the event loop.
+
+    Every job gets its own inference instance (pipelines are not
+    reentrant) and its own output file under `output_dir`.
+    """
+
+    def __init__(
+        self,
+        make_inference: Callable,
+        output_dir: str = "assets/videos",
+        max_workers: int = VIDEO_JOB_WORKERS,
+        retention: int = VIDEO_JOB_RETENTION,
+    ):
+        self.make_inference = make_inference
+        self.output_dir = output_dir
+        self.retention = retention
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="video-job"
+        )
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(
+        self,
+        input_path: str,
+        write_video: bool = True,
+        on_detections: Optional[Callable] = None,
+        video_options: Optional[dict] = None,
+        output_format: str = "mp4",
+    ) -> VideoJob:
+        """Queue `input_path` for inference; the file is removed afterwards.
+
+        `on_detections(record)` is called from the pipeline thread for every
+        frame; with `write_video=False` no annotated video is produced.
+        `video_options` are passed on to run_video (frame sampling), as is
+        `output_format` (see video_output.VIDEO_OUTPUT_FORMATS).
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        output_path = None
+        if write_video:
+            output_path = video_output_path(self.output_dir, job_id, output_format)
+        job = VideoJob(
+            job_id,
+            input_path,
+            output_path,
+            on_detections,
+            video_options,
+            output_format,
+        )
+        with self._lock:
+            self._jobs[job_id] = job
+            self._evict_finished()
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[VideoJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job: VideoJob, error: str):
+        """Fail `job` with `error`: a queued job never starts, a running one
+        fails when run_video returns"""
+        if not self._cancel_queued(job, error):
+            job.cancel(error)
+
+    def shutdown(self):
+        """Stop the pool: queued jobs fail, running jobs are not waited for"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            self._cancel_queued(job, "Service shut down before the job started")
+        self.executor.shutdown(wait=False)
+
+    def _cancel_queued(self, job: VideoJob, error: str) -> bool:
+        # cancel() only succeeds for jobs that have not started
+        if job.future is None or not job.future.cancel():
+            return False
+        job.error = error
+        job.status = "failed"
+        job.finished_at = time.monotonic()
+        if os.path.exists(job.input_path):
+            os.remove(job.input_path)
+        return True
+
+    def _run(self, job: VideoJob):
+        job.status = "running"
+        job.started_at = time.monotonic()
+        try:
+            inference = self.make_inference()
+            inference.run_video(
+                f"file://{job.input_path}",
+                job.output_path,
+                on_result=job.on_result,
+                output_format=job.output_format,
+                **job.video_options,
+            )
+            if job.cancelled:
+                raise RuntimeError(job.error)
+            job.status = "completed"
+        except Exception as e:
+            if job.cancelled and job.output_path:
+                remove_output(job.output_path)
+            job.error = job.error if job.cancelled else str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.monotonic()
+            if os.path.exists(job.input_path):
+                os.remove(job.input_path)
+        return job
+
+    def _evict_finished(self):
+        finished = [job for job in self._jobs.values() if job.done]
+        for job in finished[: max(0, len(self._jobs) - self.retention)]:
+            del self._jobs[job.id]
+            if job.output_path:
+                remove_output(job.output_path)
@@ -1,31 +1,174 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import Depends, FastAPI, File, UploadFile, Form, Query, Request
+from typing import List, Optional
+from fastapi.responses import Response, StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from search import engine_sync, SessionLocalSync, Base, Face
-from schemas import RegisterFaceResponse
+from search import (
+    engine_sync,
+    engine_async,
+    get_session,
+    Base,
+    GALLERY_INDEX,
+    GALLERY_SNAPSHOT_DIR,
+)
+from schemas import (
+    RegisterFaceResponse,
+    BulkRegisterItem,
+    BulkRegisterResponse,
+    FaceCandidate,
+    MatchCacheStats,
+    TopKFace,
+    TopKSearchResponse,
+    VideoJobResponse,
+    VideoJobStatus,
+)
 from fastapi import HTTPException
 from sqlalchemy import text
-from PIL import Image
 import numpy as np
 import cv2
 
+import errno
 import io
-import os, shutil
+import json
+import asyncio
+import concurrent.futures
+import os
+import tarfile
 import tempfile
+import time
+import uuid
+import zipfile
+
+from inference import (
+    create_backend,
+    face_search,
+    IMAGE_REQUEST_TIMEOUT,
+)
+from gallery import GalleryIndex, l2_normalize
+from jobs import VideoJobManager
+from metrics import FRAMES_DROPPED, HTTP_REQUEST_SECONDS
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from utils import draw_detections
+from video_output import HLS_PLAYLIST, ffmpeg_available
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
 
-from ds_pipeline import DeepStreamInference
-from utils import draw_bbox
+BULK_MAX_IN_FLIGHT = 64
+BULK_DEDUP_CHUNK = 1024
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+# How often a progressive video response checks its file for new fragments
+VIDEO_FOLLOW_INTERVAL = 0.25
+VIDEO_STREAM_CHUNK = 1 << 20
+# Records a detections stream holds for a slow client; beyond that they are
+# dropped and counted as frames_dropped_total{reason="stream_full"}
+DETECTIONS_QUEUE_SIZE = int(os.getenv("DETECTIONS_QUEUE_SIZE", "1024"))
+# Upload size caps in bytes (413 beyond); uploads are read in UPLOAD_CHUNK
+# pieces, never whole
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 << 20)))
+MAX_ARCHIVE_BYTES = int(os.getenv("MAX_ARCHIVE_BYTES", str(2 << 30)))
+MAX_VIDEO_BYTES = int(os.getenv("MAX_VIDEO_BYTES", str(16 << 30)))
+UPLOAD_CHUNK = 1 << 20
+# Request body cap per route, MAX_IMAGE_BYTES for the others, plus room
+# for the multipart boundaries and form fields around the file bytes
+UPLOAD_LIMITS = {
+    "/register/bulk": MAX_ARCHIVE_BYTES,
+    "/infer-video": MAX_VIDEO_BYTES,
+    "/infer-video/stream": MAX_VIDEO_BYTES,
+    "/infer-video/detections": MAX_VIDEO_BYTES,
+    "/jobs/video": MAX_VIDEO_BYTES,
+}
+MULTIPART_OVERHEAD = 64 << 10
+# Request body of the video endpoints, which parse it themselves
+VIDEO_UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
 
-face_ds = DeepStreamInference()
+# INFERENCE_BACKEND picks DeepStream (GPU) or ONNX Runtime (CPU); only the
+# selected backend module is imported
+face_ds = create_backend(tracker="nvtracker")
+video_jobs = VideoJobManager(lambda: create_backend(tracker="nvtracker"))
 app = FastAPI()
 
+
+class UploadLimitMiddleware:
+    """Reject request bodies over the cap of their route with 413 before
+    they are parsed: from Content-Length without reading anything, or as
+    soon as a chunked body passes the cap. Starlette otherwise spools a
+    whole multipart body to disk before the handler sees its size."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        cap = UPLOAD_LIMITS.get(scope["path"], MAX_IMAGE_BYTES)
+        limit = cap + MULTIPART_OVERHEAD
+        length = Headers(scope=scope).get("content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            response = JSONResponse(
+                {"detail": upload_too_large(cap).detail}, status_code=413
+            )
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise upload_too_large(cap)
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+app.add_middleware(UploadLimitMiddleware)
 # CORS for frontend access
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
 )
 
 
+@app.middleware("http")
+async def observe_request(request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template keeps the label cardinality bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        HTTP_REQUEST_SECONDS.labels(request.method, route, status).observe(
+            time.perf_counter() - start
+        )
+
+
 @app.on_event("startup")
 def startup():
     with engine_sync.begin() as conn:
@@ -33,25 +176,251 @@ def startup():
         Base.metadata.create_all(conn)
         conn.execute(
             text(
-                """
-                CREATE INDEX IF NOT EXISTS idx_embedding
-                ON faces USING ivfflat (embedding vector_l2_ops) WITH (lists = 100)
-            """
+                "ALTER TABLE faces ADD COLUMN IF NOT EXISTS "
+                "created_at timestamptz DEFAULT now()"
             )
         )
+        # create_all only indexes created_at on tables it creates
+        conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_faces_created_at "
+                "ON faces (created_at)"
+            )
+        )
+    face_search.ensure_vector_index()
+    if (
+        GALLERY_INDEX != "none"
+        and GALLERY_SNAPSHOT_DIR
+        and os.path.isdir(GALLERY_SNAPSHOT_DIR)
+    ):
+        face_search.load_snapshot(GALLERY_SNAPSHOT_DIR)
+    else:
+        face_search.load_index()
+    face_ds.start_image_pipeline()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    face_ds.stop_image_pipeline()
+    video_jobs.shutdown()
+    face_search.close()
+    await engine_async.dispose()
+
+
+def upload_too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+
+
+def check_upload_size(file: UploadFile, limit: int):
+    """Reject an upload whose size is already known to exceed `limit`"""
+    size = getattr(file, "size", None)
+    if size is not None and size > limit:
+        raise upload_too_large(limit)
+
+
+async def read_upload(file: UploadFile, limit: int = MAX_IMAGE_BYTES) -> bytes:
+    """The bytes of an upload of at most `limit` bytes"""
+    check_upload_size(file, limit)
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > limit:
+            raise upload_too_large(limit)
+        chunks.append(chunk)
+
+
+class MultipartFileWriter:
+    """python-multipart callbacks that write the `field` file of a form to
+    a unique temp path, keeping its extension, and ignore other parts"""
+
+    def __init__(self, field: str, limit: int):
+        self.field = field.encode()
+        self.limit = limit
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.writing = False
+        self.headers = {}
+        self.header_field = b""
+        self.header_value = b""
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self):
+        disposition = self.headers.get(b"content-disposition", b"")
+        _, options = parse_options_header(disposition)
+        if options.get(b"name") != self.field or self.path is not None:
+            return
+        filename = options.get(b"filename", b"").decode("utf-8", "replace")
+        fd, self.path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+        self.file = os.fdopen(fd, "wb")
+        self.writing = True
+
+    def on_part_data(self, data, start, end):
+        if self.writing:
+            self.size += end - start
+            if self.size > self.limit:
+                raise upload_too_large(self.limit)
+            self.file.write(data[start:end])
+
+    def on_part_end(self):
+        if self.writing:
+            self.writing = False
+            self.file.close()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def receive_upload(
+    request: Request, limit: int = MAX_VIDEO_BYTES, field: str = "file"
+) -> str:
+    """Temp path of the `field` file of a multipart request, written as the
+    body arrives: unlike an UploadFile, which Starlette spools first and
+    handlers then copy, the upload is written to disk once"""
+    content_type, options = parse_options_header(
+        request.headers.get("content-type", "")
+    )
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(
+            status_code=400, detail="Expected a multipart/form-data upload"
+        )
+    writer = MultipartFileWriter(field, limit)
+    parser = multipart.MultipartParser(boundary, writer.callbacks())
+    try:
+        pending, size = [], 0
+        async for chunk in request.stream():
+            pending.append(chunk)
+            size += len(chunk)
+            # Parse and write off the event loop, about UPLOAD_CHUNK at a time
+            if size >= UPLOAD_CHUNK:
+                await run_in_threadpool(parser.write, b"".join(pending))
+                pending, size = [], 0
+        await run_in_threadpool(parser.write, b"".join(pending))
+        parser.finalize()
+    except FormParserError as e:
+        writer.discard()
+        raise HTTPException(status_code=400, detail=f"Malformed upload: {e}")
+    except BaseException:
+        writer.discard()
+        raise
+    if writer.writing:
+        writer.discard()
+        raise HTTPException(status_code=400, detail="Malformed upload: truncated")
+    if writer.path is None:
+        raise HTTPException(status_code=422, detail=f"Missing file field '{field}'")
+    return writer.path
+
+
+def make_upload_fifo() -> str:
+    """A named pipe at a unique temp path, for a video decoded while it is
+    uploaded"""
+    while True:
+        path = os.path.join(tempfile.gettempdir(), f"upload-{uuid.uuid4().hex}")
+        try:
+            os.mkfifo(path, 0o600)
+            return path
+        except FileExistsError:
+            continue
+
+
+def write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+async def feed_upload(request: Request, path: str, job):
+    """Write the request body into the named pipe the job decodes from.
+
+    Writes block while the decoder is behind, which holds back the client.
+    Stops when the decoder closes the pipe (end of stream or failure).
+    """
+    fd = None
+    try:
+        while fd is None:
+            try:
+                # Without a reader yet this fails instead of blocking, so a
+                # job that fails before opening the pipe cannot hang us
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if job.done:
+                    return
+                if e.errno != errno.ENXIO:
+                    raise
+                await asyncio.sleep(VIDEO_FOLLOW_INTERVAL)
+        os.set_blocking(fd, True)
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_VIDEO_BYTES:
+                raise upload_too_large(MAX_VIDEO_BYTES)
+            await run_in_threadpool(write_all, fd, chunk)
+    except BrokenPipeError:
+        pass
+    except BaseException as e:
+        # Closing the pipe looks like a clean end of stream to the decoder:
+        # fail the job on the truncated input before it completes
+        job.cancel(getattr(e, "detail", None) or "Upload interrupted")
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+async def infer_upload(image_bytes: bytes):
+    """Run uploaded image bytes through the persistent pipeline in memory"""
+    try:
+        # Waiting off the event loop lets concurrent uploads share a batch
+        return await run_in_threadpool(face_ds.infer_image, image_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except concurrent.futures.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Image inference timed out after {IMAGE_REQUEST_TIMEOUT:g}s",
+        )
 
 
 @app.post("/register", response_model=RegisterFaceResponse)
-async def register_face(name: str = Form(...), file: UploadFile = File(...)):
-
-    image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-        image.save(tmp_file.name)
-        tmp_path = tmp_file.name
-    image_cv, results = face_ds.run_image(tmp_path)
-    # Optionally, remove the temp image after processing
-    os.remove(tmp_path)
+async def register_face(
+    name: str = Form(...),
+    file: UploadFile = File(...),
+    session: AsyncSession = Depends(get_session),
+):
+
+    image_bytes = await read_upload(file)
+    image_cv, results = await infer_upload(image_bytes)
     if len(results) == 0:
         raise HTTPException(
             status_code=404,
@@ -66,26 +435,167 @@ async def register_face(name: str = Form(...), file: UploadFile = File(...)):
             detail=f"Face already exists as '{UserName}' with similarity {1 - match_distance:.2f}",
         )
     embedding = results[0]["embedding"]
-    new_face = Face(name=name, embedding=embedding.tolist())
+    (face_id,) = await face_search.register_faces(session, [(name, embedding)])
+    return RegisterFaceResponse(id=face_id, name=name)
+
+
+def iter_archive(fileobj, filename: str):
+    """Yield (name, image bytes) for every image in a zip or tar archive,
+    named after the file without its extension; members are read one at a
+    time from the spooled upload and capped at MAX_IMAGE_BYTES"""
+
+    def check(name, size):
+        stem, ext = os.path.splitext(os.path.basename(name))
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            return None
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"'{name}' exceeds {MAX_IMAGE_BYTES} bytes",
+            )
+        return stem
+
+    if zipfile.is_zipfile(fileobj):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                stem = None if info.is_dir() else check(info.filename, info.file_size)
+                if stem is not None:
+                    yield stem, archive.read(info)
+        return
+    fileobj.seek(0)
+    try:
+        # Stream mode: members are read in order, without an index pass
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for member in archive:
+                stem = check(member.name, member.size) if member.isfile() else None
+                if stem is not None:
+                    yield stem, archive.extractfile(member).read()
+    except tarfile.TarError:
+        raise HTTPException(
+            status_code=400, detail=f"'{filename}' is not a zip or tar archive"
+        )
+
+
+async def bulk_images(files, names, archive):
+    """(name, image bytes) of the uploaded `files` and `archive` members,
+    read one at a time as the caller asks for them"""
+    for i, file in enumerate(files or []):
+        name = names[i] if names and i < len(names) else None
+        name = name or os.path.splitext(os.path.basename(file.filename))[0]
+        yield name, await read_upload(file)
+    if archive is not None:
+        check_upload_size(archive, MAX_ARCHIVE_BYTES)
+        members = iter_archive(archive.file, archive.filename)
+        while True:
+            item = await run_in_threadpool(next, members, None)
+            if item is None:
+                return
+            yield item
 
-    with SessionLocalSync() as db:
-        db.add(new_face)
-        db.commit()
-        db.refresh(new_face)
-        return RegisterFaceResponse(id=str(new_face.id), name=new_face.name)
+
+async def detect_faces_bulk(images):
+    """Run (name, image bytes) pairs through the batched image pipeline as
+    they are read, at most BULK_MAX_IN_FLIGHT at a time.
+
+    Returns the report item of every image and the (index, embedding) of
+    the first face of each image with one; frames and other detections
+    are dropped as soon as an image completes.
+    """
+    semaphore = asyncio.Semaphore(BULK_MAX_IN_FLIGHT)
+    report = []
+    embeddings = {}
+    pending = set()
+
+    async def detect(i, image_bytes):
+        try:
+            pts, future = await run_in_threadpool(face_ds.submit_image, image_bytes)
+            try:
+                _, records = await asyncio.wait_for(
+                    asyncio.wrap_future(future), IMAGE_REQUEST_TIMEOUT
+                )
+            finally:
+                face_ds.image_requests.discard(pts)
+            if records:
+                embeddings[i] = np.array(records[0]["embedding"])
+            else:
+                report[i].status = "no_face"
+        except Exception as e:
+            report[i].detail = str(e) or type(e).__name__
+        finally:
+            semaphore.release()
+
+    try:
+        async for name, image_bytes in images:
+            await semaphore.acquire()
+            report.append(BulkRegisterItem(name=name, status="invalid"))
+            task = asyncio.ensure_future(detect(len(report) - 1, image_bytes))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    return report, sorted(embeddings.items())
+
+
+@app.post("/register/bulk", response_model=BulkRegisterResponse)
+async def register_faces_bulk(
+    files: Optional[List[UploadFile]] = File(None),
+    names: Optional[List[str]] = Form(None),
+    archive: Optional[UploadFile] = File(None),
+    session: AsyncSession = Depends(get_session),
+):
+    """Register many faces at once from `files` (named by `names`, or by
+    their file names) and/or a zip/tar `archive` of <name>.<ext> images"""
+    report, candidates = await detect_faces_bulk(bulk_images(files, names, archive))
+    if not report:
+        raise HTTPException(status_code=400, detail="No images provided")
+
+    # Vectorized dedup, chunk by chunk: against faces accepted earlier in
+    # this request, within the chunk, then against the gallery.
+    accepted = GalleryIndex()
+    new_faces = []
+    for start in range(0, len(candidates), BULK_DEDUP_CHUNK):
+        chunk = candidates[start : start + BULK_DEDUP_CHUNK]
+        embeddings = l2_normalize(np.stack([embedding for _, embedding in chunk]))
+        earlier = accepted.search_batch(embeddings, k=1)
+        within = 1.0 - embeddings @ embeddings.T <= face_search.threshold
+        gallery = await face_search.compare_faces_async(session, embeddings)
+        registered = np.zeros(len(chunk), dtype=bool)
+        for j, (i, embedding) in enumerate(chunk):
+            item = report[i]
+            same = np.flatnonzero(within[j, :j] & registered[:j])
+            if earlier[j] and face_search.is_match(earlier[j][0][0]):
+                item.status = "duplicate"
+                item.detail = f"Same face as '{earlier[j][0][2]}' in this request"
+            elif len(same):
+                item.status = "duplicate"
+                name = report[chunk[same[0]][0]].name
+                item.detail = f"Same face as '{name}' in this request"
+            elif face_search.is_match(gallery[j][0]):
+                distance, _, name = gallery[j]
+                item.status = "exists"
+                item.detail = f"Face already exists as '{name}' with similarity {1 - distance:.2f}"
+            else:
+                item.status = "registered"
+                registered[j] = True
+                new_faces.append((i, embedding))
+                accepted.add(i, item.name, embedding)
+
+    ids = await face_search.register_faces(
+        session, [(report[i].name, embedding) for i, embedding in new_faces]
+    )
+    for (i, _), face_id in zip(new_faces, ids):
+        report[i].id = face_id
+    return BulkRegisterResponse(registered=len(ids), items=report)
 
 
 @app.post("/search")
 async def search_face(file: UploadFile = File(...)):
-    image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-        image.save(tmp_file.name)
-        tmp_path = tmp_file.name
-    # Feed image to DeepStream pipeline
-    image_cv, results = face_ds.run_image(tmp_path)
-    os.remove(tmp_path)
+    image_bytes = await read_upload(file)
+    # Feed image to the inference pipeline
+    image_cv, results = await infer_upload(image_bytes)
 
     if len(results) == 0:  # No faces detected
         raise HTTPException(
@@ -93,26 +603,303 @@ async def search_face(file: UploadFile = File(...)):
             detail="No face detected in the input image",
         )
 
-    for result in results:
-        draw_bbox(image_cv, result["bbox"], label=result["label"])
+    draw_detections(
+        image_cv,
+        [result["bbox"] for result in results],
+        [result["label"] for result in results],
+    )
 
     _, jpeg = cv2.imencode(".jpg", image_cv)
     return StreamingResponse(io.BytesIO(jpeg.tobytes()), media_type="image/jpeg")
 
 
-@app.post("/infer-video")
-async def infer_video(file: UploadFile):
-    input_path = f"/tmp/{file.filename}"
-    os.makedirs(f"assets/videos", exist_ok=True)
-    output_path = f"assets/videos/output.mp4"
-    with open(input_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+@app.post("/search/topk", response_model=TopKSearchResponse)
+async def search_face_topk(
+    file: UploadFile = File(...),
+    k: int = Query(5, ge=1, le=100),
+    max_distance: Optional[float] = Query(None, ge=0.0, le=2.0),
+    session: AsyncSession = Depends(get_session),
+):
+    """Up to k gallery candidates within `max_distance` (default: the
+    recognition threshold) for every face detected in the image"""
+    image_bytes = await read_upload(file)
+    _, results = await infer_upload(image_bytes)
+    if len(results) == 0:
+        raise HTTPException(
+            status_code=404,
+            detail="No face detected in the input image",
+        )
+
+    candidates = [
+        await face_search.search_async(session, result["embedding"], k, max_distance)
+        for result in results
+    ]
+    return TopKSearchResponse(
+        faces=[
+            TopKFace(
+                bbox=[int(v) for v in result["bbox"]],
+                candidates=[
+                    FaceCandidate(id=face_id, name=name, distance=distance)
+                    for distance, face_id, name in matches
+                ],
+            )
+            for result, matches in zip(results, candidates)
+        ]
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/cache/stats", response_model=MatchCacheStats)
+def match_cache_stats():
+    if face_search.cache is None:
+        raise HTTPException(status_code=404, detail="Match cache is disabled")
+    return MatchCacheStats(**face_search.cache.stats())
+
+
+def video_options(
+    target_fps: Optional[float] = Query(None, gt=0, le=120),
+    keyframes_only: bool = Query(False),
+    adaptive_interval: bool = Query(False),
+) -> dict:
+    """Frame sampling options of the video endpoints"""
+    return {
+        "target_fps": target_fps,
+        "keyframes_only": keyframes_only,
+        "adaptive_interval": adaptive_interval,
+    }
+
+
+def video_output_format(
+    output: str = Query("mp4", pattern="^(mp4|fmp4|hls)$"),
+) -> str:
+    """Annotated-video format: mp4, or fragmented MP4 / HLS (via ffmpeg),
+    which can be played while the video is still being processed"""
+    if output != "mp4" and not ffmpeg_available():
+        raise HTTPException(
+            status_code=503, detail=f"ffmpeg is required for {output} output"
+        )
+    return output
+
+
+def playlist_url(job) -> Optional[str]:
+    if job.output_format != "hls" or job.output_path is None:
+        return None
+    return f"/jobs/{job.id}/hls/{HLS_PLAYLIST}"
+
+
+async def wait_for_output(job):
+    """Wait until the job has written its first fragment / segment"""
+    while not job.done and not (
+        os.path.exists(job.output_path) and os.path.getsize(job.output_path) > 0
+    ):
+        await asyncio.sleep(VIDEO_FOLLOW_INTERVAL)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if not os.path.exists(job.output_path):
+        raise HTTPException(status_code=500, detail="Job produced no video")
 
-    face_ds.run_video(f"file://{input_path}", output_path)
-    os.remove(input_path)
+
+async def follow_output(job):
+    """The job's video file, including what is appended until the job ends"""
+    with open(job.output_path, "rb") as f:
+        while True:
+            done = job.done
+            chunk = await run_in_threadpool(f.read, VIDEO_STREAM_CHUNK)
+            if chunk:
+                yield chunk
+            elif done:
+                break
+            else:
+                await asyncio.sleep(VIDEO_FOLLOW_INTERVAL)
+
+
+async def video_response(job, output: str):
+    """The /infer-video response of `job`: its fragmented MP4 streamed while
+    it is written, its HLS playlist URL once the first segment exists, or
+    the MP4 once the job is done"""
+    if output == "fmp4":
+        await wait_for_output(job)
+        return StreamingResponse(
+            follow_output(job),
+            media_type="video/mp4",
+            headers={
+                "Content-Disposition": 'attachment; filename="inference_result.mp4"'
+            },
+        )
+    if output == "hls":
+        await wait_for_output(job)
+        return VideoJobResponse(
+            job_id=job.id, status=job.status, playlist_url=playlist_url(job)
+        )
+    await asyncio.wrap_future(job.future)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
 
     return FileResponse(
-        path=output_path,
+        path=job.output_path,
         media_type="video/mp4",
         filename="inference_result.mp4",  # suggested download name
     )
+
+
+@app.post("/infer-video", openapi_extra=VIDEO_UPLOAD_BODY)
+async def infer_video(
+    request: Request,
+    options: dict = Depends(video_options),
+    output: str = Depends(video_output_format),
+):
+    """Annotated video: with `output=fmp4` streamed fragment by fragment
+    while it is processed, with `output=hls` the playlist URL as soon as
+    the first segment is written; `mp4` returns once the video is done"""
+    input_path = await receive_upload(request)
+    job = video_jobs.submit(input_path, video_options=options, output_format=output)
+    return await video_response(job, output)
+
+
+@app.post("/infer-video/stream")
+async def infer_video_stream(
+    request: Request,
+    options: dict = Depends(video_options),
+    output: str = Depends(video_output_format),
+):
+    """/infer-video for a raw (not multipart) request body, decoded while it
+    is uploaded through a named pipe. The container must be readable front
+    to back: MKV, MPEG-TS, fragmented or faststart MP4"""
+    input_path = make_upload_fifo()
+    job = video_jobs.submit(input_path, video_options=options, output_format=output)
+    await feed_upload(request, input_path, job)
+    return await video_response(job, output)
+
+
+@app.post("/infer-video/detections", openapi_extra=VIDEO_UPLOAD_BODY)
+async def infer_video_detections(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+    options: dict = Depends(video_options),
+):
+    """Stream per-frame detection records while the video is processed,
+    without copying, annotating or encoding any frame"""
+    input_path = await receive_upload(request)
+    loop = asyncio.get_running_loop()
+    # Unbounded so the end-of-job None always gets in; push() bounds records
+    records = asyncio.Queue()
+
+    def push(record):
+        if records.qsize() < DETECTIONS_QUEUE_SIZE:
+            records.put_nowait(record)
+        else:
+            FRAMES_DROPPED.labels("stream_full").inc()
+
+    job = video_jobs.submit(
+        input_path,
+        write_video=False,
+        video_options=options,
+        on_detections=lambda record: loop.call_soon_threadsafe(push, record),
+    )
+    job.future.add_done_callback(
+        lambda _: loop.call_soon_threadsafe(records.put_nowait, None)
+    )
+
+    def encode(record):
+        if format == "sse":
+            event = "event: error\n" if "error" in record else ""
+            return f"{event}data: {json.dumps(record)}\n\n"
+        return json.dumps(record) + "\n"
+
+    async def stream():
+        try:
+            while True:
+                record = await records.get()
+                if record is None:
+                    break
+                yield encode(record)
+            if job.future.cancelled() or job.status == "failed":
+                yield encode({"error": job.error or "Video job was cancelled"})
+        finally:
+            # Client gone (or stream failed): the job has nobody to report to
+            if not job.future.done():
+                video_jobs.cancel(job, "Client disconnected")
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type)
+
+
+@app.post(
+    "/jobs/video",
+    response_model=VideoJobResponse,
+    status_code=202,
+    openapi_extra=VIDEO_UPLOAD_BODY,
+)
+async def create_video_job(
+    request: Request,
+    options: dict = Depends(video_options),
+    output: str = Depends(video_output_format),
+):
+    input_path = await receive_upload(request)
+    job = video_jobs.submit(input_path, video_options=options, output_format=output)
+    return VideoJobResponse(
+        job_id=job.id, status=job.status, playlist_url=playlist_url(job)
+    )
+
+
+@app.get("/jobs/{job_id}", response_model=VideoJobStatus)
+async def get_video_job(job_id: str):
+    job = video_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return VideoJobStatus(
+        job_id=job.id,
+        status=job.status,
+        frames_processed=job.frames_processed,
+        fps=job.fps,
+        error=job.error,
+        result_url=(
+            f"/jobs/{job.id}/result"
+            if job.status == "completed"
+            and job.output_path
+            and job.output_format != "hls"
+            else None
+        ),
+        playlist_url=playlist_url(job),
+    )
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_video_job_result(job_id: str):
+    job = video_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if job.output_path is None:
+        raise HTTPException(status_code=404, detail="Job produced no video")
+    if job.output_format == "hls":
+        raise HTTPException(status_code=404, detail="HLS output, see playlist_url")
+    return FileResponse(
+        path=job.output_path,
+        media_type="video/mp4",
+        filename="inference_result.mp4",
+    )
+
+
+@app.get("/jobs/{job_id}/hls/{name}")
+async def get_video_job_hls(job_id: str, name: str):
+    """Playlist and segments of an HLS job, available while it runs"""
+    job = video_jobs.get(job_id)
+    if job is None or playlist_url(job) is None:
+        raise HTTPException(status_code=404, detail="Job has no HLS output")
+    path = os.path.join(os.path.dirname(job.output_path), name)
+    if os.path.basename(name) != name or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Segment not found")
+    if name == HLS_PLAYLIST:
+        # The playlist grows until the job ends
+        return FileResponse(
+            path,
+            media_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "no-cache"},
+        )
+    return FileResponse(path, media_type="video/mp2t")
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from gallery import EMBEDDING_DIM, l2_normalize
+
+MATCH_CACHE_CAPACITY = 10000
+MATCH_CACHE_TTL = 300.0  # seconds
+# Cosine distance under which a cached query is considered the same face
+MATCH_CACHE_RADIUS = 0.05
+LSH_BITS = 16
+
+
+class MatchCache:
+    """LRU/TTL cache of gallery matches keyed by query embedding.
+
+    Queries are bucketed by random-hyperplane LSH; a lookup scans its own
+    bucket and the buckets one uncertain bit away, and reuses the face
+    matched by a cached query within `radius` cosine distance, its distance
+    recomputed against the stored gallery vector. Any change to the gallery
+    must call clear(), since it can change every nearest match.
+    """
+
+    def __init__(
+        self,
+        capacity: int = MATCH_CACHE_CAPACITY,
+        ttl: float = MATCH_CACHE_TTL,
+        radius: float = MATCH_CACHE_RADIUS,
+        bits: int = LSH_BITS,
+        probes: int = 4,
+        dim: int = EMBEDDING_DIM,
+        seed: int = 0,
+    ):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.radius = radius
+        self.probes = probes
+        self.planes = np.random.default_rng(seed).standard_normal(
+            (bits, dim), dtype=np.float32
+        )
+        self._weights = 1 << np.arange(bits, dtype=np.int64)
+        self._lock = threading.Lock()
+        # entry id -> (embedding, match, gallery vector, expires, key)
+        self._entries = OrderedDict()
+        self._buckets = {}  # key -> set of entry ids
+        self._next_id = 0
+        # Bumped by clear() so results computed before it are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _keys(self, embedding: np.ndarray):
+        projections = self.planes @ embedding
+        key = int((projections > 0) @ self._weights)
+        # Multi-probe: flip the bits whose hyperplane is closest to the query
+        flips = np.argsort(np.abs(projections))[: self.probes]
+        return key, [key] + [key ^ int(self._weights[bit]) for bit in flips]
+
+    def get(self, embedding: np.ndarray) -> Optional[Tuple]:
+        embedding = l2_normalize(embedding)
+        _, keys = self._keys(embedding)
+        now = time.monotonic()
+        with self._lock:
+            best, best_distance = None, self.radius
+            expired = []
+            for key in keys:
+                for entry_id in self._buckets.get(key, ()):
+                    cached, _, _, expires, _ = self._entries[entry_id]
+                    if expires < now:
+                        expired.append(entry_id)
+                        continue
+                    distance = 1.0 - float(cached @ embedding)
+                    if distance <= best_distance:
+                        best, best_distance = entry_id, distance
+            for entry_id in expired:
+                self._remove(entry_id)
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            _, match, vector, _, _ = self._entries[best]
+        if vector is None:
+            return match
+        return (1.0 - float(vector @ embedding), match[1], match[2])
+
+    def put(
+        self,
+        embedding: np.ndarray,
+        match: Tuple,
+        vector: Optional[np.ndarray],
+        generation: int,
+    ) -> None:
+        """Store `match` with the gallery vector of its face, unless the
+        gallery changed since `generation`"""
+        if match[1] is not None and vector is None:
+            return  # a hit could not recompute the distance
+        embedding = l2_normalize(embedding)
+        if vector is not None:
+            vector = l2_normalize(vector)
+        key, _ = self._keys(embedding)
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (
+                embedding,
+                match,
+                vector,
+                time.monotonic() + self.ttl,
+                key,
+            )
+            self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: int) -> None:
+        key = self._entries.pop(entry_id)[4]
+        self._buckets[key].discard(entry_id)
+        if not self._buckets[key]:
+            del self._buckets[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
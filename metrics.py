@@ -0,0 +1,89 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Seconds; from sub-millisecond probe work up to pipeline start-up
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "facerecog_http_request_seconds",
+    "HTTP request latency",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+PIPELINE_BUILD_SECONDS = Histogram(
+    "facerecog_pipeline_build_seconds",
+    "Time to create and link the elements of a pipeline",
+    ["pipeline"],
+    buckets=LATENCY_BUCKETS,
+)
+FIRST_BUFFER_SECONDS = Histogram(
+    "facerecog_first_buffer_seconds",
+    "Time from setting a pipeline to PLAYING to its first inferred buffer",
+    ["pipeline"],
+    buckets=LATENCY_BUCKETS,
+)
+PROBE_FRAME_SECONDS = Histogram(
+    "facerecog_probe_frame_seconds",
+    "Probe time per frame (frame copy and face/embedding capture)",
+    ["pipeline"],
+    buckets=LATENCY_BUCKETS,
+)
+POSTPROCESS_FRAME_SECONDS = Histogram(
+    "facerecog_postprocess_frame_seconds",
+    "Post-processing time per frame (matching, drawing, encoding, callbacks)",
+    ["pipeline"],
+    buckets=LATENCY_BUCKETS,
+)
+EMBEDDING_EXTRACTION_SECONDS = Histogram(
+    "facerecog_embedding_extraction_seconds",
+    "Time to read the faces and embeddings of one frame from its metadata",
+    buckets=LATENCY_BUCKETS,
+)
+MATCH_SECONDS = Histogram(
+    "facerecog_match_seconds",
+    "Gallery lookup latency per call",
+    ["backend"],
+    buckets=LATENCY_BUCKETS,
+)
+IMAGE_REQUEST_SECONDS = Histogram(
+    "facerecog_image_request_seconds",
+    "Persistent image pipeline latency, from submit to result",
+    buckets=LATENCY_BUCKETS,
+)
+FRAMES_PROCESSED = Counter(
+    "facerecog_frames_processed_total", "Frames that reached a probe", ["pipeline"]
+)
+FRAMES_DROPPED = Counter(
+    "facerecog_frames_dropped_total", "Frames dropped, by reason", ["reason"]
+)
+FACES_DETECTED = Counter(
+    "facerecog_faces_detected_total", "Faces detected", ["pipeline"]
+)
+FACES_RECOGNIZED = Counter(
+    "facerecog_faces_recognized_total",
+    "Faces matched to a registered identity",
+    ["pipeline"],
+)
+POSTPROCESS_QUEUE_DEPTH = Gauge(
+    "facerecog_postprocess_queue_depth",
+    "Batches waiting for a post-processing worker",
+    ["pipeline"],
+)
+MATCH_CACHE_LOOKUPS = Counter(
+    "facerecog_match_cache_lookups_total", "Match cache lookups", ["result"]
+)
@@ -0,0 +1,513 @@
+"""CPU inference backend: RetinaFace + WebFace R50 on ONNX Runtime.
+
+Mirrors what the DeepStream pipeline does on the GPU: letterboxed BGR
+detector input (retinaface.txt), the box/landmark decoding and NMS of
+nvdsparse_retinaface.cpp, the plain bbox crop of the shipped webface.txt
+(or, with ONNX_ALIGNMENT=arcface, the 5-point similarity alignment of the
+custom gst-nvinfer plugin, align_functions.cpp) and the normalized RGB
+112x112 recognizer input (webface.txt). Images are batched like on the GPU and run
+on a thread pool; ONNX Runtime releases the GIL while it runs.
+"""
+
+import os
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+from inference import (
+    ENGINE_MAX_BATCH_SIZE,
+    IMAGE_BATCH_SIZE,
+    IMAGE_BATCH_WINDOW_MS,
+    KEYFRAME_OUTPUT_FPS,
+    VIDEO_DEFAULT_FPS,
+    AdaptiveInterval,
+    FrameSampler,
+    ImageBatchScheduler,
+    InferenceBackend,
+    StreamOutputs,
+    frame_records,
+    match_batch_faces,
+    observe_frames,
+    video_postprocessor,
+)
+from metrics import (
+    EMBEDDING_EXTRACTION_SECONDS,
+    FIRST_BUFFER_SECONDS,
+    FRAMES_DROPPED,
+    PIPELINE_BUILD_SECONDS,
+)
+from tracker import UNTRACKED_OBJECT_ID
+
+ONNX_DETECTOR_MODEL = os.getenv(
+    "ONNX_DETECTOR_MODEL", "engine/primary/retinaface_mobilenet.onnx"
+)
+ONNX_RECOGNIZER_MODEL = os.getenv(
+    "ONNX_RECOGNIZER_MODEL",
+    "engine/secondary/webface_r50_dynamic_simplify_cleanup.onnx",
+)
+# Batches run concurrently; each session run gets cpu_count // workers
+# threads unless ONNX_INTRA_OP_THREADS is set
+ONNX_WORKERS = int(os.getenv("ONNX_WORKERS", "2"))
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+# "crop": plain bbox crop, as the shipped webface.txt (alignment-type
+# unset) does, so embeddings match a gallery registered on the GPU;
+# "arcface": 5-point alignment (gst-nvinfer alignment-type=1)
+ONNX_ALIGNMENT = os.getenv("ONNX_ALIGNMENT", "crop")
+
+DETECTOR_INPUT_SIZE = 640
+DETECTOR_OFFSETS = np.array([104.0, 117.0, 123.0], dtype=np.float32)  # BGR
+# Fixed in nvdsparse_retinaface.cpp
+DETECTOR_CONF_THRESHOLD = 0.25
+DETECTOR_NMS_THRESHOLD = 0.1
+DETECTOR_TOPK = 100
+ANCHOR_STEPS = (8, 16, 32)
+ANCHOR_MIN_SIZES = ((16, 32), (64, 128), (256, 512))
+RECOGNIZER_INPUT_SIZE = 112
+RECOGNIZER_BATCH_SIZE = 32
+# arcface_src of insightface's face_align.py, as in align_functions.cpp
+ARCFACE_LANDMARKS = np.array(
+    [
+        [38.2946, 51.6963],
+        [73.5318, 51.5014],
+        [56.0252, 71.7366],
+        [41.5493, 92.3655],
+        [70.7299, 92.2041],
+    ],
+    dtype=np.float32,
+)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def load_session(path, threads):
+    """ONNX Runtime CPU session of `path`, shared by every backend instance"""
+    with _sessions_lock:
+        session = _sessions.get(path)
+        if session is None:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"ONNX model not found: {path}")
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            session = ort.InferenceSession(
+                path, options, providers=["CPUExecutionProvider"]
+            )
+            _sessions[path] = session
+    return session
+
+
+def retinaface_anchors(width, height):
+    """(A, 4) normalized (cx, cy, sx, sy) priors, in the order of the
+    network outputs (create_anchor_retinaface)"""
+    anchors = []
+    for step, min_sizes in zip(ANCHOR_STEPS, ANCHOR_MIN_SIZES):
+        rows = int(np.ceil(height / step))
+        cols = int(np.ceil(width / step))
+        cy, cx = np.meshgrid(
+            (np.arange(rows) + 0.5) * step / height,
+            (np.arange(cols) + 0.5) * step / width,
+            indexing="ij",
+        )
+        # The anchors of one cell are adjacent in the outputs
+        level = np.empty((rows, cols, len(min_sizes), 4), dtype=np.float32)
+        level[..., 0] = cx[..., None]
+        level[..., 1] = cy[..., None]
+        level[..., 2] = np.array(min_sizes) / width
+        level[..., 3] = np.array(min_sizes) / height
+        anchors.append(level.reshape(-1, 4))
+    return np.concatenate(anchors)
+
+
+def letterbox(image, size):
+    """Resize keeping the aspect ratio and pad both sides to size x size
+    (maintain-aspect-ratio=1, symmetric-padding=1); returns the padded
+    image, the scale and the (x, y) padding"""
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height)
+    resized_w, resized_h = round(width * scale), round(height * scale)
+    pad_x, pad_y = (size - resized_w) // 2, (size - resized_h) // 2
+    padded = np.zeros((size, size, 3), dtype=np.uint8)
+    padded[pad_y : pad_y + resized_h, pad_x : pad_x + resized_w] = cv2.resize(
+        image, (resized_w, resized_h), interpolation=cv2.INTER_LINEAR
+    )
+    return padded, scale, (pad_x, pad_y)
+
+
+def nms(boxes, scores, threshold):
+    """Indices kept by greedy NMS, highest score first (inclusive-pixel
+    areas, as in nvdsparse_retinaface.cpp)"""
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(
+            0.0,
+            np.minimum(boxes[i, 2], boxes[rest, 2])
+            - np.maximum(boxes[i, 0], boxes[rest, 0])
+            + 1,
+        )
+        h = np.maximum(
+            0.0,
+            np.minimum(boxes[i, 3], boxes[rest, 3])
+            - np.maximum(boxes[i, 1], boxes[rest, 1])
+            + 1,
+        )
+        inter = w * h
+        overlap = inter / (areas[i] + areas[rest] - inter)
+        order = rest[overlap < threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def decode_detections(bbox, landmarks, conf, anchors, size):
+    """Boxes (N, 4 xyxy), scores (N,) and landmarks (N, 5, 2) in network
+    pixels from the raw outputs of one image"""
+    scores = conf[:, 1]
+    keep = scores > DETECTOR_CONF_THRESHOLD
+    bbox, landmarks, scores, anchors = (
+        bbox[keep],
+        landmarks[keep],
+        scores[keep],
+        anchors[keep],
+    )
+    centers = anchors[:, :2] + bbox[:, :2] * 0.1 * anchors[:, 2:]
+    sizes = anchors[:, 2:] * np.exp(bbox[:, 2:] * 0.2)
+    boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+    boxes = np.clip(boxes * size, 0, size - 1)
+    points = anchors[:, None, :2] + landmarks.reshape(-1, 5, 2) * (
+        0.1 * anchors[:, None, 2:]
+    )
+    points = np.round(points * size)
+
+    kept = nms(boxes, scores, DETECTOR_NMS_THRESHOLD)[:DETECTOR_TOPK]
+    return boxes[kept], scores[kept], points[kept]
+
+
+def similarity_transform(src, dst):
+    """2x3 least-squares similarity transform (rotation, uniform scale and
+    translation) taking the `src` points onto `dst` (Umeyama, 1991)"""
+    src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+    src_demean, dst_demean = src - src_mean, dst - dst_mean
+    covariance = dst_demean.T @ src_demean / len(src)
+    u, s, vt = np.linalg.svd(covariance)
+    d = np.ones(2)
+    if np.linalg.det(covariance) < 0:
+        d[-1] = -1
+    rotation = u @ np.diag(d) @ vt
+    scale = (s * d).sum() / src_demean.var(axis=0).sum()
+    translation = dst_mean - scale * rotation @ src_mean
+    return np.hstack([scale * rotation, translation[:, None]]).astype(np.float32)
+
+
+def align_face(image, bbox, landmarks):
+    """112x112 BGR recognizer input of one face"""
+    size = RECOGNIZER_INPUT_SIZE
+    # Like the plugin, fall back to the plain crop on unusable landmarks
+    valid = np.all(landmarks > 0) and np.all(np.ptp(landmarks, axis=0) > 0)
+    if ONNX_ALIGNMENT == "arcface" and valid:
+        matrix = similarity_transform(landmarks, ARCFACE_LANDMARKS)
+        return cv2.warpAffine(image, matrix, (size, size), borderValue=0)
+    x1, y1, x2, y2 = bbox
+    crop = image[y1 : max(y2, y1 + 1), x1 : max(x2, x1 + 1)]
+    return cv2.resize(crop, (size, size), interpolation=cv2.INTER_LINEAR)
+
+
+class DetectorInterval:
+    """nvinfer's `interval` for the CPU detector: the number of frames
+    skipped between two detections"""
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self._skipped = 0
+
+    def get_property(self, name):
+        return self.interval
+
+    def set_property(self, name, value):
+        self.interval = value
+
+    def due(self):
+        """Whether the next frame runs the detector"""
+        if self._skipped >= self.interval:
+            self._skipped = 0
+            return True
+        self._skipped += 1
+        return False
+
+
+class OnnxInference(InferenceBackend):
+    def __init__(
+        self,
+        detector_model=ONNX_DETECTOR_MODEL,
+        recognizer_model=ONNX_RECOGNIZER_MODEL,
+        workers=ONNX_WORKERS,
+        tracker=None,
+    ):
+        """`tracker` None matches every face; any other value tracks faces
+        with the IoU tracker, as there is no nvtracker on the CPU"""
+        super().__init__(tracker)
+        self.detector_model = detector_model
+        self.recognizer_model = recognizer_model
+        self.workers = workers
+        self.threads = ONNX_INTRA_OP_THREADS or max(1, (os.cpu_count() or 1) // workers)
+        self.detector = None
+        self.recognizer = None
+        self.anchors = retinaface_anchors(DETECTOR_INPUT_SIZE, DETECTOR_INPUT_SIZE)
+
+        self.executor = None
+        self.image_scheduler = None
+
+    def _load(self):
+        if self.detector is None:
+            self.detector = load_session(self.detector_model, self.threads)
+            self.recognizer = load_session(self.recognizer_model, self.threads)
+
+    def detect(self, images):
+        """(bboxes, landmarks) in image pixels for every BGR image, run as
+        one detector batch"""
+        inputs = []
+        transforms = []
+        for image in images:
+            padded, scale, pad = letterbox(image, DETECTOR_INPUT_SIZE)
+            inputs.append(padded.astype(np.float32) - DETECTOR_OFFSETS)
+            transforms.append((scale, np.array(pad, dtype=np.float32)))
+        batch = np.ascontiguousarray(np.stack(inputs).transpose(0, 3, 1, 2))
+        name = self.detector.get_inputs()[0].name
+        bbox, landmarks, conf = self.detector.run(
+            ["bbox", "lmk", "conf"], {name: batch}
+        )
+
+        results = []
+        for i, (image, (scale, pad)) in enumerate(zip(images, transforms)):
+            boxes, _, points = decode_detections(
+                bbox[i], landmarks[i], conf[i], self.anchors, DETECTOR_INPUT_SIZE
+            )
+            height, width = image.shape[:2]
+            boxes = (boxes - np.tile(pad, 2)) / scale
+            boxes = np.clip(boxes, 0, [width - 1, height - 1, width - 1, height - 1])
+            points = (points - pad) / scale
+            results.append(([list(map(int, box)) for box in boxes], points))
+        return results
+
+    def embed(self, crops):
+        """(N, 512) L2-normalized embeddings of 112x112 BGR crops"""
+        name = self.recognizer.get_inputs()[0].name
+        embeddings = []
+        for start in range(0, len(crops), RECOGNIZER_BATCH_SIZE):
+            batch = np.stack(crops[start : start + RECOGNIZER_BATCH_SIZE])
+            batch = (batch[..., ::-1].astype(np.float32) - 127.5) * 0.0078125
+            batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+            embeddings.append(self.recognizer.run(None, {name: batch})[0])
+        embeddings = np.concatenate(embeddings).astype(np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def infer_frames(self, images):
+        """Faces as (bbox, embedding, object_id) for every BGR image; all
+        faces of the batch go through the recognizer together"""
+        self._load()
+        detections = self.detect(images)
+        start = time.perf_counter()
+        crops = [
+            align_face(image, bbox, points)
+            for image, (bboxes, landmarks) in zip(images, detections)
+            for bbox, points in zip(bboxes, landmarks)
+        ]
+        embeddings = iter(self.embed(crops)) if crops else iter([])
+        if crops:
+            EMBEDDING_EXTRACTION_SECONDS.observe(
+                (time.perf_counter() - start) / len(images)
+            )
+        return [
+            [(bbox, next(embeddings), UNTRACKED_OBJECT_ID) for bbox in bboxes]
+            for bboxes, _ in detections
+        ]
+
+    def start_image_pipeline(
+        self,
+        batch_size=IMAGE_BATCH_SIZE,
+        batch_window_ms=IMAGE_BATCH_WINDOW_MS,
+        warmup=True,
+    ):
+        """Load both sessions and batch concurrent requests onto a pool of
+        `workers` threads"""
+        if self.image_scheduler is not None:
+            return
+        start = time.perf_counter()
+        self._load()
+        PIPELINE_BUILD_SECONDS.labels("image").observe(time.perf_counter() - start)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="onnx-image"
+        )
+        self.image_scheduler = ImageBatchScheduler(
+            lambda batch: self.executor.submit(self._infer_batch, batch),
+            batch_size=batch_size,
+            window_ms=batch_window_ms,
+        )
+        if warmup:
+            blank = np.zeros((DETECTOR_INPUT_SIZE, DETECTOR_INPUT_SIZE, 3), np.uint8)
+            self.infer_frames([blank])
+
+    def stop_image_pipeline(self):
+        if self.image_scheduler is None:
+            return
+        self.image_scheduler.close()
+        self.executor.shutdown(wait=True)
+        self.image_requests.fail_all(RuntimeError("Image pipeline stopped"))
+        self.image_scheduler = None
+        self.executor = None
+
+    def _infer_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            faces = self.infer_frames([image for image, _ in batch])
+            matches = match_batch_faces(faces)
+            recognized = 0
+            for (image, pts), frame_faces in zip(batch, faces):
+                records = frame_records(image, frame_faces, matches)
+                recognized += sum(record["existed"] for record in records[1:])
+                self.image_requests.resolve(pts, (image, records[1:]))
+        except Exception as e:
+            sys.stderr.write(f"Error: ONNX image batch failed: {e}\n")
+            for _, pts in batch:
+                self.image_requests.fail(pts, e)
+            return
+        observe_frames("image", faces, recognized, started)
+
+    def submit_image(self, image_bytes):
+        """Decode one encoded image on the host and queue it for the next
+        batch; resolves to (image_cv, results)"""
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Unsupported or corrupt image")
+        if self.image_scheduler is None:
+            raise RuntimeError("Image pipeline is not running")
+        pts, future = self.image_requests.register()
+        self.image_scheduler.submit(image, pts)
+        return pts, future
+
+    def run_image(self, image_path):
+        """Run inference on single image"""
+        image = cv2.imread(image_path) if os.path.isfile(image_path) else None
+        if image is None:
+            sys.stderr.write(f"ERROR: Image file not found: {image_path}\n")
+            return []
+        started = time.perf_counter()
+        faces = self.infer_frames([image])
+        records = frame_records(image, faces[0], match_batch_faces(faces))
+        recognized = sum(record["existed"] for record in records[1:])
+        observe_frames("image", faces, recognized, started)
+        return image, records[1:]
+
+    def run_video(
+        self,
+        uri,
+        output_path=None,
+        on_result=None,
+        target_fps=None,
+        keyframes_only=False,
+        adaptive_interval=False,
+        output_format="mp4",
+    ):
+        """Run inference on a video / stream decoded by OpenCV.
+
+        Same contract as DeepStreamInference.run_video. OpenCV cannot skip
+        non-key frames while decoding, so `keyframes_only` samples at
+        `target_fps` or KEYFRAME_OUTPUT_FPS instead. Detection of batch n
+        overlaps with decoding batch n + 1, and matching, drawing and
+        encoding run on the post-processing workers.
+        """
+        path = uri[len("file://") :] if uri.startswith("file://") else uri
+        if os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode):
+            # A pipe can be read once: no fallback to other backends, which
+            # would reopen it and wait for a writer forever
+            capture = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+        else:
+            capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise RuntimeError(f"Could not open video source: {uri}")
+        self._load()
+        source_fps = capture.get(cv2.CAP_PROP_FPS) or VIDEO_DEFAULT_FPS
+        if keyframes_only:
+            target_fps = target_fps or KEYFRAME_OUTPUT_FPS
+        output_fps = min(target_fps, source_fps) if target_fps else source_fps
+        size = (
+            int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
+        sampler = FrameSampler(target_fps)
+        detector = DetectorInterval()
+        outputs = StreamOutputs(
+            (lambda source_id: output_path) if output_path else None,
+            lambda source_id: output_fps,
+            size,
+            on_result=on_result,
+            recognizer=self._make_recognizer(),
+            interval=AdaptiveInterval(detector) if adaptive_interval else None,
+            output_format=output_format,
+        )
+        outputs.started_at = time.perf_counter()
+        post = video_postprocessor(outputs, live=not uri.startswith("file://"))
+
+        def read_batch():
+            """Up to ENGINE_MAX_BATCH_SIZE sampled frames as (frame_num,
+            timestamp, image, detect)"""
+            batch = []
+            while len(batch) < ENGINE_MAX_BATCH_SIZE:
+                ok, image = capture.read()
+                if not ok:
+                    break
+                frame_num = int(capture.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+                timestamp = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+                if not sampler.keep(timestamp):
+                    FRAMES_DROPPED.labels("sampling").inc()
+                    continue
+                batch.append((frame_num, timestamp, image, detector.due()))
+            return batch
+
+        def infer_batch(batch):
+            images = [image for _, _, image, detect in batch if detect]
+            faces = iter(self.infer_frames(images) if images else [])
+            return [next(faces) if detect else [] for _, _, _, detect in batch]
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            batch = read_batch()
+            pending = pool.submit(infer_batch, batch) if batch else None
+            try:
+                while pending is not None:
+                    next_batch = read_batch()
+                    faces = pending.result()
+                    pending = (
+                        pool.submit(infer_batch, next_batch) if next_batch else None
+                    )
+                    self._submit_batch(outputs, post, batch, faces)
+                    batch = next_batch
+            finally:
+                capture.release()
+                post.close()
+                outputs.release()
+
+    def _submit_batch(self, outputs, post, batch, faces):
+        if outputs.started_at is not None:
+            FIRST_BUFFER_SECONDS.labels("video").observe(
+                time.perf_counter() - outputs.started_at
+            )
+            outputs.started_at = None
+        if outputs.interval is not None:
+            outputs.interval.update(len(batch), any(faces))
+        post.submit(
+            [
+                (0, frame_num, timestamp, image if outputs.writes_video else None, f)
+                for (frame_num, timestamp, image, _), f in zip(batch, faces)
+            ],
+            frames=len(batch),
+        )
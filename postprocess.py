@@ -0,0 +1,138 @@
+"""Bounded worker stage between the pipelines and their CPU post-processing.
+
+Pad probes only capture frames and embeddings and submit them to a
+PostProcessor; its worker threads run matching, drawing and encoding, so
+the streaming thread goes straight back to feeding the GPU. OpenCV and
+ONNX Runtime release the GIL, so the work spreads over cores. Threads
+rather than processes, as frames would otherwise be pickled across.
+"""
+
+import os
+import queue
+import sys
+import threading
+
+from metrics import FRAMES_DROPPED, POSTPROCESS_QUEUE_DEPTH
+
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "4"))
+# Batches waiting for a worker before submit blocks (or drops, for live
+# sources)
+POSTPROCESS_QUEUE_SIZE = int(os.getenv("POSTPROCESS_QUEUE_SIZE", "8"))
+
+
+class Turnstile:
+    """Lets callers through one at a time, in sequence-number order"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next = 0
+
+    def wait(self, seq):
+        with self._cond:
+            while seq != self._next:
+                self._cond.wait()
+
+    def done(self):
+        with self._cond:
+            self._next += 1
+            self._cond.notify_all()
+
+
+class PostProcessor:
+    """Runs submitted items through `stages` on a pool of worker threads.
+
+    `stages` is a list of (function, ordered): each function receives the
+    result of the previous one. Items are numbered on submit and an ordered
+    stage runs them strictly in that order (tracking, writing a video);
+    the other stages run concurrently. The queue holds `queue_size` items:
+    when it is full, submit blocks, which stalls the pipeline upstream, or
+    with `drop_when_full` drops the item so a live source keeps its pace.
+    `on_error(item, exc)` is called when a stage raises.
+    """
+
+    def __init__(
+        self,
+        stages,
+        workers=POSTPROCESS_WORKERS,
+        queue_size=POSTPROCESS_QUEUE_SIZE,
+        drop_when_full=False,
+        on_error=None,
+        name="video",
+    ):
+        self.stages = stages
+        self.drop_when_full = drop_when_full
+        self.on_error = on_error
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._turnstiles = [Turnstile() if ordered else None for _, ordered in stages]
+        self._submit_lock = threading.Lock()
+        self._done = threading.Condition()
+        self._pending = set()
+        self._seq = 0
+        self._depth = POSTPROCESS_QUEUE_DEPTH.labels(name)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{name}-post-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item, frames=1):
+        """Queue `item`; returns False if it was dropped (`frames` is what
+        the drop counter is incremented by)"""
+        with self._submit_lock:
+            seq = self._seq
+            with self._done:
+                self._pending.add(seq)
+            try:
+                self.queue.put((seq, item), block=not self.drop_when_full)
+            except queue.Full:
+                with self._done:
+                    self._pending.discard(seq)
+                FRAMES_DROPPED.labels("postprocess_full").inc(frames)
+                return False
+            self._seq += 1
+        self._depth.inc()
+        return True
+
+    def flush(self):
+        """Wait until every item submitted so far has been processed"""
+        with self._submit_lock:
+            last = self._seq
+        with self._done:
+            while any(seq < last for seq in self._pending):
+                self._done.wait()
+
+    def close(self):
+        """Process what is queued, then stop the workers"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            self._depth.dec()
+            seq, item = entry
+            value, failed = item, False
+            for (stage, _), turnstile in zip(self.stages, self._turnstiles):
+                if turnstile is not None:
+                    turnstile.wait(seq)
+                try:
+                    if not failed:
+                        value = stage(value)
+                except Exception as e:
+                    failed = True
+                    sys.stderr.write(f"Error: {self.name} post-processing: {e}\n")
+                    if self.on_error is not None:
+                        self.on_error(item, e)
+                finally:
+                    # A failed item still passes every turnstile in turn
+                    if turnstile is not None:
+                        turnstile.done()
+            with self._done:
+                self._pending.discard(seq)
+                self._done.notify_all()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class RegisterFaceResponse(BaseModel):
@@ -7,5 +7,55 @@ class RegisterFaceResponse(BaseModel):
     name: str
 
 
+class BulkRegisterItem(BaseModel):
+    name: str
+    status: str  # registered | exists | duplicate | no_face | invalid
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
+
+class BulkRegisterResponse(BaseModel):
+    registered: int
+    items: List[BulkRegisterItem]
+
+
+class FaceCandidate(BaseModel):
+    id: str
+    name: str
+    distance: float
+
+
+class TopKFace(BaseModel):
+    bbox: List[int]
+    candidates: List[FaceCandidate]
+
+
+class TopKSearchResponse(BaseModel):
+    faces: List[TopKFace]
+
+
+class MatchCacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    hit_rate: float
+
+
 class VideoResponse(BaseModel):
     result_path: str
+
+
+class VideoJobResponse(BaseModel):
+    job_id: str
+    status: str
+    playlist_url: Optional[str] = None
+
+
+class VideoJobStatus(BaseModel):
+    job_id: str
+    status: str
+    frames_processed: int
+    fps: float
+    error: Optional[str] = None
+    result_url: Optional[str] = None
+    playlist_url: Optional[str] = None
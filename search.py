@@ -1,15 +1,31 @@
+import argparse
 import json
+import os
+import re
 from typing import List, Tuple, Optional
 
 import uuid
 import asyncio
+from datetime import timedelta
 import numpy as np
-from sqlalchemy import Column, String, text, create_engine
+from sqlalchemy import Column, DateTime, String, create_engine, func, insert, text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from pgvector.sqlalchemy import Vector
 
+from gallery import (
+    GalleryIndex,
+    GallerySnapshot,
+    IVFIndex,
+    SnapshotIndex,
+    ivf_params,
+    write_snapshot,
+)
+from match_cache import MatchCache
+from metrics import MATCH_CACHE_LOOKUPS, MATCH_SECONDS
+from shards import ShardedIndex
+
 
 Base = declarative_base()
 
@@ -20,28 +36,434 @@ class Face(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String)
     embedding = Column(Vector(512))
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
 
+DATABASE_URL_SYNC = os.getenv(
+    "DATABASE_URL_SYNC", "postgresql+psycopg2://postgres:123456789@db:5432/face_db"
+)
+DATABASE_URL_ASYNC = os.getenv(
+    "DATABASE_URL_ASYNC", "postgresql+asyncpg://postgres:123456789@db:5432/face_db"
+)
+# The API handlers share the async pool; the pipeline threads and startup
+# use a small, bounded sync pool of their own.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_SYNC_POOL_SIZE = int(os.getenv("DB_SYNC_POOL_SIZE", "4"))
 
-DATABASE_URL_SYNC = "postgresql+psycopg2://postgres:123456789@db:5432/face_db"
-engine_sync = create_engine(DATABASE_URL_SYNC)
+engine_sync = create_engine(
+    DATABASE_URL_SYNC,
+    pool_size=DB_SYNC_POOL_SIZE,
+    max_overflow=0,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
 SessionLocalSync = sessionmaker(bind=engine_sync)
 
+engine_async = create_async_engine(
+    DATABASE_URL_ASYNC,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+SessionLocalAsync = async_sessionmaker(engine_async, expire_on_commit=False)
+
+
+async def get_session():
+    """FastAPI dependency yielding a session from the async pool"""
+    async with SessionLocalAsync() as session:
+        yield session
+
+
+# Directory of a gallery snapshot to serve from instead of loading the table
+GALLERY_SNAPSHOT_DIR = os.getenv("GALLERY_SNAPSHOT_DIR", "")
+# created_at is the start of the inserting transaction, so a row committed
+# after a snapshot can be older than its watermark by as long as that
+# transaction ran: rows this far back are read again and deduplicated by id
+SNAPSHOT_OVERLAP_SECONDS = int(os.getenv("SNAPSHOT_OVERLAP_SECONDS", "600"))
+# pgvector index method ("ivfflat", "hnsw" or "none") and in-process
+# index ("flat" for exact search, "ivf" for the NumPy IVF engine,
+# "sharded" for exact search split across GALLERY_SHARDS worker processes,
+# "none" to answer every query from pgvector)
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "ivfflat")
+GALLERY_INDEX = os.getenv("GALLERY_INDEX", "flat")
+GALLERY_SHARDS = int(os.getenv("GALLERY_SHARDS", str(os.cpu_count() or 1)))
+VECTOR_INDEX_NAME = "idx_embedding"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+
+
+# Nearest k rows within :max_distance; the inner ORDER BY ... LIMIT is the
+# shape pgvector answers from its index.
+TOPK_SQL = text(
+    """
+    SELECT id, name, distance FROM (
+        SELECT id, name, embedding <=> (:query_vector)::vector AS distance
+        FROM faces
+        ORDER BY distance
+        LIMIT :k
+    ) candidates
+    WHERE distance <= :max_distance
+    ORDER BY distance
+"""
+)
+# Nearest row for every vector of a JSON array, in input order
+NEAREST_BATCH_SQL = text(
+    """
+    SELECT q.ord, m.id, m.name, m.distance, m.embedding
+    FROM jsonb_array_elements_text(CAST(:query_vectors AS jsonb))
+        WITH ORDINALITY AS q(vec, ord)
+    LEFT JOIN LATERAL (
+        SELECT id, name, embedding, embedding <=> q.vec::vector AS distance
+        FROM faces
+        ORDER BY distance
+        LIMIT 1
+    ) m ON true
+    ORDER BY q.ord
+"""
+).columns(embedding=Vector(512))
+
+
+def hnsw_ef_search(count: int) -> int:
+    """Candidate list size for HNSW queries, growing with the gallery"""
+    return min(400, max(40, 10 * int(np.log2(max(count, 2)))))
+
 
 class PGVectorFaceSearch:
-    def __init__(self, threshold: float = 0.5):
+    def __init__(
+        self,
+        threshold: float = 0.5,
+        index: Optional[GalleryIndex] = None,
+        cache: Optional[MatchCache] = None,
+    ):
         self.threshold = threshold
+        self.index = index
+        self.cache = cache
+        # Query-time knobs of the pgvector index, set by ensure_vector_index
+        self.probes = None
+        self.ef_search = None
 
-    def compare_face(self, encoding: np.ndarray) -> Optional[Tuple[float, str, str]]:
+    def ensure_vector_index(self, method: str = VECTOR_INDEX) -> None:
+        """Create the pgvector index on faces.embedding with the cosine
+        opclass matching `<=>`, sized from the current row count.
+
+        An ivfflat index is rebuilt only when its lists are off by more than
+        2x from the recommended value, so restarts stay cheap.
+        """
+        with engine_sync.begin() as conn:
+            count = conn.execute(text("SELECT count(*) FROM faces")).scalar()
+            current = conn.execute(
+                text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+                {"name": VECTOR_INDEX_NAME},
+            ).scalar()
+            opclass = f"USING {method} (embedding vector_cosine_ops)"
+            up_to_date = current is not None and opclass in current
+            if method == "ivfflat":
+                lists, _ = ivf_params(count)
+                built = re.search(r"lists='?(\d+)", current or "")
+                if (
+                    up_to_date
+                    and built
+                    and lists / 2 <= int(built.group(1)) <= lists * 2
+                ):
+                    lists = int(built.group(1))
+                else:
+                    up_to_date = False
+                self.probes = max(1, int(np.sqrt(lists)))
+                options = f"lists = {lists}"
+            elif method == "hnsw":
+                self.ef_search = hnsw_ef_search(count)
+                options = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+            else:
+                up_to_date = current is None
+
+            if up_to_date:
+                return
+            conn.execute(text(f"DROP INDEX IF EXISTS {VECTOR_INDEX_NAME}"))
+            if method in ("ivfflat", "hnsw"):
+                conn.execute(
+                    text(
+                        f"CREATE INDEX {VECTOR_INDEX_NAME} ON faces "
+                        f"{opclass} WITH ({options})"
+                    )
+                )
+
+    def _tuning_statements(self):
+        """SET LOCAL statements for the index query knobs"""
+        statements = []
+        if self.probes is not None:
+            statements.append(text(f"SET LOCAL ivfflat.probes = {self.probes}"))
+        if self.ef_search is not None:
+            statements.append(text(f"SET LOCAL hnsw.ef_search = {self.ef_search}"))
+        return statements
+
+    def _tune_session(self, session: Session) -> None:
+        """Apply the index query knobs to the current transaction"""
+        for statement in self._tuning_statements():
+            session.execute(statement)
+
+    def load_index(self, kind: str = GALLERY_INDEX) -> int:
+        """Mirror the `faces` table into an in-process index; with "none"
+        no index is kept and queries go to pgvector"""
+        if kind == "none":
+            self._set_index(None)
+            return 0
+        if kind == "sharded":
+            index = ShardedIndex(GALLERY_SHARDS)
+        else:
+            index = IVFIndex() if kind == "ivf" else GalleryIndex()
+        with SessionLocalSync() as session:
+            rows = session.query(Face.id, Face.name, Face.embedding).yield_per(10000)
+            count = index.load(rows)
+        self._set_index(index)
+        return count
+
+    def load_snapshot(self, path: str) -> int:
+        """Serve from a memory-mapped snapshot plus the rows it lacks, which
+        are loaded into an in-memory delta index"""
+        snapshot = GallerySnapshot(path)
+        delta = GalleryIndex(snapshot.vectors.shape[1])
+        with SessionLocalSync() as session:
+            query = session.query(Face.id, Face.name, Face.embedding)
+            if snapshot.watermark is not None:
+                since = snapshot.watermark - timedelta(seconds=SNAPSHOT_OVERLAP_SECONDS)
+                query = query.filter(Face.created_at > since)
+            rows = query.all()
+        known = np.isin([str(face_id) for face_id, _, _ in rows], snapshot.ids)
+        delta.load(row for row, seen in zip(rows, known) if not seen)
+        self._set_index(SnapshotIndex(snapshot, delta))
+        return len(self.index)
+
+    def write_snapshot(self, path: str, dtype: str = "int8") -> int:
+        """Dump the `faces` table into a quantized snapshot directory"""
         with SessionLocalSync() as session:
-            sql = text(
-                """
-                SELECT id, name, embedding <=> (:query_vector)::vector AS distance
-                FROM faces
-                ORDER BY distance
-            """
+            # The count, the watermark and the rows come from one snapshot
+            session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            count, watermark = session.query(
+                func.count(Face.id), func.max(Face.created_at)
+            ).one()
+            rows = (
+                session.query(Face.id, Face.name, Face.embedding)
+                .order_by(Face.created_at)
+                .yield_per(10000)
             )
-            vector_str = json.dumps(encoding.tolist())
-            match = session.execute(sql, {"query_vector": vector_str}).fetchone()
-            if match:
-                return match.distance, str(match.id), match.name
-        return None, None, None
+            return write_snapshot(path, rows, count, dtype, watermark)
+
+    def _set_index(self, index) -> None:
+        """Serve from `index`, stopping the workers of a sharded one it
+        replaces"""
+        previous, self.index = self.index, index
+        if self.cache is not None:
+            self.cache.clear()
+        if isinstance(previous, ShardedIndex):
+            previous.close()
+
+    def close(self) -> None:
+        """Stop the worker processes of a sharded index"""
+        if isinstance(self.index, ShardedIndex):
+            self.index.close()
+
+    def add_faces(self, faces) -> None:
+        """Keep the in-process index in sync with newly inserted
+        (id, name, embedding) rows"""
+        if self.index is not None:
+            for face_id, name, embedding in faces:
+                self.index.add(face_id, name, embedding)
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def register_faces(
+        self, session: AsyncSession, faces: List[Tuple[str, np.ndarray]]
+    ) -> List[str]:
+        """Insert (name, embedding) rows in one transaction via executemany"""
+        rows = [
+            {"id": uuid.uuid4(), "name": name, "embedding": embedding.tolist()}
+            for name, embedding in faces
+        ]
+        if rows:
+            async with session.begin():
+                await session.execute(insert(Face), rows)
+        # An IVF add can retrain and a sharded add waits on its worker, so
+        # the index is updated off the event loop like the searches
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.add_faces,
+            [
+                (row["id"], name, embedding)
+                for row, (name, embedding) in zip(rows, faces)
+            ],
+        )
+        return [str(row["id"]) for row in rows]
+
+    def _search_params(self, embedding, k, max_distance):
+        return {
+            "query_vector": json.dumps(np.asarray(embedding).tolist()),
+            "k": k,
+            "max_distance": self.threshold if max_distance is None else max_distance,
+        }
+
+    def _search_index(self, embedding, k, max_distance):
+        if max_distance is None:
+            max_distance = self.threshold
+        with MATCH_SECONDS.labels("index").time():
+            matches = self.index.search(embedding, k)
+        return [match for match in matches if match[0] <= max_distance]
+
+    def search(
+        self, embedding: np.ndarray, k: int = 1, max_distance: Optional[float] = None
+    ) -> List[Tuple[float, str, str]]:
+        """Up to k (distance, id, name) matches within `max_distance`
+        (default: self.threshold), closest first.
+
+        pgvector only uses its index for `ORDER BY distance LIMIT k`, so the
+        distance predicate is applied to that bounded result.
+        """
+        if self.index is not None:
+            return self._search_index(embedding, k, max_distance)
+
+        with MATCH_SECONDS.labels("pgvector").time(), SessionLocalSync() as session:
+            self._tune_session(session)
+            params = self._search_params(embedding, k, max_distance)
+            rows = session.execute(TOPK_SQL, params).fetchall()
+        return [(row.distance, str(row.id), row.name) for row in rows]
+
+    async def search_async(
+        self,
+        session: AsyncSession,
+        embedding: np.ndarray,
+        k: int = 1,
+        max_distance: Optional[float] = None,
+    ) -> List[Tuple[float, str, str]]:
+        """search() for the API handlers, on the async connection pool"""
+        if self.index is not None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._search_index, embedding, k, max_distance
+            )
+
+        with MATCH_SECONDS.labels("pgvector").time():
+            async with session.begin():
+                for statement in self._tuning_statements():
+                    await session.execute(statement)
+                params = self._search_params(embedding, k, max_distance)
+                rows = (await session.execute(TOPK_SQL, params)).fetchall()
+        return [(row.distance, str(row.id), row.name) for row in rows]
+
+    def compare_face(self, encoding: np.ndarray) -> Optional[Tuple[float, str, str]]:
+        """Nearest registered face whatever its distance"""
+        return self.compare_faces(encoding)[0]
+
+    def is_match(self, distance: Optional[float]) -> bool:
+        return distance is not None and distance <= self.threshold
+
+    def _cache_lookup(self, encodings):
+        """(results with None for cache misses, miss rows, cache generation)"""
+        if self.cache is None:
+            return [None] * len(encodings), list(range(len(encodings))), 0
+        generation = self.cache.generation
+        results = [self.cache.get(encoding) for encoding in encodings]
+        misses = [i for i, result in enumerate(results) if result is None]
+        MATCH_CACHE_LOOKUPS.labels("hit").inc(len(results) - len(misses))
+        MATCH_CACHE_LOOKUPS.labels("miss").inc(len(misses))
+        return results, misses, generation
+
+    def _cache_fill(self, encodings, results, misses, matches, vectors, generation):
+        for i, match, vector in zip(misses, matches, vectors):
+            results[i] = match
+            if self.cache is not None:
+                self.cache.put(encodings[i], match, vector, generation)
+        return results
+
+    def _compare_index(self, encodings):
+        """(nearest matches, their gallery vectors for the match cache)"""
+        with MATCH_SECONDS.labels("index").time():
+            batch = self.index.search_batch(encodings, k=1)
+        matches = [found[0] if found else (None, None, None) for found in batch]
+        vectors = [None] * len(matches)
+        if self.cache is not None:
+            for i, (_, face_id, _) in enumerate(matches):
+                try:
+                    vectors[i] = None if face_id is None else self.index.vector(face_id)
+                except KeyError:
+                    pass  # gone since the search: the cache is cleared anyway
+        return matches, vectors
+
+    def compare_faces(
+        self, encodings: np.ndarray
+    ) -> List[Tuple[Optional[float], Optional[str], Optional[str]]]:
+        """Nearest registered face for every row of an (N, 512) matrix.
+
+        Served from the match cache when possible; the misses are resolved
+        with one matrix product against the in-process index, or a single
+        LATERAL query against pgvector when no index is loaded.
+        """
+        encodings = np.atleast_2d(encodings)
+        if len(encodings) == 0:
+            return []
+        results, misses, generation = self._cache_lookup(encodings)
+        if not misses:
+            return results
+        if self.index is not None:
+            matches, vectors = self._compare_index(encodings[misses])
+        else:
+            with MATCH_SECONDS.labels("pgvector").time(), SessionLocalSync() as session:
+                self._tune_session(session)
+                vectors_str = json.dumps(encodings[misses].tolist())
+                rows = session.execute(
+                    NEAREST_BATCH_SQL, {"query_vectors": vectors_str}
+                ).fetchall()
+            matches = self._rows_to_matches(rows)
+            vectors = [row.embedding if row.id else None for row in rows]
+        return self._cache_fill(
+            encodings, results, misses, matches, vectors, generation
+        )
+
+    async def compare_faces_async(
+        self, session: AsyncSession, encodings: np.ndarray
+    ) -> List[Tuple[Optional[float], Optional[str], Optional[str]]]:
+        """compare_faces() for the API handlers, on the async connection pool"""
+        encodings = np.atleast_2d(encodings)
+        if len(encodings) == 0:
+            return []
+        results, misses, generation = self._cache_lookup(encodings)
+        if not misses:
+            return results
+        if self.index is not None:
+            matches, vectors = await asyncio.get_running_loop().run_in_executor(
+                None, self._compare_index, encodings[misses]
+            )
+        else:
+            with MATCH_SECONDS.labels("pgvector").time():
+                async with session.begin():
+                    for statement in self._tuning_statements():
+                        await session.execute(statement)
+                    vectors_str = json.dumps(encodings[misses].tolist())
+                    result = await session.execute(
+                        NEAREST_BATCH_SQL, {"query_vectors": vectors_str}
+                    )
+                    rows = result.fetchall()
+            matches = self._rows_to_matches(rows)
+            vectors = [row.embedding if row.id else None for row in rows]
+        return self._cache_fill(
+            encodings, results, misses, matches, vectors, generation
+        )
+
+    @staticmethod
+    def _rows_to_matches(rows):
+        return [
+            (row.distance, str(row.id), row.name) if row.id else (None, None, None)
+            for row in rows
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gallery maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="Write a quantized, memory-mappable gallery snapshot"
+    )
+    snapshot_parser.add_argument("--out", required=True)
+    snapshot_parser.add_argument("--dtype", choices=["int8", "float16"], default="int8")
+    args = parser.parse_args()
+
+    written = PGVectorFaceSearch().write_snapshot(args.out, args.dtype)
+    print(f"Wrote {written} faces to {args.out}")
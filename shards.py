@@ -0,0 +1,445 @@
+"""Gallery sharded across local worker processes.
+
+Rows are assigned to shards by rendezvous hashing of the face id. Every
+shard keeps its L2-normalized vectors in a shared-memory segment that a
+worker process of its own searches exactly; a query is sent to all shards
+at once and their top-k lists are merged, so search throughput scales with
+the cores of the machine. Workers only see (attach, search, stop) messages
+on a pipe, the same shape a remote shard would be driven with; requests
+carry an id echoed by the reply, so searches from several threads are in
+flight on a shard at once. Adding a
+shard moves just the rows whose hash now prefers it (about 1/N of them).
+"""
+
+import os
+import itertools
+import signal
+import threading
+import weakref
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple
+
+import numpy as np
+
+from gallery import (
+    EMBEDDING_DIM,
+    INITIAL_CAPACITY,
+    RowLookup,
+    l2_normalize,
+    top_k_rows,
+)
+
+# BLAS threads per worker: each shard is one core's worth of work
+SHARD_WORKER_THREADS = os.getenv("SHARD_WORKER_THREADS", "1")
+SHARD_STOP_TIMEOUT = 5
+_BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+_GOLDEN = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+
+def id_hashes(ids) -> np.ndarray:
+    """Stable 64-bit hash of every face id (crc32 of its string form)"""
+    return np.fromiter(
+        (zlib.crc32(str(face_id).encode()) for face_id in ids),
+        dtype=np.uint64,
+        count=len(ids),
+    )
+
+
+def shard_scores(hashes: np.ndarray, shard: int) -> np.ndarray:
+    """Rendezvous weight of every id hash for `shard` (splitmix64 mix)"""
+    x = hashes ^ np.uint64(((shard + 1) * _GOLDEN) & _MASK)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def assign_shards(hashes: np.ndarray, shards: int) -> np.ndarray:
+    """Owning shard of every id hash: the shard with the highest weight"""
+    owner = np.zeros(len(hashes), dtype=np.int64)
+    best = shard_scores(hashes, 0)
+    for shard in range(1, shards):
+        scores = shard_scores(hashes, shard)
+        better = scores > best
+        owner[better] = shard
+        best = np.where(better, scores, best)
+    return owner
+
+
+def _shard_worker(conn, dim: int) -> None:
+    """Serve one shard until ("stop",) or the parent goes away"""
+    # Ctrl-C reaches the whole process group; the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    segment, vectors = None, None
+    while True:
+        try:
+            request_id, message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == "stop":
+            break
+        try:
+            if message[0] == "search":
+                _, size, queries, k = message
+                distances = 1.0 - queries @ vectors[:size].T
+                top = top_k_rows(distances, k)
+                reply = (np.take_along_axis(distances, top, axis=1), top)
+            else:
+                _, name, capacity = message
+                vectors = None
+                if segment is not None:
+                    segment.close()
+                segment = SharedMemory(name=name)
+                vectors = np.ndarray((capacity, dim), np.float32, buffer=segment.buf)
+                reply = None
+        except Exception as e:
+            reply = e
+        conn.send((request_id, reply))
+    vectors = None
+    if segment is not None:
+        segment.close()
+
+
+@contextmanager
+def _worker_environment():
+    """Limit BLAS threads in the environment spawned workers inherit"""
+    saved = {name: os.environ.get(name) for name in _BLAS_THREAD_VARS}
+    os.environ.update(dict.fromkeys(_BLAS_THREAD_VARS, SHARD_WORKER_THREADS))
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class _Shard:
+    """Parent side of one shard: its segment, row labels and worker.
+
+    A reader thread hands every reply to the future of its request.
+    `lock` serializes sends on the worker pipe and guards the fields below
+    it; a request sent under it sees the content they describe, since the
+    worker handles its messages in order.
+    """
+
+    def __init__(self, context, dim: int):
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.conn, child = context.Pipe()
+        # Spawned, not forked: the parent runs GStreamer and executor threads
+        with _worker_environment():
+            self.process = context.Process(
+                target=_shard_worker, args=(child, dim), daemon=True
+            )
+            self.process.start()
+        child.close()
+        self._pending = {}  # request id -> Future
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._closed = False
+        self._reader = threading.Thread(
+            target=self._read_replies, name="shard-reader", daemon=True
+        )
+        self._reader.start()
+        self.segment = None
+        self.vectors = None
+        self.ids = []
+        self.names = []
+        self.size = 0
+        self.rows = RowLookup()
+
+    def submit(self, message) -> Future:
+        """Send `message` (`lock` held) and return the future of its reply"""
+        future = Future()
+        with self._pending_lock:
+            if self._closed:
+                raise RuntimeError("Shard worker is gone")
+            request_id = next(self._request_ids)
+            self._pending[request_id] = future
+        try:
+            self.conn.send((request_id, message))
+        except BaseException:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def request(self, message):
+        return self.submit(message).result()
+
+    def _read_replies(self) -> None:
+        while True:
+            try:
+                request_id, reply = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(request_id)
+            if isinstance(reply, Exception):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+        with self._pending_lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("Shard worker is gone"))
+
+    def attach(self, segment, vectors, ids, names) -> None:
+        """Point the worker at a new segment and drop the old one"""
+        self.request(("attach", segment.name, len(vectors)))
+        self.release()
+        self.segment, self.vectors = segment, vectors
+        self.ids, self.names, self.size = ids, names, len(ids)
+
+    def release(self) -> None:
+        if self.segment is not None:
+            self.vectors = None
+            _free(self.segment)
+            self.segment = None
+
+    def stop(self) -> None:
+        with self.lock:
+            try:
+                self.conn.send((None, ("stop",)))
+            except OSError:
+                pass
+            self.process.join(SHARD_STOP_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+            # The worker's end closes with it, which ends the reader
+            self._reader.join(SHARD_STOP_TIMEOUT)
+            self.conn.close()
+            self.release()
+
+
+def _allocate(rows: int, dim: int):
+    """(segment, vectors) for a zeroed shared (rows, dim) float32 matrix"""
+    segment = SharedMemory(create=True, size=rows * dim * 4)
+    vectors = np.ndarray((rows, dim), np.float32, buffer=segment.buf)
+    vectors[:] = 0
+    return segment, vectors
+
+
+def _free(segment) -> None:
+    segment.close()
+    segment.unlink()
+
+
+def _stop_shards(shards) -> None:
+    for shard in shards:
+        shard.stop()
+
+
+class ShardedIndex:
+    """GalleryIndex-compatible exact search over `shards` worker processes"""
+
+    def __init__(self, shards: int, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self._context = get_context("spawn")
+        # Serializes writers (add, load, add_shard); searches only take the
+        # shard locks, always in shard order, while sending their queries.
+        self._lock = threading.Lock()
+        self._started = []
+        self._finalizer = weakref.finalize(self, _stop_shards, self._started)
+        self._shards = ()
+        layout = tuple(self._start_shard() for _ in range(max(1, shards)))
+        self._publish(layout, [self._layout() for _ in layout])
+
+    def __len__(self):
+        return sum(shard.size for shard in self._shards)
+
+    @property
+    def shards(self) -> int:
+        return len(self._shards)
+
+    def _start_shard(self) -> _Shard:
+        shard = _Shard(self._context, self.dim)
+        self._started.append(shard)
+        return shard
+
+    def _layout(self, vectors=None, ids=(), names=()):
+        """New shard content: vectors are copied into a fresh segment"""
+        count = len(ids)
+        segment, shared = _allocate(max(count, INITIAL_CAPACITY), self.dim)
+        if count:
+            shared[:count] = vectors
+        return segment, shared, list(ids), list(names)
+
+    @contextmanager
+    def _locked(self, shards):
+        acquired = []
+        try:
+            for shard in shards:
+                shard.lock.acquire()
+                acquired.append(shard)
+            yield
+        finally:
+            for shard in acquired:
+                shard.lock.release()
+
+    def _publish(self, shards, layouts) -> None:
+        """Swap every shard's content and the shard list as one step"""
+        with self._locked(shards):
+            attached = 0
+            try:
+                for shard, layout in zip(shards, layouts):
+                    shard.attach(*layout)
+                    attached += 1
+            except BaseException:
+                for segment, _, _, _ in layouts[attached:]:
+                    _free(segment)
+                raise
+            self._shards = shards
+
+    def load(self, rows) -> int:
+        """Replace the index content with (id, name, embedding) rows"""
+        rows = list(rows)
+        return self.load_arrays(
+            [face_id for face_id, _, _ in rows],
+            [name for _, name, _ in rows],
+            np.array([embedding for _, _, embedding in rows], dtype=np.float32),
+        )
+
+    def load_arrays(self, ids, names, embeddings: np.ndarray) -> int:
+        """Replace the index content with parallel id/name/embedding arrays"""
+        ids = [str(face_id) for face_id in ids]
+        names = list(names)
+        with self._lock:
+            shards = self._shards
+            owner = assign_shards(id_hashes(ids), len(shards))
+            layouts = []
+            for i in range(len(shards)):
+                rows = np.nonzero(owner == i)[0]
+                layouts.append(
+                    self._layout(
+                        l2_normalize(embeddings[rows]),
+                        [ids[row] for row in rows],
+                        [names[row] for row in rows],
+                    )
+                )
+            self._publish(shards, layouts)
+        return len(ids)
+
+    def add(self, face_id, name: str, embedding: np.ndarray) -> None:
+        """Append one registered face to its shard, growing the segment
+        geometrically"""
+        face_id = str(face_id)
+        with self._lock:
+            shards = self._shards
+            shard = shards[assign_shards(id_hashes([face_id]), len(shards))[0]]
+            with shard.lock:
+                if shard.size == len(shard.vectors):
+                    segment, vectors = _allocate(2 * shard.size, self.dim)
+                    vectors[: shard.size] = shard.vectors
+                    shard.attach(segment, vectors, shard.ids, shard.names)
+                # Rows at or above `size` are not searched until it grows
+                shard.vectors[shard.size] = l2_normalize(embedding)
+                shard.ids.append(face_id)
+                shard.names.append(name)
+                shard.size += 1
+
+    def add_shard(self) -> int:
+        """Start one more worker and move to it the rows it now owns;
+        returns the number of rows moved"""
+        with self._lock:
+            old = self._shards
+            count = len(old) + 1
+            layouts = []
+            moved = []
+            for shard in old:
+                # Shard content only changes under self._lock
+                ids, names = shard.ids, shard.names
+                moves = assign_shards(id_hashes(ids), count) == count - 1
+                keep, move = np.nonzero(~moves)[0], np.nonzero(moves)[0]
+                layouts.append(
+                    self._layout(
+                        shard.vectors[keep],
+                        [ids[row] for row in keep],
+                        [names[row] for row in keep],
+                    )
+                )
+                moved.append(
+                    (
+                        shard.vectors[move],
+                        [ids[row] for row in move],
+                        [names[row] for row in move],
+                    )
+                )
+            layouts.append(
+                self._layout(
+                    np.concatenate([vectors for vectors, _, _ in moved]),
+                    [face_id for _, ids, _ in moved for face_id in ids],
+                    [name for _, _, names in moved for name in names],
+                )
+            )
+            self._publish(old + (self._start_shard(),), layouts)
+        return len(layouts[-1][2])
+
+    def _acquire_layout(self):
+        """Current shard list with all of its locks held"""
+        while True:
+            shards = self._shards
+            for shard in shards:
+                shard.lock.acquire()
+            if shards is self._shards:
+                return shards
+            # A shard was added meanwhile
+            for shard in shards:
+                shard.lock.release()
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int = 1
+    ) -> List[List[Tuple[float, str, str]]]:
+        """Top-k matches for each row of an (N, dim) query matrix: every
+        shard scores its rows in parallel, the per-shard top-k are merged"""
+        queries = l2_normalize(np.atleast_2d(embeddings))
+        # The locks only keep a layout swap from landing between the sends;
+        # the replies are awaited without them
+        held = self._acquire_layout()
+        try:
+            sent = [
+                (
+                    shard.submit(("search", shard.size, queries, k)),
+                    shard.ids,
+                    shard.names,
+                )
+                for shard in held
+                if shard.size
+            ]
+        finally:
+            for shard in held:
+                shard.lock.release()
+        replies = [(future.result(), ids, names) for future, ids, names in sent]
+
+        merged = [[] for _ in range(len(queries))]
+        for (distances, top), ids, names in replies:
+            for found, best, rows in zip(merged, distances, top):
+                found.extend(
+                    (float(distance), ids[row], names[row])
+                    for distance, row in zip(best, rows)
+                )
+        return [sorted(found, key=lambda match: match[0])[:k] for found in merged]
+
+    def search(self, embedding: np.ndarray, k: int = 1) -> List[Tuple[float, str, str]]:
+        return self.search_batch(embedding, k)[0]
+
+    def vector(self, face_id) -> np.ndarray:
+        """Normalized embedding of a registered face; KeyError if unknown"""
+        face_id = str(face_id)
+        shards = self._shards
+        shard = shards[assign_shards(id_hashes([face_id]), len(shards))[0]]
+        # The lock keeps the segment attached while the row is copied
+        with shard.lock:
+            row = shard.rows.row(shard.ids, shard.size, face_id)
+            return shard.vectors[row].copy()
+
+    def close(self) -> None:
+        """Stop the workers and free the shared segments"""
+        self._finalizer()
@@ -0,0 +1,158 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# obj_meta.object_id of objects that no nvtracker has seen
+UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU of two (N, 4) / (M, 4) xyxy box arrays"""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+class IoUTracker:
+    """Greedy IoU tracker used when no nvtracker is in the pipeline"""
+
+    def __init__(self, iou_threshold: float = 0.3, max_age: int = 15):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.next_id = 0
+        self.tracks: Dict[int, Tuple[List[int], int]] = {}  # id -> (bbox, age)
+
+    def update(self, bboxes: List[List[int]]) -> List[int]:
+        """Assign a track id to each bbox of the current frame"""
+        track_ids = list(self.tracks)
+        assigned = [-1] * len(bboxes)
+        if track_ids and bboxes:
+            previous = [self.tracks[i][0] for i in track_ids]
+            ious = iou_matrix(bboxes, previous)
+            # Highest overlaps first; each track and each box used once.
+            for flat in np.argsort(-ious, axis=None):
+                row, col = np.unravel_index(flat, ious.shape)
+                if ious[row, col] < self.iou_threshold:
+                    break
+                if assigned[row] == -1 and track_ids[col] not in assigned:
+                    assigned[row] = track_ids[col]
+
+        for i, bbox in enumerate(bboxes):
+            if assigned[i] == -1:
+                assigned[i] = self.next_id
+                self.next_id += 1
+            self.tracks[assigned[i]] = (bbox, 0)
+        for track_id in track_ids:
+            if track_id not in assigned:
+                bbox, age = self.tracks[track_id]
+                if age + 1 > self.max_age:
+                    del self.tracks[track_id]
+                else:
+                    self.tracks[track_id] = (bbox, age + 1)
+        return assigned
+
+
+class TrackIdentityCache:
+    """Last match of every track, reused until it needs refreshing.
+
+    A cached match is served unless the track is new, the refresh interval
+    has expired, or the match distance lies within `ambiguity_margin` of the
+    recognition threshold (i.e. the identity confidence is low).
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        refresh_frames: int = 30,
+        ambiguity_margin: float = 0.05,
+        max_idle_frames: int = 150,
+    ):
+        self.threshold = threshold
+        self.refresh_frames = refresh_frames
+        self.ambiguity_margin = ambiguity_margin
+        self.max_idle_frames = max_idle_frames
+        self.entries = {}  # key -> (match, matched_at, last_seen)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, frame_num: int) -> Optional[Tuple]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            match, matched_at, _ = entry
+            distance = match[0]
+            confident = (
+                distance is None
+                or abs(distance - self.threshold) > self.ambiguity_margin
+            )
+            if confident and 0 <= frame_num - matched_at < self.refresh_frames:
+                self.entries[key] = (match, matched_at, frame_num)
+                self.hits += 1
+                return match
+        self.misses += 1
+        return None
+
+    def put(self, key, match: Tuple, frame_num: int) -> None:
+        self.entries[key] = (match, frame_num, frame_num)
+
+    def prune(self, source_id, frame_num: int) -> None:
+        """Forget tracks of a source not seen for max_idle_frames"""
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items()
+            if key[0] != source_id or frame_num - entry[2] <= self.max_idle_frames
+        }
+
+
+class TrackedRecognizer:
+    """Matches a face against the gallery only when its track needs it.
+
+    Tracks come from obj_meta.object_id when nvtracker is in the pipeline,
+    otherwise from a per-source IoUTracker.
+    """
+
+    def __init__(self, compare_faces, threshold: float, refresh_frames: int = 30):
+        self.compare_faces = compare_faces
+        self.cache = TrackIdentityCache(threshold, refresh_frames=refresh_frames)
+        self.trackers = defaultdict(IoUTracker)
+        self.pruned_at = {}  # source_id -> frame_num of its last prune
+
+    def match(self, frames):
+        """frames: (source_id, frame_num, faces) with faces as (bbox, emb,
+        object_id); returns an iterator of matches in face order"""
+        matches = []
+        misses = []
+        for source_id, frame_num, faces in frames:
+            object_ids = [object_id for _, _, object_id in faces]
+            if not faces or UNTRACKED_OBJECT_ID in object_ids:
+                object_ids = self.trackers[source_id].update(
+                    [bbox for bbox, _, _ in faces]
+                )
+            for (bbox, emb, _), object_id in zip(faces, object_ids):
+                key = (source_id, object_id)
+                match = self.cache.get(key, frame_num)
+                if match is None:
+                    misses.append((len(matches), key, frame_num, emb))
+                matches.append(match)
+            # Sampled frames skip numbers: prune by distance, not multiples
+            last = self.pruned_at.setdefault(source_id, frame_num)
+            if not 0 <= frame_num - last < self.cache.max_idle_frames:
+                self.cache.prune(source_id, frame_num)
+                self.pruned_at[source_id] = frame_num
+
+        if misses:
+            embeddings = np.stack([emb for _, _, _, emb in misses])
+            for (i, key, frame_num, _), match in zip(
+                misses, self.compare_faces(embeddings)
+            ):
+                self.cache.put(key, match, frame_num)
+                matches[i] = match
+        return iter(matches)
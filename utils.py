@@ -1,16 +1,31 @@
 import time
 import sys
 import platform
+from functools import lru_cache
 from PIL import Image, ImageOps
 import numpy as np
 import cv2
 import ctypes
 
+# Distinct label sprites kept rendered (names, match distances)
+LABEL_SPRITE_CACHE_SIZE = 4096
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+
 
 def is_aarch64():
     return platform.uname()[4] == "aarch64"
 
 
+def embedding_from_buffer(address, size=512) -> np.ndarray:
+    """Copy a float32 output tensor at `address` and L2-normalize it in place"""
+    ptr = ctypes.cast(address, ctypes.POINTER(ctypes.c_float))
+    emb = np.ctypeslib.as_array(ptr, shape=(size,)).copy()
+    norm = np.linalg.norm(emb)
+    if norm > 0:
+        emb /= norm
+    return emb
+
+
 def get_bbox(rect_params):
     x = rect_params.left
     y = rect_params.top
@@ -20,6 +35,101 @@ def get_bbox(rect_params):
     return xyxy
 
 
+def text_is_binary() -> bool:
+    """Whether this OpenCV draws Hershey text without anti-aliasing"""
+    canvas = np.zeros((32, 32), dtype=np.uint8)
+    cv2.putText(canvas, "a", (4, 24), LABEL_FONT, 0.75, 255, 2)
+    return not np.any((canvas > 0) & (canvas < 255))
+
+
+# Labels are blitted from sprites where text is binary (OpenCV 4, as in the
+# DeepStream image). OpenCV 5 anti-aliases it, and blending the glyph edges
+# into every frame costs more than putText, so labels are drawn directly.
+LABEL_SPRITES = text_is_binary()
+
+
+@lru_cache(maxsize=LABEL_SPRITE_CACHE_SIZE)
+def label_sprite(text, font_scale, font_thickness, rect_color, font_color, text_height):
+    """Pre-rendered label: (pixels, opaque, (text_width, text_height), pad).
+
+    `pixels` holds the filled background box, `text_height` high, and the
+    glyphs, including descenders and stroke overflow outside the box, with
+    the box `pad` pixels in from the top-left corner. `opaque` is non-zero
+    where the label covers the frame.
+    """
+    (text_width, _), baseline = cv2.getTextSize(
+        text, LABEL_FONT, font_scale, font_thickness
+    )
+    pad = font_thickness + 1
+    shape = (text_height + baseline + 2 * pad, text_width + 2 * pad)
+    pixels = np.zeros(shape + (3,), dtype=np.uint8)
+    opaque = np.zeros(shape, dtype=np.uint8)
+    corners = (pad, pad), (pad + text_width, pad + text_height)
+    origin = (pad, pad + text_height)
+    for canvas, rect, font in ((pixels, rect_color, font_color), (opaque, 1, 1)):
+        cv2.rectangle(canvas, *corners, rect, cv2.FILLED)
+        cv2.putText(canvas, text, origin, LABEL_FONT, font_scale, font, font_thickness)
+    pixels.setflags(write=False)
+    opaque.setflags(write=False)
+    return pixels, opaque, (text_width, text_height), pad
+
+
+def blit_sprite(frame, sprite, x, y):
+    """Paint a label_sprite with its top-left corner at (x, y), clipped to
+    the frame"""
+    pixels, opaque, _, _ = sprite
+    height, width = frame.shape[:2]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2 = min(x + pixels.shape[1], width)
+    y2 = min(y + pixels.shape[0], height)
+    if x1 >= x2 or y1 >= y2:
+        return
+    src = (slice(y1 - y, y2 - y), slice(x1 - x, x2 - x))
+    cv2.copyTo(pixels[src], opaque[src], frame[y1:y2, x1:x2])
+
+
+def label_parts(label):
+    """Split a label line before its last word (the distance of a match
+    label): each part is its own sprite, so a name's sprite is reused
+    whatever distance it is shown with"""
+    head, space, tail = label.rpartition(" ")
+    return [head, space + tail] if head else [tail]
+
+
+def blit_label(frame, label, x, y, font_scale, font_thickness, rect_color, font_color):
+    """Blit the sprites of a label line with its baseline at y; returns
+    the line height"""
+    # Every part's background is as high as the whole line, as in put_label
+    (_, text_height), _ = cv2.getTextSize(label, LABEL_FONT, font_scale, font_thickness)
+    for part in label_parts(label):
+        sprite = label_sprite(
+            part,
+            font_scale,
+            font_thickness,
+            tuple(rect_color),
+            tuple(font_color),
+            text_height,
+        )
+        _, _, (text_width, _), pad = sprite
+        blit_sprite(frame, sprite, x - pad, y - text_height - pad)
+        x += text_width
+    return text_height
+
+
+def put_label(frame, label, x, y, font_scale, font_thickness, rect_color, font_color):
+    """Draw a label line with its baseline at y; returns the line height"""
+    (text_width, text_height), _ = cv2.getTextSize(
+        label, LABEL_FONT, font_scale, font_thickness
+    )
+    cv2.rectangle(
+        frame, (x, y - text_height), (x + text_width, y), rect_color, cv2.FILLED
+    )
+    cv2.putText(
+        frame, label, (x, y), LABEL_FONT, font_scale, font_color, font_thickness
+    )
+    return text_height
+
+
 def label_on_box(
     frame,
     display_texts,
@@ -33,85 +143,47 @@ def label_on_box(
 ) -> np.ndarray:
     margin_x, margin_y = margin
     current_y = y + margin_y
+    draw_label = blit_label if LABEL_SPRITES else put_label
 
     for label in display_texts[::-1]:
-        (text_width, text_height), _ = cv2.getTextSize(
-            label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness
-        )
-        rect_x1 = x + margin_x
-        rect_y1 = current_y - text_height
-        rect_x2 = rect_x1 + text_width
-        rect_y2 = current_y
-
-        cv2.rectangle(
-            frame, (rect_x1, rect_y1), (rect_x2, rect_y2), rect_color, cv2.FILLED
-        )
-        cv2.putText(
+        text_height = draw_label(
             frame,
             label,
-            (rect_x1, current_y),
-            cv2.FONT_HERSHEY_SIMPLEX,
+            x + margin_x,
+            current_y,
             font_scale,
-            font_color,
             font_thickness,
+            rect_color,
+            font_color,
         )
         current_y -= text_height + 4  # Add spacing between lines
 
     return frame
 
 
-def draw_bbox(
+def draw_detections(
     image,
-    bbox,
-    bbox_type="xyxy",
+    bboxes,
+    labels=None,
     bbox_color=(0, 0, 255),
-    label=None,
     font_color=(0, 0, 255),
     rect_color=(255, 255, 255),
     margin=(0, -10),
 ) -> None:
-
-    if isinstance(image, str):
-        temp_image = cv2.imread(image)
-        if temp_image is None:
-            raise ValueError("Could not read image from path.")
-    else:
-        temp_image = image
-
-    h, w = temp_image.shape[:2]
-    temp_bbox = np.array(bbox, dtype=np.float32)
-
-    if bbox_type.endswith("xyxy"):
-        x_min, y_min, x_max, y_max = map(int, temp_bbox)
-    elif bbox_type.endswith("xywh"):
-        x_min, y_min, x_max, y_max = xywh2xyxy(temp_bbox)
-    else:
-        raise ValueError("Invalid bbox_type: should be 'xyxy', 'xywh', or 's_xywh'")
-
-    cv2.rectangle(temp_image, (x_min, y_min), (x_max, y_max), bbox_color, 2)
-
-    if label:
-        if isinstance(label, str):
-            label_on_box(
-                temp_image,
-                [label],
-                x_min,
-                y_min,
-                font_color=font_color,
-                rect_color=rect_color,
-                margin=margin,
-            )
-        elif isinstance(label, (list, tuple)) and all(
-            isinstance(l, str) for l in label
-        ):
+    """Draw every xyxy box of a frame in one call, with `labels[i]` (a
+    string or list of strings) on box i; labels are blitted from the
+    sprite cache where LABEL_SPRITES is set, drawn with putText otherwise"""
+    labels = labels if labels is not None else [None] * len(bboxes)
+    for bbox, label in zip(bboxes, labels):
+        x_min, y_min, x_max, y_max = (int(v) for v in bbox)
+        cv2.rectangle(image, (x_min, y_min), (x_max, y_max), bbox_color, 2)
+        if label:
             label_on_box(
-                temp_image,
-                label,
+                image,
+                [label] if isinstance(label, str) else label,
                 x_min,
                 y_min,
                 font_color=font_color,
                 rect_color=rect_color,
                 margin=margin,
             )
-        else:
-            raise TypeError("Label must be a string or list of strings.")
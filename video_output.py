@@ -0,0 +1,122 @@
+"""Annotated-video writers: OpenCV MP4, or fragmented MP4 / HLS through ffmpeg.
+
+A plain MP4 can only be played once the writer has been released and its
+index written at the end. Fragmented MP4 starts with an empty index and
+appends self-contained fragments at every keyframe, and HLS writes a
+growing playlist of segments, so both can be streamed while frames are
+still being produced.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+
+import cv2
+
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+# e.g. h264_nvenc on GPU nodes
+FFMPEG_VIDEO_CODEC = os.getenv("FFMPEG_VIDEO_CODEC", "libx264")
+# Keyframe interval, hence the fragment / HLS segment length
+VIDEO_SEGMENT_SECONDS = float(os.getenv("VIDEO_SEGMENT_SECONDS", "2"))
+HLS_PLAYLIST = "index.m3u8"
+
+VIDEO_OUTPUT_FORMATS = ("mp4", "fmp4", "hls")
+
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BIN) is not None
+
+
+def output_path(output_dir, job_id, output_format):
+    """Where a job writes its video; HLS gets a directory of segments"""
+    if output_format == "hls":
+        return os.path.join(output_dir, job_id, HLS_PLAYLIST)
+    return os.path.join(output_dir, f"{job_id}.mp4")
+
+
+def remove_output(path):
+    """Delete a video written by open_video_writer"""
+    if os.path.basename(path) == HLS_PLAYLIST:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class FfmpegWriter:
+    """cv2.VideoWriter stand-in that pipes raw BGR frames to ffmpeg"""
+
+    def __init__(self, path, fps, size, output_format):
+        width, height = size
+        command = [
+            FFMPEG_BIN,
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "pipe:0",
+            "-c:v",
+            FFMPEG_VIDEO_CODEC,
+            "-pix_fmt",
+            "yuv420p",
+            "-force_key_frames",
+            f"expr:gte(t,n_forced*{VIDEO_SEGMENT_SECONDS})",
+        ]
+        if output_format == "hls":
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            command += [
+                "-f",
+                "hls",
+                "-hls_time",
+                str(VIDEO_SEGMENT_SECONDS),
+                "-hls_list_size",
+                "0",
+                "-hls_playlist_type",
+                "event",
+                "-hls_segment_filename",
+                os.path.join(directory, "segment_%05d.ts"),
+                path,
+            ]
+        else:
+            # Every fragment reaches the file as soon as it is complete
+            command += [
+                "-flush_packets",
+                "1",
+                "-movflags",
+                "frag_keyframe+empty_moov+default_base_moof",
+                "-f",
+                "mp4",
+                path,
+            ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def release(self):
+        """Close the input and wait until ffmpeg has finalized the output"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = self.process.wait()
+        if code:
+            sys.stderr.write(f"Error: ffmpeg exited with status {code}\n")
+
+
+def open_video_writer(path, fps, size, output_format="mp4"):
+    if output_format == "mp4":
+        # fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+        fourcc = cv2.VideoWriter_fourcc(*"avc1")
+        return cv2.VideoWriter(path, fourcc, fps, size)
+    return FfmpegWriter(path, fps, size, output_format)